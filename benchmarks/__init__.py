@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for kungfupipelines. Run them from the repository root with
+
+    python -m benchmarks --output results.json [--baseline previous.json] [--quick]
+
+Every benchmark writes a record to the output file, so that the effect of a change can be
+measured by comparing against a baseline run.
+"""
@@ -0,0 +1,31 @@
+from benchmarks import bench_artifact_step, bench_cli, bench_workflow
+from benchmarks.harness import Results, compare
+import argparse
+import sys
+
+SUITES = {
+    'artifact_step': bench_artifact_step,
+    'cli': bench_cli,
+    'workflow': bench_workflow,
+}
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run the kungfupipelines benchmarks.")
+    parser.add_argument('--output', default='benchmark-results.json', help="Where to write the results")
+    parser.add_argument('--baseline', help="A previous results file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Slowdown which counts as a regression")
+    parser.add_argument('--quick', action='store_true', help="Use smaller inputs and fewer repeats")
+    parser.add_argument('suites', nargs='*', choices=[[]] + list(SUITES), help="Which suites to run (default: all)")
+    args = parser.parse_args()
+
+    results = Results()
+    for name in args.suites or SUITES:
+        SUITES[name].run(results, quick=args.quick)
+    results.write(args.output)
+    print("Wrote {0} results to {1}".format(len(results.records), args.output))
+    if args.baseline and compare(results.records, args.baseline, args.threshold):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
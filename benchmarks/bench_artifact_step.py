@@ -0,0 +1,134 @@
+"""
+ArtifactStep throughput against FolderCoffers, for many tiny files vs. a few large ones, in
+each of the execution modes. Transfers to a FolderCoffer are nearly free, so the effect of
+transfer concurrency is measured separately with a simulated per-request latency.
+"""
+from kungfupipelines.step import ArtifactStep
+from kungfupipelines.coffers import FolderCoffer
+from kungfupipelines import coffers
+from contextlib import contextmanager
+from caboodle.artifacts import BinaryArtifact
+from benchmarks.harness import measure, Results
+import tempfile
+import shutil
+import time
+import os
+
+def copy_file(filename, output_dir):
+    shutil.copyfile(filename, os.path.join(output_dir, os.path.basename(filename)))
+
+def copy_artifact(artifact):
+    return BinaryArtifact(artifact.key, bytes(artifact.path_or_buffer.getbuffer()))
+
+MODES = {
+    'serial': {},
+    'thread': {'executor': 'thread', 'workers': 4},
+    'process': {'executor': 'process', 'workers': 4},
+    'streaming': {'streaming': True},
+    'in_memory': {'in_memory': True},
+}
+
+def datasets(quick:bool):
+    if quick:
+        return [(200, 1 << 10), (2, 8 << 20)]
+    return [(2000, 1 << 10), (200, 64 << 10), (4, 64 << 20)]
+
+@contextmanager
+def simulated_latency(seconds:float):
+    """ Delays every object-level request to a Coffer by the given number of seconds. """
+    originals = {name: getattr(coffers, name) for name in ('fetch', 'fetch_bytes', 'upload_file')}
+    def delayed(function):
+        def wrapper(*args, **kwargs):
+            time.sleep(seconds)
+            return function(*args, **kwargs)
+        return wrapper
+    for name, function in originals.items():
+        setattr(coffers, name, delayed(function))
+    try:
+        yield
+    finally:
+        for name, function in originals.items():
+            setattr(coffers, name, function)
+
+def run_transfer(results:Results, quick:bool = False):
+
+    count = 50 if quick else 200
+    latency = 0.01
+    root = tempfile.mkdtemp(prefix="bench-transfer-")
+    try:
+        inputs = FolderCoffer(os.path.join(root, "inputs"))
+        outputs = FolderCoffer(os.path.join(root, "outputs"))
+        for i in range(count):
+            with open(os.path.join(inputs.folder, "{0:06d}.bin".format(i)), 'wb') as f:
+                f.write(os.urandom(1 << 10))
+        for mode in ('serial', 'streaming', 'in_memory'):
+            for concurrency in (1, 8, 32):
+                step = ArtifactStep(
+                    'copy',
+                    copy_artifact if mode == 'in_memory' else copy_file,
+                    [],
+                    inputs,
+                    outputs,
+                    local_input=os.path.join(root, "local_input"),
+                    local_output=os.path.join(root, "local_output"),
+                    streaming=mode == 'streaming',
+                    in_memory=mode == 'in_memory',
+                    transfer_concurrency=concurrency,
+                )
+                def reset():
+                    for path in (step.local_input, step.local_output):
+                        shutil.rmtree(path, ignore_errors=True)
+                    outputs.delete()
+                with simulated_latency(latency):
+                    timing = measure(step, repeat=1 if quick else 3, setup=reset)
+                results.add(
+                    'artifact_step_transfer',
+                    {'mode': mode, 'files': count, 'latency': latency, 'transfer_concurrency': concurrency},
+                    timing,
+                    files_per_second=count / timing['median'],
+                )
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def run(results:Results, quick:bool = False):
+
+    run_transfer(results, quick)
+
+    for count, size in datasets(quick):
+        root = tempfile.mkdtemp(prefix="bench-artifact-step-")
+        try:
+            inputs = FolderCoffer(os.path.join(root, "inputs"))
+            outputs = FolderCoffer(os.path.join(root, "outputs"))
+            payload = os.urandom(size)
+            for i in range(count):
+                with open(os.path.join(inputs.folder, "{0:06d}.bin".format(i)), 'wb') as f:
+                    f.write(payload)
+
+            for mode, options in MODES.items():
+                local_input = os.path.join(root, "local_input")
+                local_output = os.path.join(root, "local_output")
+                step = ArtifactStep(
+                    'copy',
+                    copy_artifact if options.get('in_memory') else copy_file,
+                    [],
+                    inputs,
+                    outputs,
+                    local_input=local_input,
+                    local_output=local_output,
+                    **options
+                )
+                def reset():
+                    for path in (local_input, local_output):
+                        shutil.rmtree(path, ignore_errors=True)
+                    outputs.delete()
+                timing = measure(step, repeat=1 if quick else 3, setup=reset)
+                total = count * size
+                results.add(
+                    'artifact_step',
+                    {'mode': mode, 'files': count, 'file_bytes': size},
+                    timing,
+                    files_per_second=count / timing['median'],
+                    megabytes_per_second=total / timing['median'] / (1 << 20),
+                )
+        finally:
+            shutil.rmtree(root, ignore_errors=True)
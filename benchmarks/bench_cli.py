@@ -0,0 +1,77 @@
+"""
+Overhead of StepSwitch dispatch and command line parsing, the cold start time of a
+StepSwitch script, and the round trip time to a StepSwitch server.
+"""
+from kungfupipelines.cli import StepSwitch, _parse_cmdline, run_remote, send_request
+from kungfupipelines.step import Step
+from benchmarks.harness import measure, Results
+import subprocess
+import tempfile
+import logging
+import shutil
+import time
+import sys
+import os
+
+# A StepSwitch script with one plain Step and one lazily imported Step.
+SCRIPT = """
+from kungfupipelines import Step, StepSwitch, LazyStep
+StepSwitch('bench', [Step('noop', lambda: None, []), LazyStep('lazy', 'json:dumps', ['obj'])])()
+"""
+
+def noop(**kwargs):
+    pass
+
+def run(results:Results, quick:bool = False):
+
+    for command in (['-c', 'import kungfupipelines'], ['-c', SCRIPT, 'noop']):
+        timing = measure(lambda: subprocess.check_call([sys.executable] + command), repeat=3 if quick else 10)
+        results.add('cold_start', {'command': command[-1] if command[-1] == 'noop' else command[1]}, timing)
+
+    folder = tempfile.mkdtemp()
+    address = os.path.join(folder, 'bench.sock')
+    server = subprocess.Popen([sys.executable, '-c', SCRIPT, '--serve', address], stderr=subprocess.DEVNULL)
+    try:
+        while not os.path.exists(address):
+            time.sleep(0.01)
+        requests = 100 if quick else 1000
+        def remote():
+            for _ in range(requests):
+                run_remote(address, ['noop'])
+        timing = measure(remote, repeat=3)
+        results.add('warm_server', {'command': 'noop'}, timing, microseconds_per_call=timing['median'] / requests * 1e6)
+    finally:
+        send_request(address, {'command': 'shutdown'})
+        server.wait()
+        shutil.rmtree(folder, ignore_errors=True)
+
+    calls = 1000 if quick else 10000
+    logging.disable(logging.CRITICAL) # Don't measure logging
+    argv = sys.argv
+    try:
+        for num_args in [1, 10, 50]:
+            names = ['arg{0}'.format(i) for i in range(num_args)]
+            sys.argv = ['script.py', 'step'] + [x for name in names for x in ('--' + name, 'value')]
+
+            def parse():
+                for _ in range(calls):
+                    _parse_cmdline()
+            timing = measure(parse)
+            results.add('parse_cmdline', {'arguments': num_args}, timing, microseconds_per_call=timing['median'] / calls * 1e6)
+
+            for num_steps in [1, 100]:
+                steps = [Step('step' if i == 0 else 'step{0}'.format(i), noop, names) for i in range(num_steps)]
+                switch = StepSwitch('bench', steps)
+                def dispatch():
+                    for _ in range(calls):
+                        switch()
+                timing = measure(dispatch)
+                results.add(
+                    'step_switch_dispatch',
+                    {'arguments': num_args, 'steps': num_steps},
+                    timing,
+                    microseconds_per_call=timing['median'] / calls * 1e6,
+                )
+    finally:
+        sys.argv = argv
+        logging.disable(logging.NOTSET)
@@ -0,0 +1,72 @@
+"""
+Time taken to build and compile pipelines of increasing size.
+"""
+from kungfupipelines.workflow import SequentialWorkflow, DAGWorkflow
+from kungfupipelines.compiler import compile_many, CompileCache
+from kungfupipelines.step import Step
+from benchmarks.harness import measure, Results
+import tempfile
+import shutil
+import os
+
+def make_steps(n:int):
+    return [Step('step{0}'.format(i), print, ['a', 'b']) for i in range(n)]
+
+def build_ops(workflow):
+    """
+    Compiles a workflow and builds its ContainerOps, which is the work that compile itself
+    defers to the pipeline function it returns, without serializing the result.
+    """
+    from kfp import dsl
+    pipeline = workflow.compile('image', 'script.py')
+    with dsl.Pipeline('bench'):
+        pipeline()
+
+def run_sweep(results:Results, root:str, quick:bool = False):
+    """ Compiles a sweep of workflow variants one by one, with compile_many, and from the cache. """
+    variants = 20 if quick else 200
+    distinct = variants // 2 # Half of the variants duplicate another one
+    workflows = {
+        os.path.join(root, "variant-{0}.tar.gz".format(i)): SequentialWorkflow(
+            'sweep', make_steps(10) + [Step('train-{0}'.format(i % distinct), print, ['lr'])]
+        )
+        for i in range(variants)
+    }
+    def one_by_one():
+        for filename, workflow in workflows.items():
+            workflow.generate_yaml(filename, 'image', 'script.py')
+    timing = measure(one_by_one, repeat=1)
+    results.add('compile_sweep', {'method': 'generate_yaml', 'variants': variants}, timing, variants_per_second=variants / timing['median'])
+
+    timing = measure(lambda: compile_many(workflows, 'image', 'script.py'), repeat=1)
+    results.add('compile_sweep', {'method': 'compile_many', 'variants': variants}, timing, variants_per_second=variants / timing['median'])
+
+    cache = CompileCache(os.path.join(root, "cache"))
+    compile_many(workflows, 'image', 'script.py', cache=cache)
+    timing = measure(lambda: compile_many(workflows, 'image', 'script.py', cache=cache), repeat=3)
+    results.add('compile_sweep', {'method': 'compile_many_cached', 'variants': variants}, timing, variants_per_second=variants / timing['median'])
+
+def run(results:Results, quick:bool = False):
+
+    sizes = [10, 100] if quick else [10, 100, 1000]
+    root = tempfile.mkdtemp(prefix="bench-workflow-")
+    try:
+        for n in sizes:
+            steps = make_steps(n)
+            # Each step depends on the two before it, so there are redundant edges to reduce.
+            dependencies = {s.name: [p.name for p in steps[max(i-2, 0):i]] for i, s in enumerate(steps)}
+            workflows = {
+                'sequential': lambda: SequentialWorkflow('bench', steps),
+                'dag': lambda: DAGWorkflow('bench', steps, dependencies),
+            }
+            for kind, make_workflow in workflows.items():
+                workflow = make_workflow()
+                repeat = 1 if n >= 1000 else 3
+                timing = measure(lambda: build_ops(workflow), repeat=repeat)
+                results.add('workflow_compile', {'workflow': kind, 'steps': n}, timing, steps_per_second=n / timing['median'])
+                filename = os.path.join(root, "{0}-{1}.tar.gz".format(kind, n))
+                timing = measure(lambda: workflow.generate_yaml(filename, 'image', 'script.py'), repeat=repeat)
+                results.add('workflow_generate_yaml', {'workflow': kind, 'steps': n}, timing, steps_per_second=n / timing['median'])
+        run_sweep(results, root, quick)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
@@ -0,0 +1,87 @@
+"""
+Utilities for timing benchmarks and recording their results.
+"""
+from typing import Callable, List
+import platform
+import subprocess
+import statistics
+import time
+import json
+import sys
+
+def measure(function:Callable, repeat:int = 5, setup:Callable = None) -> dict:
+    """
+    Calls function repeat times (calling setup before each call, untimed) and returns timing
+    statistics in seconds.
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'max': max(timings),
+        'repeat': repeat,
+    }
+
+class Results():
+    """ Collects benchmark records and writes them to a JSON file. """
+    def __init__(self):
+        self.records = []
+
+    def add(self, benchmark:str, params:dict, timing:dict, **metrics):
+        record = {'benchmark': benchmark, 'params': params, 'seconds': timing}
+        record.update(metrics)
+        self.records.append(record)
+        print("{0:<32} {1:<48} median {2:.6f}s {3}".format(
+            benchmark,
+            json.dumps(params, sort_keys=True),
+            timing['median'],
+            " ".join("{0}={1:.4g}".format(k, v) for k, v in metrics.items()),
+        ))
+
+    def metadata(self) -> dict:
+        try:
+            commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'timestamp': time.time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'commit': commit,
+        }
+
+    def write(self, filename:str):
+        with open(filename, 'w') as f:
+            json.dump({'metadata': self.metadata(), 'results': self.records}, f, indent=2)
+
+def _key(record:dict) -> str:
+    return record['benchmark'] + json.dumps(record['params'], sort_keys=True)
+
+def compare(current:List[dict], baseline_file:str, threshold:float = 0.1) -> List[str]:
+    """
+    Prints the change in median time of every benchmark relative to a baseline results file,
+    and returns the keys of benchmarks which got slower by more than threshold.
+    """
+    with open(baseline_file) as f:
+        baseline = {_key(r): r for r in json.load(f)['results']}
+    regressions = []
+    print("\nComparison with {0}:".format(baseline_file))
+    for record in current:
+        key = _key(record)
+        if key not in baseline:
+            continue
+        before = baseline[key]['seconds']['median']
+        after = record['seconds']['median']
+        change = (after - before) / before if before else 0.
+        flag = ""
+        if change > threshold:
+            regressions.append(key)
+            flag = "  <-- regression"
+        print("{0:<80} {1:+.1%}{2}".format(key, change, flag))
+    return regressions
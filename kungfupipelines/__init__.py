@@ -1,3 +1,3 @@
 from .step import Step, ArtifactStep
-from .cli import StepSwitch
+from .cli import StepSwitch, LazyStep
 from .workflow import *
\ No newline at end of file
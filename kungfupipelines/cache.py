@@ -0,0 +1,296 @@
+"""
+Content-addressed caching of Step results. A StepCache can be used as the check_if_complete
+argument of a Step: it fingerprints the Step's function, its arguments and (for an
+ArtifactStep) the contents of its input Coffer, and skips the Step if a completion record for
+that fingerprint exists in a cache store.
+
+    cache = StepCache(LocalCacheStore("/mnt/cache", max_entries=1000, ttl=7*24*3600))
+    step = ArtifactStep(..., check_if_complete=cache)
+"""
+from kungfupipelines import coffers
+from caboodle.coffer import Coffer
+from typing import Callable, List
+import threading
+import hashlib
+import random
+import inspect
+import logging
+import json
+import time
+import os
+import abc
+
+logger = logging.getLogger(__name__)
+
+def function_source(function:Callable) -> str:
+    """
+    Returns the source code of a function, falling back to its bytecode for functions whose
+    source is not available. Note that only the function itself is inspected; changes to
+    other functions that it calls do not change its fingerprint.
+    """
+    try:
+        return inspect.getsource(function)
+    except (OSError, TypeError):
+        code = getattr(function, '__code__', None)
+        if code is not None:
+            return repr((code.co_code, code.co_consts, code.co_names))
+        return getattr(function, '__qualname__', repr(function))
+
+def fingerprint(step, *args, **kwargs) -> str:
+    """
+    Returns a hex digest which identifies the result of running step with the given
+    arguments. It covers the step's name and function source, the arguments, and for Steps
+    with an input_coffer and output_coffer (ie. ArtifactSteps), the name, size and checksum
+    of each input object along with the location that outputs are written to. The shard of
+    a sharded ArtifactStep is included too, since each shard processes different inputs.
+    """
+    digest = hashlib.sha256()
+    digest.update(step.name.encode())
+    digest.update(function_source(step.function).encode())
+    digest.update(json.dumps([args, kwargs], sort_keys=True, default=repr).encode())
+    input_coffer = getattr(step, 'input_coffer', None)
+    output_coffer = getattr(step, 'output_coffer', None)
+    if input_coffer is not None:
+        for info in coffers.list_objects(input_coffer):
+            digest.update(json.dumps(list(info)).encode())
+    if output_coffer is not None:
+        digest.update(output_coffer.location.encode())
+    if getattr(step, 'sharded', False):
+        digest.update("shard {0} of {1} by {2}".format(step.shard_index, step.shard_count, step.shard_by).encode())
+    return digest.hexdigest()
+
+class CacheStore(abc.ABC):
+    """
+    Stores completion records keyed by fingerprint.
+    Entries expire ttl seconds after they were written, and when there are more than
+    max_entries entries, the least recently used ones are evicted.
+
+    Looking a record up only rewrites it to update when it was last used if that was at least
+    touch_interval seconds ago, so that recency is tracked to within touch_interval. Writing a
+    record only reads the other records to evict some once there are more than max_entries
+    (and then evicts down to 90% of max_entries, so that this is not needed on every write),
+    or, with a ttl, to remove expired records on a random sweep_probability of writes. Expired
+    records are never returned in the meantime.
+
+    Args:
+        max_entries: (optional) Maximum number of records to keep
+        ttl: (optional) Number of seconds after which a record expires
+        touch_interval: The number of seconds for which the last use of a record is not updated
+        sweep_probability: The probability that a write removes expired records
+    """
+    def __init__(self, max_entries:int = None, ttl:float = None, touch_interval:float = 3600, sweep_probability:float = 0.05):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.sweep_probability = sweep_probability
+        self._count = None # The number of records, counted on the first write
+        self._lock = threading.Lock()
+
+    def get(self, key:str) -> dict:
+        """ Returns the record for key, or None if there is no valid record. """
+        record = self._read(key)
+        if record is None:
+            return None
+        now = time.time()
+        if self.ttl is not None and now - record['created'] > self.ttl:
+            self._delete(key)
+            return None
+        if now - record['last_used'] >= self.touch_interval:
+            record['last_used'] = now
+            self._write(key, record)
+        return record
+
+    def put(self, key:str, record:dict):
+        now = time.time()
+        record = dict(record, created=now, last_used=now)
+        self._write(key, record)
+        full = False
+        if self.max_entries is not None:
+            with self._lock:
+                if self._count is None:
+                    self._count = len(self._keys())
+                else:
+                    self._count += 1 # Records are put after a miss, so they are usually new
+                full = self._count > self.max_entries
+        if full or (self.ttl is not None and random.random() < self.sweep_probability):
+            self.evict()
+
+    def evict(self):
+        """
+        Removes expired records, and then if there are more than max_entries records, the least
+        recently used records down to 90% of max_entries.
+        """
+        if self.max_entries is None and self.ttl is None:
+            return
+        now = time.time()
+        records = []
+        for key in self._keys():
+            record = self._read(key)
+            if record is None:
+                continue
+            if self.ttl is not None and now - record['created'] > self.ttl:
+                self._delete(key)
+            else:
+                records.append((record['last_used'], key))
+        if self.max_entries is not None and len(records) > self.max_entries:
+            records.sort()
+            keep = self.max_entries - self.max_entries // 10
+            for _, key in records[:len(records) - keep]:
+                logger.debug("Evicting cache record %s", key)
+                self._delete(key)
+            records = records[len(records) - keep:]
+        with self._lock:
+            self._count = len(records)
+
+    @abc.abstractmethod
+    def _read(self, key:str) -> dict:
+        pass
+
+    @abc.abstractmethod
+    def _write(self, key:str, record:dict):
+        pass
+
+    @abc.abstractmethod
+    def _delete(self, key:str):
+        pass
+
+    @abc.abstractmethod
+    def _keys(self) -> List[str]:
+        pass
+
+class LocalCacheStore(CacheStore):
+    """
+    Stores completion records as JSON files in a local folder.
+    """
+    def __init__(
+        self,
+        path:str,
+        max_entries:int = None,
+        ttl:float = None,
+        touch_interval:float = 3600,
+        sweep_probability:float = 0.05,
+    ):
+        super().__init__(max_entries, ttl, touch_interval, sweep_probability)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, key:str) -> str:
+        return os.path.join(self.path, key + '.json')
+
+    def _read(self, key):
+        try:
+            with open(self._filename(key)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write(self, key, record):
+        temp = self._filename(key) + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(record, f)
+        os.replace(temp, self._filename(key))
+
+    def _delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except FileNotFoundError:
+            pass
+
+    def _keys(self):
+        return [f[:-len('.json')] for f in os.listdir(self.path) if f.endswith('.json')]
+
+class CofferCacheStore(CacheStore):
+    """
+    Stores completion records as hidden JSON objects in a Coffer, so that the cache can be
+    shared between pods. Only GCSCoffers and LocalCoffers are supported.
+    """
+    prefix = '.cache-'
+
+    def __init__(
+        self,
+        coffer:Coffer,
+        max_entries:int = None,
+        ttl:float = None,
+        touch_interval:float = 3600,
+        sweep_probability:float = 0.05,
+    ):
+        super().__init__(max_entries, ttl, touch_interval, sweep_probability)
+        self.coffer = coffer
+
+    def _read(self, key):
+        return coffers.read_metadata(self.coffer, self.prefix + key)
+
+    def _write(self, key, record):
+        coffers.write_metadata(self.coffer, self.prefix + key, record)
+
+    def _delete(self, key):
+        coffers.delete_object(self.coffer, self.prefix + key)
+
+    def _keys(self):
+        return [
+            o.name[len(self.prefix):] for o in coffers.list_objects(self.coffer, include_hidden=True)
+            if o.name.startswith(self.prefix)
+        ]
+
+class StepCache():
+    """
+    A check_if_complete implementation which skips Steps whose fingerprint (see fingerprint)
+    has a completion record in store. Records are written once a Step completes successfully.
+    A single StepCache can be shared between Steps, and keeps count of the hit rate across
+    all of them, which is logged on every lookup.
+
+    Args:
+        store: The CacheStore to keep completion records in
+    """
+    def __init__(self, store:CacheStore):
+        self.store = store
+        self.hits = 0
+        self.lookups = 0
+        self._lock = threading.Lock()
+
+    def bind(self, step) -> 'BoundStepCache':
+        """ Returns a view of this cache for a specific Step. Called by Step.__init__. """
+        return BoundStepCache(self, step)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.
+
+    def _count(self, hit:bool):
+        with self._lock:
+            self.lookups += 1
+            self.hits += int(hit)
+
+    def __call__(self, *args, **kwargs):
+        raise RuntimeError("StepCache must be bound to a Step. Pass it to a Step as check_if_complete.")
+
+class BoundStepCache():
+    """
+    A StepCache bound to a Step. The Step is fingerprinted as it is configured when it runs.
+    """
+    def __init__(self, cache:StepCache, step):
+        self.cache = cache
+        self.step = step
+        self._keys = {}
+
+    def bind(self, step) -> 'BoundStepCache':
+        """ Returns a view of the same cache for another Step (eg. a copy of this one). """
+        return self.cache.bind(step)
+
+    def __call__(self, *args, **kwargs) -> bool:
+
+        key = fingerprint(self.step, *args, **kwargs)
+        self._keys[threading.get_ident()] = key
+        hit = self.cache.store.get(key) is not None
+        self.cache._count(hit)
+        logger.info(
+            "Cache %s for step %s (key %s). Cache hit rate: %d/%d (%.0f%%)",
+            "hit" if hit else "miss", self.step.name, key[:12],
+            self.cache.hits, self.cache.lookups, 100 * self.cache.hit_rate,
+        )
+        return hit
+
+    def mark_complete(self, *args, **kwargs):
+        """ Records that the Step has completed for these arguments. """
+        key = self._keys.pop(threading.get_ident(), None) or fingerprint(self.step, *args, **kwargs)
+        self.cache.store.put(key, {'step': self.step.name})
@@ -0,0 +1,109 @@
+from kungfupipelines import cache, step
+from kungfupipelines import step_test
+from kungfupipelines.coffers import FolderCoffer
+import time
+import copy
+import os
+
+def test_step_cache(tmp_path):
+
+    calls = 0
+    def add(a, b):
+        nonlocal calls
+        calls += 1
+        return int(a) + int(b)
+
+    step_cache = cache.StepCache(cache.LocalCacheStore(str(tmp_path / "cache")))
+    my_step = step.Step('add', add, ['a', 'b'], check_if_complete=step_cache)
+
+    assert my_step(a=1, b=2) == 3
+    assert my_step(a=1, b=2) is None # Skipped
+    assert my_step(a=2, b=2) == 4
+    assert calls == 2
+    assert step_cache.hits == 1
+    assert step_cache.lookups == 3
+
+def test_artifact_step_fingerprint(tmp_path):
+
+    input_coffer = FolderCoffer(str(tmp_path / "inputs"))
+    output_coffer = FolderCoffer(str(tmp_path / "outputs"))
+    (tmp_path / "inputs" / "a.txt").write_bytes(b"a")
+    my_step = step.ArtifactStep('copy', print, [], input_coffer, output_coffer)
+
+    before = cache.fingerprint(my_step)
+    assert cache.fingerprint(my_step) == before
+    (tmp_path / "inputs" / "a.txt").write_bytes(b"b")
+    assert cache.fingerprint(my_step) != before
+
+def test_sharded_step_cache(tmp_path):
+
+    contents = {"{0}.txt".format(i): str(i).encode() for i in range(8)}
+    input_coffer, output_coffer = step_test.make_local_coffers(tmp_path, contents)
+    step_cache = cache.StepCache(cache.LocalCacheStore(str(tmp_path / "cache")))
+    my_step = step.ArtifactStep(
+        'shout', step_test.shout, [], input_coffer, output_coffer,
+        local_input=str(tmp_path / "local_input"), local_output=str(tmp_path / "local_output"),
+        check_if_complete=step_cache,
+    )
+    for i in range(2):
+        shard = copy.copy(my_step) # As StepSwitch runs each invocation
+        shard.configure(shard_index=i, shard_count=2)
+        shard()
+
+    assert sorted(p.name for p in (tmp_path / "outputs").iterdir()) == sorted(contents)
+    assert step_cache.hits == 0
+    shard()
+    assert step_cache.hits == 1
+
+def test_eviction(tmp_path):
+
+    stores = [
+        cache.LocalCacheStore(str(tmp_path / "cache"), max_entries=2, touch_interval=0),
+        cache.CofferCacheStore(FolderCoffer(str(tmp_path / "coffer")), max_entries=2, touch_interval=0),
+    ]
+    for store in stores:
+        store.put('a', {})
+        time.sleep(.01)
+        store.put('b', {})
+        time.sleep(.01)
+        assert store.get('a') is not None # a is now more recently used than b
+        time.sleep(.01)
+        store.put('c', {})
+        assert store.get('b') is None
+        assert store.get('a') is not None
+        assert store.get('c') is not None
+
+    store = cache.LocalCacheStore(str(tmp_path / "ttl"), ttl=-1)
+    store.put('a', {})
+    assert store.get('a') is None
+
+class CountingStore(cache.LocalCacheStore):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reads = 0
+        self.writes = 0
+
+    def _read(self, key):
+        self.reads += 1
+        return super()._read(key)
+
+    def _write(self, key, record):
+        self.writes += 1
+        super()._write(key, record)
+
+def test_store_requests(tmp_path):
+
+    store = CountingStore(str(tmp_path / "cache"), max_entries=10, ttl=3600, sweep_probability=0)
+    for i in range(10):
+        store.put(str(i), {})
+    assert store.reads == 0 # Under max_entries, nothing is read to evict
+    for _ in range(3):
+        assert store.get('0') is not None
+    assert store.writes == 10 # Used within touch_interval, so not rewritten
+
+    store.put('10', {}) # Over max_entries: evicts down to 9 records
+    assert store.reads == 3 + 11
+    assert sorted(os.listdir(str(tmp_path / "cache"))) == sorted("{0}.json".format(i) for i in range(2, 11))
+    store.put('11', {})
+    assert store.reads == 3 + 11 # Room was left for more records
@@ -1,11 +1,77 @@
 import pprint
 import sys
-from kungfupipelines.step import Step
-from typing import List
+import importlib
+from kungfupipelines.step import Step, FusedStep, _sigterm_as_exit
+from contextlib import redirect_stdout
+from typing import List, Union
+import traceback
 import logging
+import socket
+import json
+import copy
+import time
+import os
 
 logger = logging.getLogger(__name__)
 
+SERVER_ENV = 'KUNGFUPIPELINES_SERVER' # If set, StepSwitches send invocations to the server at this address
+
+class StepSwitchError(RuntimeError):
+    """
+    Raised by a StepSwitch client when the server fails to run the Step it was asked to run.
+    The traceback attribute contains the traceback from the server.
+    """
+    def __init__(self, message:str, traceback:str = None):
+        self.traceback = traceback
+        if traceback:
+            message = "{0}\n\nServer traceback:\n{1}".format(message, traceback)
+        super().__init__(message)
+
+class LazyStep():
+    """
+    A placeholder for a Step which is only imported once a StepSwitch is asked to run it.
+    Defining the Steps of a StepSwitch script this way means that starting the script only
+    imports the modules needed by the Step which actually runs.
+
+    Args:
+        name: The name of the Step
+        target: Where to find the Step, as 'module:attribute'. If the attribute is a Step, it
+            is used as is; otherwise it is treated as the function of a Step with the given
+            name, arguments, fullname and description.
+        arguments: (optional) The arguments of the function, if target is a function
+        fullname: (optional) The fullname of the step
+        description: (optional) The description for the step
+    """
+    def __init__(
+        self,
+        name:str,
+        target:str,
+        arguments:List[str] = None,
+        fullname:str = None,
+        description:str = None,
+    ):
+        if ':' not in target:
+            raise ValueError("Expected a target of the form 'module:attribute', not '{0}'.".format(target))
+        self.name = name
+        self.target = target
+        self.arguments = arguments or []
+        self.fullname = fullname or name
+        self.description = description or ""
+        self._step = None
+
+    def resolve(self) -> Step:
+        """ Imports the target and returns the Step it refers to. """
+        if self._step is None:
+            module_name, attribute = self.target.split(':', 1)
+            obj = importlib.import_module(module_name)
+            for part in attribute.split('.'):
+                obj = getattr(obj, part)
+            if isinstance(obj, Step):
+                self._step = obj
+            else:
+                self._step = Step(self.name, obj, self.arguments, fullname=self.fullname, description=self.description)
+        return self._step
+
 class StepSwitch():
     """
     This is essentially a collection of Steps. When called, this reads in 
@@ -13,17 +79,71 @@ class StepSwitch():
     eg. if you had run python myscript.py step1 a b c --d
     and myscript.py simply creates and calls a StepSwitch, the result would be to call the
     Step named 'step1' with positional arguments a,b,c, and d=True
+    Command line options which match one of the Step's runtime options (eg. --executor and
+    --workers for an ArtifactStep) are used to configure the Step instead of being passed to
+    its function.
+    Several Steps can be run one after another by joining their names with commas, eg.
+    python myscript.py step1,step2 (see FusedStep).
+    Steps can also be given as LazySteps, which are only imported when they are run.
+
+    Each invocation normally runs in a process of its own, which sets up the Step, runs it and
+    tears it down again (see the setup argument of Step). For many small invocations of Steps
+    with an expensive setup, the StepSwitch can instead be started as a server which keeps its
+    Steps set up between invocations:
+        python myscript.py --serve /tmp/myscript.sock [--preload step1,step2]
+    and the usual command lines are then sent to it by adding --connect, or by setting the
+    KUNGFUPIPELINES_SERVER environment variable to the server's address:
+        python myscript.py step1 a b c --d --connect /tmp/myscript.sock
+    The client exits once the server has run the Step, and raises a StepSwitchError if it
+    failed. If no server is listening at the address, the client runs the Step itself.
+    With --serve and no address, requests are read from stdin instead (see serve).
+    A Step can also be run on many sets of arguments at once with --sweep (see
+    kungfupipelines.sweep).
+    The options --serve, --preload, --connect, --shutdown and those starting with --sweep are
+    therefore reserved.
     """
-    def __init__(self, name:str, steps:List[Step]):
+    def __init__(self, name:str, steps:List[Union[Step, LazyStep]]):
 
         self.name = name
         self.steps = steps
         self.steps_dict = {step.name: step for step in self.steps}
 
-    def __call__(self):
-        """ Parse command line arguments and options to decide which step to run and provide the appropriate arguments. """
+    def __call__(self, argv:List[str] = None):
+        """
+        Parse command line arguments and options to decide which step to run and provide the appropriate arguments.
+        argv defaults to sys.argv[1:].
+        """
+        argv = sys.argv[1:] if argv is None else list(argv)
+        positionals, keywords = _parse_cmdline(argv)
+        if not positionals and 'serve' in keywords:
+            preload = keywords.get('preload')
+            return self.serve(
+                keywords['serve'] if isinstance(keywords['serve'], str) else '-',
+                preload.split(',') if isinstance(preload, str) else None,
+            )
+        address = keywords.get('connect', os.environ.get(SERVER_ENV))
+        if isinstance(address, str) and address:
+            if not positionals and 'shutdown' in keywords:
+                return send_request(address, {'command': 'shutdown'})
+            if positionals:
+                try:
+                    return run_remote(address, _without_option(argv, 'connect'))
+                except (FileNotFoundError, ConnectionRefusedError):
+                    logger.warning("No StepSwitch server is listening at {0}. Running the step here.".format(address))
+        try:
+            return self._dispatch(positionals, keywords)
+        finally:
+            self.teardown()
+
+    def run(self, argv:List[str]):
+        """
+        Runs the Step given by a command line (without the script name), and returns its result.
+        Unlike calling the StepSwitch, this leaves the Step set up for the next invocation.
+        """
+        return self._dispatch(*_parse_cmdline(argv))
+
+    def _dispatch(self, positionals:List[str], keywords:dict):
 
-        positionals, keywords = _parse_cmdline()
         logger.debug("Received arguments %s with keywords %s", positionals, keywords)
         if len(positionals) == 0:
             print("{0} \n------\nOptions:\n {1}".format(
@@ -32,21 +152,207 @@ class StepSwitch():
                 )
             )
             return
-        step = self.steps_dict[positionals[-1]] # Treat the last positional argument as the step name
+        step = self.get_step(positionals[-1]) # Treat the last positional argument as the step name
         logger.debug(step.arguments)
         arguments = {arg.replace('-','_'):keywords[arg] for arg in step.arguments if arg in keywords}
+        options = {opt.replace('-','_'):keywords[opt] for opt in step.options if opt in keywords}
+        if options:
+            logger.info("Configuring step '%s' with options %s", step.fullname, pprint.pformat(options))
+            # Options only apply to this invocation, but the copy shares the Step's setup.
+            step.setup()
+            step = copy.copy(step)
+            step.configure(**options)
+        if 'sweep' in keywords:
+            return self._sweep(step, arguments, keywords)
         logger.info("Running step '%s' with arguments %s", step.fullname, pprint.pformat(arguments))
         return step(**arguments)
 
-def _parse_cmdline():
+    def _sweep(self, step:Step, arguments:dict, keywords:dict) -> List:
+        """ Runs a Step on the configurations given by --sweep (see kungfupipelines.sweep). """
+        from kungfupipelines.sweep import load_configurations, run_sweep
+        source = keywords['sweep']
+        if not isinstance(source, str) or not source:
+            raise ValueError(
+                "--sweep needs the configurations to run: a JSON or JSON Lines file, a gs:// URL, or inline JSON, "
+                "eg. --sweep configs.jsonl"
+            )
+        start = keywords.get('sweep-start')
+        stop = keywords.get('sweep-stop')
+        configurations = load_configurations(source)[
+            int(start) if start is not None else None : int(stop) if stop is not None else None
+        ]
+        workers = keywords.get('sweep-workers')
+        return run_sweep(
+            step,
+            configurations,
+            arguments,
+            executor=keywords.get('sweep-executor', 'serial'),
+            workers=int(workers) if workers is not None else None,
+        )
+
+    def get_step(self, name:str) -> Step:
+        """ Returns the Step with the given name, or a FusedStep for a comma separated list of names. """
+        if name in self.steps_dict or ',' not in name:
+            return self._resolve(self.steps_dict[name])
+        return FusedStep([self._resolve(self.steps_dict[n]) for n in name.split(',')])
+
+    def _resolve(self, step:Union[Step, LazyStep]) -> Step:
+
+        if isinstance(step, LazyStep):
+            name = step.name
+            step = step.resolve()
+            self.steps_dict[name] = step
+        return step
+
+    def teardown(self):
+        """ Tears down the Steps which have been set up. LazySteps which were never run are skipped. """
+        for step in self.steps_dict.values():
+            if isinstance(step, Step):
+                step.teardown()
+
+    def serve(self, address:str = '-', preload:List[str] = None):
+        """
+        Runs Steps on request until told to shut down, keeping them set up in between. Requests
+        are handled one at a time, in the order they arrive.
+        Requests and responses are single lines of JSON. A request is either
+            {"argv": ["step1", "a", "--d"]}
+        to run a Step as if from the command line, or {"command": "ping"} or
+        {"command": "shutdown"}. The response is {"ok": true, "result": ..., "seconds": ...},
+        where the result is the Step's return value (or its repr, if it can't be converted to
+        JSON), or {"ok": false, "error": ..., "traceback": ...} if the Step raised.
+        The Steps are torn down when the server shuts down, including on SIGTERM.
+
+        Args:
+            address: The path of a Unix socket to listen on, or '-' to read requests from stdin
+                and write responses to stdout. Anything the Steps print goes to stderr instead.
+                The server stops at the end of stdin.
+            preload: (optional) The names of Steps to set up before the first request
+        """
+        with _sigterm_as_exit():
+            try:
+                for name in preload or []:
+                    self.get_step(name).setup()
+                if address == '-':
+                    output = sys.stdout
+                    with redirect_stdout(sys.stderr):
+                        self._serve_lines(sys.stdin, output)
+                else:
+                    self._serve_socket(address)
+            finally:
+                self.teardown()
+
+    def _serve_socket(self, address:str):
+
+        if os.path.exists(address): # Left behind by a server which was killed
+            os.remove(address)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(address)
+            server.listen()
+            logger.info("Serving {0} on {1}".format(self.name, address))
+            stop = False
+            while not stop:
+                connection, _ = server.accept()
+                try:
+                    with connection, connection.makefile('rw', encoding='utf-8') as stream:
+                        stop = self._serve_lines(stream, stream)
+                except OSError as e: # The client went away
+                    logger.warning("Lost connection to client: {0}".format(e))
+        finally:
+            server.close()
+            if os.path.exists(address):
+                os.remove(address)
+
+    def _serve_lines(self, requests, responses) -> bool:
+        """ Handles requests, one per line, until they run out. Returns whether to shut down. """
+        for line in requests:
+            if not line.strip():
+                continue
+            response, stop = self._handle(line)
+            responses.write(json.dumps(response, default=repr) + '\n')
+            responses.flush()
+            if stop:
+                return True
+        return False
+
+    def _handle(self, line:str):
+
+        try:
+            request = json.loads(line)
+            command = request.get('command', 'run')
+        except (ValueError, AttributeError):
+            return {'ok': False, 'error': "Invalid request: {0}".format(line.strip())}, False
+        if command == 'ping':
+            return {'ok': True}, False
+        if command == 'shutdown':
+            logger.info("Shutting down {0}".format(self.name))
+            return {'ok': True}, True
+        if command != 'run':
+            return {'ok': False, 'error': "Unknown command '{0}'".format(command)}, False
+
+        start = time.time()
+        try:
+            result = self.run(request.get('argv', []))
+        except Exception as e:
+            logger.exception("Failed to run {0}".format(request.get('argv')))
+            return {
+                'ok': False,
+                'error': "{0}: {1}".format(type(e).__name__, e),
+                'traceback': traceback.format_exc(),
+            }, False
+        return {'ok': True, 'result': result, 'seconds': time.time() - start}, False
+
+def send_request(address:str, request:dict) -> dict:
+    """ Sends a request to a StepSwitch server and returns its response (see StepSwitch.serve). """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(address)
+        with connection.makefile('rw', encoding='utf-8') as stream:
+            stream.write(json.dumps(request) + '\n')
+            stream.flush()
+            line = stream.readline()
+    if not line:
+        raise StepSwitchError("The server at {0} closed the connection without responding.".format(address))
+    return json.loads(line)
+
+def run_remote(address:str, argv:List[str]):
+    """
+    Asks the StepSwitch server at address to run the Step given by a command line, and returns
+    the result. Raises a StepSwitchError if the Step fails.
+    """
+    response = send_request(address, {'argv': argv})
+    if not response['ok']:
+        raise StepSwitchError(
+            "Running {0} on the server at {1} failed: {2}".format(argv, address, response['error']),
+            response.get('traceback'),
+        )
+    logger.info("Ran {0} on the server at {1} in {2:.3f} seconds".format(argv, address, response['seconds']))
+    return response['result']
+
+def _without_option(argv:List[str], option:str) -> List[str]:
+    """ Removes --option and its value from a command line. """
+    flag = '--' + option
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+            if not arg.startswith('--'):
+                continue
+        if arg == flag:
+            skip = True
+            continue
+        result.append(arg)
+    return result
+
+def _parse_cmdline(argv:List[str] = None):
     """
-    Parses command line arguments for use by a StepSwitch.
+    Parses command line arguments for use by a StepSwitch. argv defaults to sys.argv[1:].
     Flag arguments are converted to True (eg. command --x would produce the argument x=True)
     """
     pos = []
     named = {}
     key = None
-    args = sys.argv[1:]
+    args = sys.argv[1:] if argv is None else argv
     for arg in args:
         if key:
             if arg.startswith('--'):
@@ -0,0 +1,127 @@
+from kungfupipelines.cli import StepSwitch, StepSwitchError, LazyStep, _parse_cmdline, send_request
+from kungfupipelines.step import Step
+import subprocess
+import threading
+import pytest
+import json
+import sys
+import io
+import os
+
+def test_parse_cmdline(monkeypatch):
+
+    monkeypatch.setattr(sys, 'argv', ['script.py', 'step1', '--a', '1', '--flag', '--b', 'x'])
+    assert _parse_cmdline() == (['step1'], {'a': '1', 'flag': True, 'b': 'x'})
+    assert _parse_cmdline(['step2', '--c']) == (['step2'], {'c': True})
+
+def test_step_switch(monkeypatch):
+
+    calls = []
+    steps = [
+        Step('first', lambda a: calls.append(('first', a)), ['a']),
+        Step('second', lambda b=None: calls.append(('second', b)), ['b']),
+    ]
+    switch = StepSwitch('test', steps)
+
+    monkeypatch.setattr(sys, 'argv', ['script.py', 'second', '--b', '2'])
+    switch()
+    monkeypatch.setattr(sys, 'argv', ['script.py', 'first,second', '--a', '1', '--b', '3'])
+    switch()
+    assert calls == [('second', '2'), ('first', '1'), ('second', '3')]
+
+lazy_calls = []
+
+def record_call(a):
+    lazy_calls.append(a)
+
+lazy_step = Step('defined', record_call, ['a'])
+
+def test_lazy_step(monkeypatch):
+
+    switch = StepSwitch('test', [
+        LazyStep('function', 'kungfupipelines.cli_test:record_call', ['a'], description='A function'),
+        LazyStep('defined', 'kungfupipelines.cli_test:lazy_step'),
+        LazyStep('missing', 'kungfupipelines.no_such_module:function'),
+    ])
+    monkeypatch.setattr(sys, 'argv', ['script.py', 'function', '--a', '1'])
+    switch()
+    monkeypatch.setattr(sys, 'argv', ['script.py', 'function,defined', '--a', '2'])
+    switch()
+    assert lazy_calls == ['1', '2', '2']
+    assert switch.steps_dict['defined'] is lazy_step
+
+def test_import_is_lazy():
+
+    # Running a plain Step should not need kfp or caboodle.
+    code = "import kungfupipelines, sys; print(sorted({'kfp', 'caboodle', 'tqdm', 'wrapt'} & set(sys.modules)))"
+    output = subprocess.check_output([sys.executable, '-c', code])
+    assert output.decode().strip() == '[]'
+
+def make_served_switch(events):
+
+    def setup():
+        events.append('setup')
+        return {'model': {'offset': 10}}
+
+    def predict(x, model):
+        print("predicting") # Must not end up in the responses
+        if x == 'bad':
+            raise ValueError("bad input")
+        return int(x) + model['offset']
+
+    return StepSwitch('test', [
+        Step('predict', predict, ['x'], setup=setup, teardown=lambda state: events.append('teardown')),
+    ])
+
+def test_step_setup():
+
+    events = []
+    switch = make_served_switch(events)
+    assert switch.run(['predict', '--x', '1']) == 11
+    assert switch.run(['predict', '--x', '2', '--profile']) == 12 # Configures a copy, sharing the setup
+    assert events == ['setup']
+    assert switch.steps_dict['predict'].profilers is None
+    switch.teardown()
+    assert switch(['predict', '--x', '3']) == 13 # Called as a one-shot command, it sets up and tears down
+    assert events == ['setup', 'teardown', 'setup', 'teardown']
+
+def test_serve_stdin(monkeypatch, capsys):
+
+    events = []
+    requests = [
+        {'argv': ['predict', '--x', '1']},
+        {'argv': ['predict', '--x', 'bad']},
+        {'command': 'ping'},
+        {'argv': ['predict', '--x', '2']},
+    ]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO("".join(json.dumps(r) + "\n" for r in requests)))
+    make_served_switch(events)(['--serve'])
+
+    responses = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert [r['ok'] for r in responses] == [True, False, True, True]
+    assert responses[0]['result'] == 11 and responses[3]['result'] == 12
+    assert responses[1]['error'] == "ValueError: bad input"
+    assert events == ['setup', 'teardown']
+
+def test_serve_socket(tmp_path):
+
+    events = []
+    address = str(tmp_path / "switch.sock")
+    server = threading.Thread(target=make_served_switch(events), args=(['--serve', address, '--preload', 'predict'],))
+    server.start()
+    try:
+        for _ in range(100):
+            if os.path.exists(address):
+                break
+            server.join(0.05)
+        client = StepSwitch('test', []) # The client doesn't need the Steps
+        assert client(['predict', '--x', '1', '--connect', address]) == 11
+        assert client(['predict', '--connect', address, '--x', '2']) == 12
+        with pytest.raises(StepSwitchError) as error:
+            client(['predict', '--x', 'bad', '--connect', address])
+        assert "ValueError: bad input" in str(error.value)
+    finally:
+        send_request(address, {'command': 'shutdown'})
+        server.join()
+    assert events == ['setup', 'teardown']
+    assert not os.path.exists(address)
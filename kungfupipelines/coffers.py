@@ -0,0 +1,243 @@
+"""
+Object-level access to caboodle Coffers. A Coffer only knows how to upload a list of
+Artifacts and download everything it contains at once; these helpers let a Step list a
+Coffer's contents and move individual objects between it and local disk.
+GCSCoffer and LocalCoffer are supported.
+Artifacts stored in packed form (see kungfupipelines.packing) are listed and fetched under
+their own names, and decompressed when fetched.
+"""
+from caboodle.coffer import Coffer, GCSCoffer, LocalCoffer
+from caboodle.artifacts import BinaryArtifact
+from collections import namedtuple
+from typing import List
+import threading
+import base64
+import hashlib
+import json
+import shutil
+import os
+
+ObjectInfo = namedtuple('ObjectInfo', ['name', 'size', 'checksum'])
+ObjectInfo.__doc__ = """
+Describes an object stored in a Coffer.
+
+Args:
+    name: The key of the object within the Coffer
+    size: The size of the object in bytes
+    checksum: The base64 encoded md5 hash of the object (as reported by GCS), or its etag if
+        GCS does not provide an md5 hash
+"""
+
+# The index entries of packed Coffers, by location. These are refreshed whenever a Coffer is
+# listed, which Steps always do before fetching from it.
+_indices = {}
+_indices_lock = threading.Lock()
+
+def is_hidden(name:str) -> bool:
+    """
+    Objects whose names start with a '.' hold metadata written by kungfupipelines
+    (manifests, indices etc.) and are not treated as artifacts.
+    """
+    return name.startswith('.')
+
+def _md5(path:str) -> str:
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return base64.b64encode(digest.digest()).decode()
+
+def _bucket(coffer:GCSCoffer):
+    # Client.bucket() does not make a request, unlike Client.get_bucket()
+    return coffer.storage_client.bucket(coffer.bucket_name)
+
+def supports_objects(coffer:Coffer) -> bool:
+    """ Whether the helpers in this module can access the individual objects of a Coffer. """
+    return isinstance(coffer, (GCSCoffer, LocalCoffer))
+
+def _unsupported(coffer:Coffer):
+    return NotImplementedError(
+        "Object-level access is not supported for {0}. Use a GCSCoffer or LocalCoffer.".format(type(coffer).__name__)
+    )
+
+def list_objects(coffer:Coffer, include_hidden:bool = False, include_packed:bool = True) -> List[ObjectInfo]:
+    """
+    Lists the objects in a Coffer, sorted by name. Packed artifacts (see
+    kungfupipelines.packing) are listed in place of plain objects with the same name, unless
+    include_packed is False, in which case only the plain objects stored in the Coffer are.
+    """
+    if isinstance(coffer, GCSCoffer):
+        objects = []
+        for blob in _bucket(coffer).list_blobs(prefix=coffer.path):
+            name = blob.name.split('/')[-1] # Same naming convention as GCSCoffer.download
+            if name:
+                objects.append(ObjectInfo(name, blob.size, blob.md5_hash or blob.etag)) # Composite objects have no md5
+    elif isinstance(coffer, LocalCoffer):
+        objects = []
+        for name in os.listdir(coffer.folder):
+            path = os.path.join(coffer.folder, name)
+            if os.path.isfile(path):
+                objects.append(ObjectInfo(name, os.path.getsize(path), _md5(path)))
+    else:
+        raise _unsupported(coffer)
+    if not include_packed:
+        return sorted((o for o in objects if include_hidden or not is_hidden(o.name)), key=lambda o: o.name)
+
+    from kungfupipelines import packing
+    entries = packing.read_indices(coffer, objects)
+    with _indices_lock:
+        _indices[coffer.location] = entries
+    if entries: # Packed artifacts take the place of any plain objects with the same name
+        objects = [o for o in objects if o.name not in entries] + [
+            ObjectInfo(name, entry['size'], entry['checksum']) for name, entry in entries.items()
+        ]
+
+    return sorted(
+        (o for o in objects if include_hidden or not is_hidden(o.name)),
+        key=lambda o: o.name,
+    )
+
+def _index_entry(coffer:Coffer, name:str) -> dict:
+    """ Returns the index entry of a packed artifact, or None if name is a plain object. """
+    if is_hidden(name): # Metadata is never packed
+        return None
+    with _indices_lock:
+        entries = _indices.get(coffer.location)
+    if entries is None:
+        list_objects(coffer)
+        with _indices_lock:
+            entries = _indices[coffer.location]
+    return entries.get(name)
+
+def forget_index(coffer:Coffer):
+    """ Drops the cached index entries of a Coffer, eg. after its index was rewritten. """
+    with _indices_lock:
+        _indices.pop(coffer.location, None)
+
+def fetch(coffer:Coffer, name:str, local_dir:str) -> str:
+    """
+    Downloads a single object from a Coffer into local_dir and returns its local path.
+    """
+    local_path = os.path.join(local_dir, name)
+    entry = _index_entry(coffer, name)
+    if entry is not None:
+        from kungfupipelines.packing import decompress_file
+        partial = local_path + '.part'
+        _download(coffer, entry['blob'], partial)
+        decompress_file(partial, local_path, entry['encoding'])
+    else:
+        _download(coffer, name, local_path)
+    return local_path
+
+def _download(coffer:Coffer, name:str, local_path:str):
+
+    if isinstance(coffer, GCSCoffer):
+        _bucket(coffer).blob(os.path.join(coffer.path, name)).download_to_filename(local_path)
+    elif isinstance(coffer, LocalCoffer):
+        shutil.copyfile(os.path.join(coffer.folder, name), local_path)
+    else:
+        raise _unsupported(coffer)
+
+def fetch_bytes(coffer:Coffer, name:str) -> bytes:
+    """
+    Returns the contents of a single object in a Coffer without writing it to disk.
+    """
+    entry = _index_entry(coffer, name)
+    if entry is not None:
+        from kungfupipelines.packing import decompress_bytes
+        return decompress_bytes(_read(coffer, entry['blob']), entry['encoding'])
+    return _read(coffer, name)
+
+def _read(coffer:Coffer, name:str) -> bytes:
+
+    if isinstance(coffer, GCSCoffer):
+        return _bucket(coffer).blob(os.path.join(coffer.path, name)).download_as_string()
+    elif isinstance(coffer, LocalCoffer):
+        with open(os.path.join(coffer.folder, name), 'rb') as f:
+            return f.read()
+    else:
+        raise _unsupported(coffer)
+
+def read_metadata(coffer:Coffer, name:str):
+    """
+    Reads a JSON metadata object from a Coffer. Returns None if the object does not exist.
+    """
+    if isinstance(coffer, GCSCoffer):
+        from google.api_core.exceptions import NotFound
+        try:
+            data = fetch_bytes(coffer, name)
+        except NotFound:
+            return None
+    else:
+        try:
+            data = fetch_bytes(coffer, name)
+        except FileNotFoundError:
+            return None
+    return json.loads(data.decode())
+
+def write_metadata(coffer:Coffer, name:str, record):
+    """
+    Writes a JSON serializable record to a Coffer. The name should start with a '.' so that
+    the object is not mistaken for an artifact (see is_hidden).
+    """
+    coffer.upload([BinaryArtifact(name, content=json.dumps(record, sort_keys=True).encode())])
+
+def upload_file(coffer:Coffer, path:str, name:str = None):
+    """
+    Uploads a single local file to a Coffer. The file is uploaded as raw bytes, so it is
+    stored exactly as it is on disk.
+    """
+    name = name or os.path.basename(path)
+    if isinstance(coffer, GCSCoffer):
+        # GCSCoffer.upload looks up the bucket with a request of its own on every call
+        _bucket(coffer).blob(os.path.join(coffer.path, name)).upload_from_filename(path)
+    else:
+        coffer.upload([BinaryArtifact(name, path_or_buffer=path)])
+
+def delete_object(coffer:Coffer, name:str):
+    """
+    Deletes a single object from a Coffer.
+    """
+    if isinstance(coffer, GCSCoffer):
+        _bucket(coffer).blob(os.path.join(coffer.path, name)).delete()
+    elif isinstance(coffer, LocalCoffer):
+        os.remove(os.path.join(coffer.folder, name))
+    else:
+        raise _unsupported(coffer)
+
+class FolderCoffer(LocalCoffer):
+    """
+    A LocalCoffer which can be used in place of a GCSCoffer, eg. for running Steps locally
+    or in tests. Unlike caboodle's LocalCoffer, it creates its folder if it does not exist,
+    can be deleted, and can download its contents to a local path.
+    """
+    def __init__(self, path:str):
+        super().__init__(path)
+        os.makedirs(path, exist_ok=True)
+
+    def download(self, local_path:str = None):
+
+        if local_path is None:
+            return super().download()
+        for info in list_objects(self):
+            fetch(self, info.name, local_path)
+
+    def delete(self):
+
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            if os.path.isfile(path):
+                os.remove(path)
+
+def download(coffer:Coffer, local_dir:str):
+    """
+    Downloads every artifact in a Coffer into local_dir.
+    This is equivalent to coffer.download(local_dir), but also works for LocalCoffers and
+    packed Coffers.
+    """
+    if supports_objects(coffer):
+        for info in list_objects(coffer):
+            fetch(coffer, info.name, local_dir)
+    else:
+        coffer.download(local_dir)
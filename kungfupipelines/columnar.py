@@ -0,0 +1,132 @@
+"""
+Artifacts for arrays and tables which are read without being deserialized. PickleArtifacts have
+to be unpickled in full before any of their data can be used; the Artifacts here are views onto
+the bytes of the stored file instead, so reading one costs nothing until its data is touched, and
+only the pages a function touches are ever read from disk. Arrow files store each column in
+buffers of its own, so selecting columns skips the pages of the others. An .npy file stores
+the fields of each row together, so selecting some of its columns saves copying the others
+but not reading them: the pages of any column span the whole file.
+
+    NpyArtifact: a numpy array stored in .npy format. Arrays with named fields (structured
+        arrays) have columns.
+    ArrowArtifact: a pyarrow Table stored in the Arrow IPC file format (.arrow or .feather).
+
+numpy and pyarrow are optional dependencies, and only imported when the Artifacts are used.
+Importing this module registers the Artifacts with caboodle under their file suffixes, so that
+in-memory ArtifactSteps hand them to the function memory-mapped (see ArtifactStep), optionally
+with only the columns given by read_columns. In the other modes, the function can open an
+input file itself with eg. NpyArtifact(key, path_or_buffer=filename, columns=['a']).data.
+"""
+from caboodle.artifacts import Artifact, PathOrBuffer, get_buffer
+from caboodle import coffer
+from typing import List
+import io
+
+class ColumnarArtifact(Artifact):
+    """
+    An Artifact whose data is a view onto its serialized form, with an optional projection
+    onto some of its columns.
+
+    Args:
+        key: The name of the Artifact
+        content: (optional) The array or table
+        path_or_buffer: (optional) A path, or a buffer such as a workspace.MappedFile. Data
+            is read without copying from paths and from buffers with a getbuffer() method.
+        columns: (optional) The names of the columns to read
+    """
+    def __init__(self, key:str, content = None, deserialize = False, path_or_buffer = None, columns:List[str] = None):
+        self.columns = columns
+        super().__init__(key, content, deserialize, path_or_buffer)
+
+    @property
+    def data(self):
+        # Artifact.data tests the truth of the content, which is ambiguous for arrays.
+        if self._content is None and self.path_or_buffer is not None:
+            return self.load()
+        return self._content
+
+class NpyArtifact(ColumnarArtifact):
+    """
+    A numpy array stored in .npy format. Its data is a read-only array backed by the file (or
+    buffer) it was read from, and its columns are the fields of a structured array. Fields are
+    stored row by row, so a selection of columns is a view which still touches every row's
+    bytes when read. Store columns which are read separately in files of their own.
+    """
+    def serialize(self, path_or_buffer:PathOrBuffer):
+        import numpy
+        with get_buffer(path_or_buffer, direction = 'write') as f:
+            numpy.save(f, self.data, allow_pickle=False)
+
+    def deserialize(self, path_or_buffer:PathOrBuffer):
+        import numpy
+        if isinstance(path_or_buffer, str):
+            array = numpy.load(path_or_buffer, mmap_mode='r')
+        elif hasattr(path_or_buffer, 'getbuffer'):
+            array = _npy_view(path_or_buffer)
+        else:
+            with get_buffer(path_or_buffer, direction = 'read') as f:
+                array = numpy.load(f, allow_pickle=False)
+        if self.columns is None:
+            return array
+        if array.dtype.names is None:
+            raise ValueError("{0} holds an array without named columns, so its columns can't be selected.".format(self.key))
+        return array[list(self.columns)] # A view, unlike indexing a plain array
+
+def _npy_view(buffer:io.BufferedIOBase):
+    """ Returns a read-only array viewing the .npy data in a buffer, without copying it. """
+    import numpy
+    from numpy.lib import format
+    buffer.seek(0)
+    version = format.read_magic(buffer)
+    read_header = {(1, 0): format.read_array_header_1_0, (2, 0): format.read_array_header_2_0}.get(version)
+    if read_header is None: # Newer versions are only written for unusual field names
+        buffer.seek(0)
+        return numpy.load(buffer, allow_pickle=False)
+    shape, fortran_order, dtype = read_header(buffer)
+    count = 1
+    for n in shape:
+        count *= n
+    array = numpy.frombuffer(buffer.getbuffer(), dtype=dtype, count=count, offset=buffer.tell())
+    array = array.reshape(shape, order='F' if fortran_order else 'C')
+    array.flags.writeable = False
+    return array
+
+class ArrowArtifact(ColumnarArtifact):
+    """
+    A pyarrow Table stored in the Arrow IPC file format (which is also the Feather V2 format).
+    Its data is a Table whose buffers point into the file (or buffer) it was read from. The
+    file must not be compressed for this to be free of copies.
+    """
+    def serialize(self, path_or_buffer:PathOrBuffer):
+        import pyarrow
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_file(sink, self.data.schema) as writer:
+            writer.write_table(self.data)
+        with get_buffer(path_or_buffer, direction = 'write') as f:
+            f.write(sink.getvalue())
+
+    def deserialize(self, path_or_buffer:PathOrBuffer):
+        import pyarrow
+        if isinstance(path_or_buffer, str):
+            source = pyarrow.memory_map(path_or_buffer)
+        elif hasattr(path_or_buffer, 'getbuffer'):
+            source = pyarrow.py_buffer(path_or_buffer.getbuffer())
+        else:
+            with get_buffer(path_or_buffer, direction = 'read') as f:
+                source = pyarrow.py_buffer(f.read())
+        table = pyarrow.ipc.open_file(source).read_all()
+        if self.columns is None:
+            return table
+        return table.select(list(self.columns))
+
+SUFFIXES = {
+    'npy': NpyArtifact,
+    'arrow': ArrowArtifact,
+    'feather': ArrowArtifact,
+}
+for suffix, artifact_class in SUFFIXES.items():
+    coffer.suffixes.setdefault(suffix, artifact_class)
+
+def is_columnar(name:str) -> bool:
+    """ Whether an object is read as a ColumnarArtifact, judging by its name. """
+    return issubclass(coffer.infer_type(name), ColumnarArtifact)
@@ -0,0 +1,67 @@
+from kungfupipelines import step
+from kungfupipelines.coffers import FolderCoffer
+from kungfupipelines.workspace import MappedFile
+import pytest
+import os
+
+numpy = pytest.importorskip("numpy")
+from kungfupipelines.columnar import NpyArtifact, ArrowArtifact, is_columnar
+
+def make_table(n):
+    table = numpy.zeros(n, dtype=[('id', 'i8'), ('score', 'f8'), ('label', 'U8')])
+    table['id'] = numpy.arange(n)
+    table['score'] = numpy.arange(n) / 2
+    return table
+
+def test_npy_artifact(tmp_path):
+
+    coffer = FolderCoffer(str(tmp_path))
+    coffer.upload([NpyArtifact("table.npy", make_table(100)), NpyArtifact("matrix.npy", numpy.ones((3, 4), order='F'))])
+    assert is_columnar("table.npy") and not is_columnar("table.pickle")
+
+    mapped = MappedFile(str(tmp_path / "table.npy"))
+    scores = NpyArtifact("table.npy", path_or_buffer=mapped, columns=['id', 'score']).data
+    assert scores.dtype.names == ('id', 'score')
+    assert scores['score'][-1] == 49.5
+    assert not scores.flags.writeable and not scores.flags.owndata # A view onto the mapped file
+
+    matrix = NpyArtifact("matrix.npy", path_or_buffer=MappedFile(str(tmp_path / "matrix.npy"))).data
+    assert matrix.shape == (3, 4) and matrix.flags.f_contiguous and matrix.sum() == 12
+    assert NpyArtifact("matrix.npy", path_or_buffer=str(tmp_path / "matrix.npy")).data.sum() == 12
+    with pytest.raises(ValueError):
+        NpyArtifact("matrix.npy", path_or_buffer=str(tmp_path / "matrix.npy"), columns=['a']).data
+
+def total_score(artifact):
+    table = artifact.data
+    assert table.dtype.names == ('score',) and isinstance(artifact.path_or_buffer, MappedFile)
+    return NpyArtifact(artifact.key, numpy.array([table['score'].sum()]))
+
+@pytest.mark.parametrize("executor", ['serial', 'process'])
+def test_columnar_artifact_step(tmp_path, executor):
+
+    input_coffer = FolderCoffer(str(tmp_path / "inputs"))
+    output_coffer = FolderCoffer(str(tmp_path / "outputs"))
+    input_coffer.upload([NpyArtifact("{0}.npy".format(n), make_table(n)) for n in (10, 20)])
+    my_step = step.ArtifactStep(
+        name="total",
+        function=total_score,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        in_memory=True,
+        executor=executor,
+        workspace_root=str(tmp_path / "workspaces"),
+    )
+    my_step.configure(read_columns="score")
+    my_step()
+    totals = {name: numpy.load(str(tmp_path / "outputs" / name))[0] for name in os.listdir(str(tmp_path / "outputs"))}
+    assert totals == {"10.npy": 22.5, "20.npy": 95.0}
+
+def test_arrow_artifact(tmp_path):
+
+    pyarrow = pytest.importorskip("pyarrow")
+    table = pyarrow.table({'id': list(range(10)), 'score': [i / 2 for i in range(10)]})
+    FolderCoffer(str(tmp_path)).upload([ArrowArtifact("table.arrow", table)])
+    projected = ArrowArtifact("table.arrow", path_or_buffer=MappedFile(str(tmp_path / "table.arrow")), columns=['score']).data
+    assert projected.column_names == ['score'] and projected.num_rows == 10
+    assert ArrowArtifact("table.arrow", path_or_buffer=str(tmp_path / "table.arrow")).data.equals(table)
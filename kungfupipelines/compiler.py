@@ -0,0 +1,212 @@
+"""
+Compiling many Workflows at once. Generators of pipeline variants (eg. hyperparameter sweeps)
+often produce the same pipeline many times over, and compiling each one with kfp takes a
+noticeable fraction of a second. compile_many compiles variants in a process pool, compiles
+identical variants only once, and can keep compiled pipelines in a CompileCache so that
+regenerating a sweep only compiles the variants which changed.
+
+    cache = CompileCache("~/.cache/kungfupipelines/compiled")
+    compile_many({"sweep-{0}.tar.gz".format(i): w for i, w in enumerate(workflows)}, 'image', 'script.py', cache=cache)
+"""
+from kungfupipelines.cache import function_source
+from kungfupipelines.executor import run_items
+from typing import Dict, List
+import hashlib
+import inspect
+import logging
+import pickle
+import shutil
+import json
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Bump this when a change to kungfupipelines changes the compiled output of existing Workflows.
+COMPILER_VERSION = 1
+
+_EXCLUDED_ATTRIBUTES = ('function', 'check_if_complete', 'profile')
+
+def describe(value, _seen:set = None):
+    """
+    Returns a JSON serializable description of a Workflow, Step or other value which covers
+    everything that affects the compiled pipeline: the classes and attributes of the Workflow
+    and its Steps (names, arguments, shards etc.), and the locations of Coffers. Step functions
+    are left out, since they run inside the containers and do not appear in the pipeline.
+    """
+    _seen = _seen or set()
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = [describe(v, _seen) for v in value]
+        return sorted(items, key=repr) if isinstance(value, (set, frozenset)) else items
+    if isinstance(value, dict):
+        return sorted(([describe(k, _seen), describe(v, _seen)] for k, v in value.items()), key=repr)
+    if inspect.isroutine(value) or inspect.isclass(value):
+        return getattr(value, '__qualname__', repr(value))
+    location = getattr(value, 'location', None)
+    if isinstance(location, str): # A Coffer
+        return {'class': type(value).__name__, 'location': location}
+    if id(value) in _seen:
+        return {'ref': getattr(value, 'name', type(value).__name__)}
+    if not hasattr(value, '__dict__'):
+        text = repr(value)
+        return type(value).__qualname__ if ' at 0x' in text else text # Addresses change between runs
+    _seen = _seen | {id(value)}
+    return {
+        'class': "{0}.{1}".format(type(value).__module__, type(value).__qualname__),
+        'attributes': {
+            k: describe(v, _seen) for k, v in sorted(vars(value).items())
+            if k not in _EXCLUDED_ATTRIBUTES and not inspect.isroutine(v)
+        },
+    }
+
+def fingerprint(workflow, *compile_args) -> str:
+    """
+    Returns a hex digest identifying the pipeline that workflow.compile(*compile_args)
+    produces (see describe), including the source of the Workflow's compile method and the
+    installed version of kfp.
+    """
+    import kfp
+    digest = hashlib.sha256()
+    digest.update(json.dumps([
+        COMPILER_VERSION,
+        getattr(kfp, '__version__', None),
+        function_source(type(workflow).compile),
+        describe(workflow),
+        describe(list(compile_args)),
+    ], sort_keys=True, default=repr).encode())
+    return digest.hexdigest()
+
+class CompileCache():
+    """
+    Keeps compiled pipelines in a local folder, keyed by fingerprint and file extension.
+    When there are more than max_entries entries, the least recently used ones are evicted.
+
+    Args:
+        path: The folder to keep compiled pipelines in
+        max_entries: (optional) Maximum number of compiled pipelines to keep
+    """
+    def __init__(self, path:str, max_entries:int = None):
+        self.path = os.path.expanduser(path)
+        self.max_entries = max_entries
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, key:str, filename:str) -> str:
+        return os.path.join(self.path, key + _extension(filename))
+
+    def get(self, key:str, filename:str) -> bool:
+        """ Copies the cached pipeline for key to filename, and returns whether there was one. """
+        cached = self._filename(key, filename)
+        try:
+            shutil.copyfile(cached, filename)
+        except FileNotFoundError:
+            return False
+        os.utime(cached) # Track when entries were last used, for eviction
+        return True
+
+    def put(self, key:str, filename:str):
+
+        cached = self._filename(key, filename)
+        temp = cached + '.tmp-{0}'.format(os.getpid())
+        shutil.copyfile(filename, temp)
+        os.replace(temp, cached)
+        self.evict()
+
+    def evict(self):
+
+        if self.max_entries is None:
+            return
+        entries = [os.path.join(self.path, f) for f in os.listdir(self.path) if '.tmp-' not in f]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for entry in entries[:len(entries) - self.max_entries]:
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+
+def _extension(filename:str) -> str:
+    """ kfp decides the output format from the extension, so cached pipelines keep it. """
+    for extension in ('.tar.gz', '.tgz', '.zip', '.yaml', '.yml'):
+        if filename.endswith(extension):
+            return extension
+    return os.path.splitext(filename)[1]
+
+def _compile(job):
+    """ Compiles a (filename, workflow, compile_args) job. Runs in a worker process. """
+    filename, workflow, compile_args = job
+    workflow.generate_yaml(filename, *compile_args)
+    return filename
+
+def _picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+        return True
+    except Exception:
+        return False
+
+def compile_many(
+    workflows:Dict[str, 'Workflow'],
+    *compile_args,
+    cache:CompileCache = None,
+    workers:int = None,
+) -> Dict[str, bool]:
+    """
+    Compiles many Workflows, each into its own file.
+    Workflows with the same fingerprint are compiled once, and the result copied to each of
+    their files. With a cache, Workflows which were compiled before are not compiled again.
+    The remaining Workflows are compiled in a process pool, except for those that cannot be
+    pickled (eg. because a Step's function is a lambda), which are compiled in this process.
+
+    Args:
+        workflows: A dictionary mapping output filenames to Workflows
+        compile_args: The arguments for Workflow.compile (eg. image and script_path)
+        cache: (optional) A CompileCache to read compiled pipelines from and add them to
+        workers: (optional) The number of worker processes
+    Returns:
+        A dictionary mapping each filename to whether it was served from the cache
+    """
+    start = time.time()
+    groups = {} # fingerprint -> filenames
+    for filename, workflow in workflows.items():
+        groups.setdefault(fingerprint(workflow, *compile_args), []).append(filename)
+
+    cached = {}
+    jobs = {} # fingerprint -> job
+    for key, filenames in groups.items():
+        hit = cache is not None and cache.get(key, filenames[0])
+        for filename in filenames:
+            cached[filename] = hit
+        if not hit:
+            jobs[key] = (filenames[0], workflows[filenames[0]], compile_args)
+
+    parallel = {key: job for key, job in jobs.items() if _picklable(job)}
+    serial = {key: job for key, job in jobs.items() if key not in parallel}
+    if serial:
+        logger.info("Compiling {0} workflows which can't be pickled in this process.".format(len(serial)))
+    results, failures = run_items(
+        _compile,
+        list(parallel.values()),
+        executor='process' if len(parallel) > 1 else 'serial',
+        workers=workers,
+    )
+    for job in serial.values():
+        _compile(job)
+    if failures:
+        raise RuntimeError("Failed to compile {0}:\n{1}".format(
+            ", ".join(f.item[0] for f in failures),
+            "\n".join(f.traceback for f in failures),
+        ))
+
+    for key, filenames in groups.items():
+        if key in jobs and cache is not None:
+            cache.put(key, filenames[0])
+        for filename in filenames[1:]:
+            shutil.copyfile(filenames[0], filename)
+
+    logger.info("Compiled {0} workflows ({1} distinct, {2} from the cache) in {3:.1f}s.".format(
+        len(workflows), len(groups), len(groups) - len(jobs), time.time() - start,
+    ))
+    return cached
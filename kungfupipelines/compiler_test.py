@@ -0,0 +1,69 @@
+from kungfupipelines import compiler
+from kungfupipelines.workflow import SequentialWorkflow, DAGWorkflow
+from kungfupipelines.step import Step, ArtifactStep
+from kungfupipelines.coffers import FolderCoffer
+import tarfile
+import yaml
+
+def make_workflow(tmp_path, shards=1, name='second'):
+
+    inputs = FolderCoffer(str(tmp_path / "inputs"))
+    outputs = FolderCoffer(str(tmp_path / "outputs"))
+    return SequentialWorkflow('variant', [
+        Step('first', print, ['a']),
+        ArtifactStep(name, print, ['a'], inputs, outputs, shards=shards),
+    ])
+
+def task_names(filename):
+
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+    dag = next(t['dag'] for t in spec['spec']['templates'] if 'dag' in t)
+    return sorted(t['name'] for t in dag['tasks'])
+
+def test_fingerprint(tmp_path):
+
+    key = compiler.fingerprint(make_workflow(tmp_path), 'image', 'script.py')
+    assert key == compiler.fingerprint(make_workflow(tmp_path), 'image', 'script.py')
+    assert key != compiler.fingerprint(make_workflow(tmp_path), 'image:v2', 'script.py')
+    assert key != compiler.fingerprint(make_workflow(tmp_path, shards=2), 'image', 'script.py')
+    assert key != compiler.fingerprint(make_workflow(tmp_path, name='other'), 'image', 'script.py')
+
+    # Functions run inside the containers, so they don't change the compiled pipeline.
+    with_len = make_workflow(tmp_path)
+    with_len.steps[0].function = len
+    assert key == compiler.fingerprint(with_len, 'image', 'script.py')
+
+def test_compile_many(tmp_path):
+
+    (tmp_path / "out").mkdir()
+    workflows = {
+        str(tmp_path / "out" / "{0}.tar.gz".format(i)): make_workflow(tmp_path, shards=1 + i % 2)
+        for i in range(4)
+    }
+    workflows[str(tmp_path / "out" / "lambda.tar.gz")] = DAGWorkflow('dag', [Step('only', lambda: None, [])])
+    cache = compiler.CompileCache(str(tmp_path / "cache"))
+
+    cached = compiler.compile_many(workflows, 'image', 'script.py', cache=cache, workers=2)
+    assert not any(cached.values())
+    assert task_names(str(tmp_path / "out" / "0.tar.gz")) == ['first', 'second']
+    assert task_names(str(tmp_path / "out" / "2.tar.gz")) == ['first', 'second']
+    assert task_names(str(tmp_path / "out" / "3.tar.gz")) == ['first', 'second-shard-0', 'second-shard-1']
+    assert task_names(str(tmp_path / "out" / "lambda.tar.gz")) == ['only']
+    assert len(list((tmp_path / "cache").iterdir())) == 3 # One per distinct workflow
+
+    for p in (tmp_path / "out").iterdir():
+        p.unlink()
+    cached = compiler.compile_many(workflows, 'image', 'script.py', cache=cache)
+    assert all(cached.values())
+    assert task_names(str(tmp_path / "out" / "1.tar.gz")) == ['first', 'second-shard-0', 'second-shard-1']
+
+def test_generate_yaml_cache(tmp_path):
+
+    cache = compiler.CompileCache(str(tmp_path / "cache"), max_entries=1)
+    make_workflow(tmp_path).generate_yaml(str(tmp_path / "a.tar.gz"), 'image', 'script.py', cache=cache)
+    make_workflow(tmp_path).generate_yaml(str(tmp_path / "b.tar.gz"), 'image', 'script.py', cache=cache)
+    assert (tmp_path / "a.tar.gz").read_bytes() == (tmp_path / "b.tar.gz").read_bytes()
+
+    make_workflow(tmp_path, shards=2).generate_yaml(str(tmp_path / "c.tar.gz"), 'image', 'script.py', cache=cache)
+    assert len(list((tmp_path / "cache").iterdir())) == 1 # The older entry was evicted
@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple
+from typing import List, Callable, Tuple, Any, Iterable, Iterator
+import traceback
+import threading
+import logging
+import random
+import signal
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+EXECUTORS = ('serial', 'thread', 'process')
+
+ItemFailure = namedtuple('ItemFailure', ['item', 'error_type', 'message', 'traceback', 'attempts'])
+ItemFailure.__new__.__defaults__ = (1,) # namedtuple only takes defaults from Python 3.7
+ItemFailure.__doc__ = """
+Describes a work item for which the function raised an exception.
+
+Args:
+    item: The work item (eg. the input filename)
+    error_type: The name of the exception class that was raised
+    message: The string representation of the exception
+    traceback: The formatted traceback, captured in the worker that ran the item
+    attempts: The number of times the function was called on the item
+"""
+
+ItemPolicy = namedtuple('ItemPolicy', ['timeout', 'retries', 'backoff'])
+ItemPolicy.__new__.__defaults__ = (None, 0, 1.)
+ItemPolicy.__doc__ = """
+How each work item is run.
+
+Args:
+    timeout: (optional) The number of seconds after which a call on an item fails with an
+        ItemTimeout
+    retries: The number of times to call the function again on an item after it raises
+    backoff: The number of seconds to wait before the first retry. Each further retry waits
+        twice as long as the one before, randomized by up to 50%.
+"""
+
+class ItemTimeout(TimeoutError):
+    """ Raised when the function takes longer than the timeout on a work item. """
+
+def _with_timeout(timeout: float, function: Callable, item, args: tuple, kwargs: dict):
+    """
+    Calls function(item, *args, **kwargs), raising an ItemTimeout if it takes longer than
+    timeout seconds. In the main thread of a process (the serial executor, or a process pool
+    worker) the call is interrupted with SIGALRM. Threads can't be interrupted, so elsewhere
+    the call is run in a thread of its own which is abandoned if it times out.
+    """
+    if timeout is None:
+        return function(item, *args, **kwargs)
+    message = "Timed out after {0}s".format(timeout)
+    if threading.current_thread() is threading.main_thread() and hasattr(signal, 'setitimer'):
+        def handler(signum, frame):
+            raise ItemTimeout(message)
+        previous = signal.signal(signal.SIGALRM, handler)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return function(item, *args, **kwargs)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    outcome = {}
+    def target():
+        try:
+            outcome['result'] = function(item, *args, **kwargs)
+        except BaseException as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        logger.warning("Abandoning the call on %s, which is still running after %ss.", item, timeout)
+        raise ItemTimeout(message)
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+def _call(function: Callable, item, args: tuple, kwargs: dict, policy: ItemPolicy = None) -> Tuple[Any, bool, Any, float]:
+    """
+    Calls function on item, timing it and capturing any exception as an ItemFailure. Exceptions
+    are converted in the worker because they (and their tracebacks) are not always picklable.
+    The call is timed out and retried according to policy.
+    """
+    policy = policy or ItemPolicy()
+    start = time.perf_counter()
+    attempt = 1
+    while True:
+        try:
+            return item, True, _with_timeout(policy.timeout, function, item, args, kwargs), time.perf_counter() - start
+        except Exception as e:
+            if attempt > policy.retries:
+                failure = ItemFailure(item, type(e).__name__, str(e), traceback.format_exc(), attempt)
+                return item, False, failure, time.perf_counter() - start
+            delay = policy.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.)
+            logger.warning("Retrying %s in %.1fs after %s: %s", item, delay, type(e).__name__, e)
+            time.sleep(delay)
+            attempt += 1
+
+def imap_items(
+    function: Callable,
+    items: Iterable,
+    args: tuple = (),
+    kwargs: dict = None,
+    executor: str = 'serial',
+    workers: int = None,
+    policy: ItemPolicy = None,
+    on_done: Callable = None,
+) -> Iterator[Tuple[Any, bool, Any, float]]:
+    """
+    Lazily runs function(item, *args, **kwargs) for each item and yields tuples
+    (item, succeeded, result, seconds) in completion order, where result is an ItemFailure if
+    the function raised and seconds is the time the function took. Items are pulled from the
+    iterable only as workers become free, so it can be a generator which produces items as
+    they become available (eg. as they are downloaded).
+    If given, on_done is called with each item as soon as the function has finished on it,
+    from whichever thread notices. Results are only yielded between pulls from the iterable,
+    so a generator which waits for resources held by earlier items (eg. disk space) has to
+    have them released by on_done rather than by the consumer of the results.
+    See run_items for a description of the other arguments.
+    """
+    if executor not in EXECUTORS:
+        raise ValueError("Unknown executor '{0}'. Choose one of {1}.".format(executor, EXECUTORS))
+    kwargs = kwargs or {}
+
+    if executor == 'serial' or workers == 1:
+        for item in items:
+            result = _call(function, item, args, kwargs, policy)
+            if on_done is not None:
+                on_done(item)
+            yield result
+        return
+
+    pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+    max_pending = workers or os.cpu_count() or 1
+    with pool_class(max_workers=workers) as pool:
+        pending = set()
+        for item in items:
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            future = pool.submit(_call, function, item, args, kwargs, policy)
+            if on_done is not None:
+                future.add_done_callback(lambda _, item=item: on_done(item))
+            pending.add(future)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def batched(
+    items: Iterable,
+    max_items: int = None,
+    max_bytes: int = None,
+    size: Callable = None,
+) -> Iterator[List]:
+    """
+    Lazily groups items into lists of at most max_items items whose sizes, as given by
+    size(item), add up to at most max_bytes. An item larger than max_bytes forms a batch of
+    its own. Either limit may be None.
+    """
+    batch = []
+    nbytes = 0
+    for item in items:
+        item_bytes = size(item) if max_bytes is not None else 0
+        if batch and (
+            (max_items is not None and len(batch) >= max_items)
+            or (max_bytes is not None and nbytes + item_bytes > max_bytes)
+        ):
+            yield batch
+            batch = []
+            nbytes = 0
+        batch.append(item)
+        nbytes += item_bytes
+    if batch:
+        yield batch
+
+def run_items(
+    function: Callable,
+    items: Iterable,
+    args: tuple = (),
+    kwargs: dict = None,
+    executor: str = 'serial',
+    workers: int = None,
+    progress = None,
+    record_item: Callable = None,
+    policy: ItemPolicy = None,
+) -> Tuple[List, List[ItemFailure]]:
+    """
+    Runs function(item, *args, **kwargs) for each item and returns a tuple (results, failures).
+    A failing item does not prevent the remaining items from running.
+
+    Args:
+        function: The function to call on each item
+        items: The work items
+        args: Additional positional arguments passed to function after the item
+        kwargs: Keyword arguments passed to function
+        executor: One of 'serial', 'thread' or 'process'. With 'process', function, items
+            and arguments must be picklable.
+        workers: The maximum number of concurrent workers (defaults to the executor's default)
+        progress: (optional) A tqdm-like object whose update() is called once per finished item
+        record_item: (optional) A function which is called with each item and the number of
+            seconds it took (eg. StepProfile.record_item)
+        policy: (optional) An ItemPolicy setting a timeout and retries for each item
+    Returns:
+        results: The return values for items that succeeded, in completion order
+        failures: A list of ItemFailures for items that raised
+    """
+    results = []
+    failures = []
+    for item, ok, value, seconds in imap_items(function, items, args, kwargs, executor, workers, policy):
+        if record_item is not None:
+            record_item(item, seconds)
+        if ok:
+            results.append(value)
+        else:
+            logger.error("Failed on %s: %s: %s", value.item, value.error_type, value.message)
+            failures.append(value)
+        if progress is not None:
+            progress.update(1)
+
+    return results, failures
@@ -0,0 +1,73 @@
+from kungfupipelines import executor
+import pytest
+import time
+import os
+
+def square(x, offset=0):
+    if x == 3:
+        raise ValueError("three is not allowed")
+    return x*x + offset
+
+@pytest.mark.parametrize("mode", ['serial', 'thread', 'process'])
+def test_run_items(mode):
+
+    ticks = 0
+    class Progress():
+        def update(self, n):
+            nonlocal ticks
+            ticks += n
+
+    results, failures = executor.run_items(
+        square,
+        [1,2,3,4],
+        kwargs={'offset': 1},
+        executor=mode,
+        workers=2,
+        progress=Progress(),
+    )
+    assert sorted(results) == [2, 5, 17]
+    assert len(failures) == 1
+    assert failures[0].item == 3
+    assert failures[0].error_type == 'ValueError'
+    assert 'three is not allowed' in failures[0].traceback
+    assert ticks == 4
+
+def test_unknown_executor():
+
+    with pytest.raises(ValueError):
+        executor.run_items(square, [1], executor='gpu')
+
+def test_batched():
+
+    assert list(executor.batched(range(5), max_items=2)) == [[0,1], [2,3], [4]]
+    sizes = {'a': 3, 'b': 3, 'c': 10, 'd': 1, 'e': 1}
+    batches = executor.batched('abcde', max_bytes=6, size=sizes.get)
+    assert list(batches) == [['a','b'], ['c'], ['d','e']]
+    batches = executor.batched('abcde', max_items=1, max_bytes=6, size=sizes.get)
+    assert list(batches) == [['a'], ['b'], ['c'], ['d'], ['e']]
+    assert list(executor.batched([], max_items=2)) == []
+
+def flaky_or_slow(x, marker_dir):
+    if x == 'slow':
+        time.sleep(5)
+    marker = os.path.join(marker_dir, x)
+    if x == 'flaky' and not os.path.exists(marker): # Fails on the first attempt only
+        open(marker, 'w').close()
+        raise ConnectionError("connection reset")
+    return x
+
+@pytest.mark.parametrize("mode", ['serial', 'thread', 'process'])
+def test_item_policy(tmp_path, mode):
+
+    start = time.time()
+    results, failures = executor.run_items(
+        flaky_or_slow,
+        ['ok', 'flaky', 'slow'],
+        kwargs={'marker_dir': str(tmp_path)},
+        executor=mode,
+        workers=3,
+        policy=executor.ItemPolicy(timeout=0.5, retries=1, backoff=0),
+    )
+    assert sorted(results) == ['flaky', 'ok']
+    assert [(f.item, f.error_type, f.attempts) for f in failures] == [('slow', 'ItemTimeout', 2)]
+    assert time.time() - start < 4
@@ -0,0 +1,135 @@
+"""
+Algorithms on dependency graphs of pipeline steps. A graph is represented as a dictionary
+mapping each node to the list of nodes it depends on (its upstream nodes), which is the
+same format as Workflow.dependencies().
+"""
+from typing import Dict, List, Callable, Tuple, Hashable, Set
+
+Graph = Dict[Hashable, List[Hashable]]
+
+def _complete(graph:Graph) -> Graph:
+    """ Adds nodes which only appear as upstream nodes. """
+    complete = {node: list(upstream) for node, upstream in graph.items()}
+    for upstream in graph.values():
+        for node in upstream:
+            complete.setdefault(node, [])
+    return complete
+
+def find_cycle(graph:Graph) -> List:
+    """ Returns a list of nodes forming a cycle (first node repeated at the end), or None. """
+    graph = _complete(graph)
+    state = {} # 1 = on the current path, 2 = finished
+    for root in graph:
+        if root in state:
+            continue
+        path = [root]
+        stack = [iter(graph[root])]
+        state[root] = 1
+        while stack:
+            node = next(stack[-1], None)
+            if node is None:
+                state[path.pop()] = 2
+                stack.pop()
+            elif state.get(node) == 1:
+                return path[path.index(node):] + [node]
+            elif node not in state:
+                state[node] = 1
+                path.append(node)
+                stack.append(iter(graph[node]))
+    return None
+
+def topological_order(graph:Graph) -> List:
+    """
+    Returns the nodes of the graph ordered so that every node comes after its upstream nodes.
+    Raises a ValueError if the graph has a cycle.
+    """
+    cycle = find_cycle(graph)
+    if cycle:
+        raise ValueError("Dependency cycle: {0}".format(" -> ".join(str(n) for n in reversed(cycle))))
+    graph = _complete(graph)
+    order = []
+    visited = set()
+    for root in graph:
+        stack = [(root, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+            elif node not in visited:
+                visited.add(node)
+                stack.append((node, True))
+                stack.extend((u, False) for u in graph[node] if u not in visited)
+    return order
+
+def ancestors(graph:Graph) -> Dict[Hashable, Set]:
+    """ Returns a dictionary mapping each node to the set of all nodes it transitively depends on. """
+    graph = _complete(graph)
+    result = {}
+    for node in topological_order(graph):
+        result[node] = set(graph[node]).union(*(result[u] for u in graph[node]))
+    return result
+
+def transitive_reduction(graph:Graph) -> Graph:
+    """
+    Returns the graph with the minimal set of edges which preserves its ordering constraints,
+    ie. an edge u -> v is removed if v also depends on u through some other path.
+    """
+    graph = _complete(graph)
+    anc = ancestors(graph)
+    reduced = {}
+    for node, upstream in graph.items():
+        upstream = list(dict.fromkeys(upstream)) # Remove duplicates, keeping order
+        implied = set().union(*(anc[u] for u in upstream))
+        reduced[node] = [u for u in upstream if u not in implied]
+    return reduced
+
+def critical_path(graph:Graph, cost:Callable = None) -> Tuple[List, float]:
+    """
+    Returns the longest path through the graph, weighted by cost(node), along with its total
+    cost. This is a lower bound on the wall-clock time of the pipeline, no matter how many
+    nodes run in parallel. By default every node costs 1, so the result is the graph's depth.
+    """
+    cost = cost or (lambda node: 1)
+    graph = _complete(graph)
+    finish = {}
+    previous = {}
+    for node in topological_order(graph):
+        start, previous[node] = max(((finish[u], u) for u in graph[node]), default=(0, None), key=lambda x: x[0])
+        finish[node] = start + cost(node)
+    if not finish:
+        return [], 0
+    node = max(finish, key=finish.get)
+    total = finish[node]
+    path = []
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return path[::-1], total
+
+def max_width(graph:Graph) -> int:
+    """
+    Returns the maximum number of nodes which can run at the same time, ie. the size of the
+    largest set of nodes none of which depends on another (a maximum antichain). By Dilworth's
+    theorem, this is the number of nodes minus the size of a maximum matching between each node
+    and the nodes that transitively depend on it.
+    """
+    graph = _complete(graph)
+    anc = ancestors(graph)
+    descendants = {node: [] for node in graph}
+    for node, upstream in anc.items():
+        for u in upstream:
+            descendants[u].append(node)
+
+    match = {} # right node -> left node
+    def augment(node, seen):
+        for d in descendants[node]:
+            if d in seen:
+                continue
+            seen.add(d)
+            if d not in match or augment(match[d], seen):
+                match[d] = node
+                return True
+        return False
+
+    matched = sum(augment(node, set()) for node in graph)
+    return len(graph) - matched
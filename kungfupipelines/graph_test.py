@@ -0,0 +1,50 @@
+from kungfupipelines import graph
+import pytest
+
+diamond = {
+    'b': ['a'],
+    'c': ['a'],
+    'd': ['b', 'c', 'a'],
+    'e': ['d'],
+}
+
+def test_topological_order():
+
+    order = graph.topological_order(diamond)
+    for node, upstream in diamond.items():
+        for u in upstream:
+            assert order.index(u) < order.index(node)
+
+def test_cycle():
+
+    cyclic = dict(diamond, a=['e'])
+    assert graph.find_cycle(diamond) is None
+    assert graph.find_cycle(cyclic) is not None
+    with pytest.raises(ValueError):
+        graph.topological_order(cyclic)
+
+def test_transitive_reduction():
+
+    reduced = graph.transitive_reduction(diamond)
+    assert sorted(reduced['d']) == ['b', 'c']
+    assert reduced['a'] == []
+    assert reduced['e'] == ['d']
+
+def test_critical_path():
+
+    path, length = graph.critical_path(diamond)
+    assert length == 4
+    assert path[0] == 'a' and path[-1] == 'e'
+
+    costs = {'a': 1, 'b': 10, 'c': 1, 'd': 1, 'e': 1}
+    path, length = graph.critical_path(diamond, costs.get)
+    assert path == ['a', 'b', 'd', 'e']
+    assert length == 13
+
+def test_max_width():
+
+    assert graph.max_width(diamond) == 2
+    assert graph.max_width({'a': [], 'b': [], 'c': []}) == 3
+    assert graph.max_width({'b': ['a'], 'c': ['b']}) == 1
+    # The widest set of independent nodes ({b, c, x}) is not a "level" of the graph.
+    assert graph.max_width({'b': ['a'], 'c': ['a'], 'x': [], 'y': ['x', 'b']}) == 3
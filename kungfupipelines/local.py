@@ -0,0 +1,91 @@
+"""
+Runs Workflows locally, without compiling them or submitting them to a cluster. This is
+useful for quick iteration and for testing pipelines in CI, eg. with FolderCoffers in place
+of GCSCoffers.
+"""
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from kungfupipelines.step import Step
+from typing import Dict, List, Any
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+def step_arguments(step:Step, kwargs:dict) -> dict:
+    """
+    Picks out the arguments for a Step from a dictionary of pipeline arguments, in the same
+    way that StepSwitch picks them out of the command line.
+    """
+    return {arg.replace('-','_'): kwargs[arg] for arg in step.arguments if arg in kwargs}
+
+def _run_step(step:Step, arguments:dict):
+    return step(**arguments)
+
+def run_local(
+    dependencies:Dict[Step, List[Step]],
+    executor:str = 'thread',
+    workers:int = None,
+    **kwargs
+) -> Dict[str, Any]:
+    """
+    Runs a graph of Steps, starting each Step as soon as all of its upstream Steps have
+    completed, so independent branches run concurrently. If a Step raises, no further Steps
+    are started, and the exception is re-raised once running Steps have finished.
+
+    Args:
+        dependencies: A dictionary mapping each Step to the list of Steps it runs after
+            (see Workflow.dependencies)
+        executor: 'thread' or 'process'. With 'process', Steps, their arguments and their
+            return values must be picklable.
+        workers: Maximum number of Steps to run at once
+        kwargs: Pipeline arguments. Each Step receives the ones listed in its arguments.
+    Returns:
+        A dictionary mapping Step names to the values they returned
+    """
+    if executor not in ('thread', 'process'):
+        raise ValueError("Unknown executor '{0}'. Choose 'thread' or 'process'.".format(executor))
+    remaining = {step: set(upstream) for step, upstream in dependencies.items()}
+    for upstream in dependencies.values():
+        for step in upstream:
+            remaining.setdefault(step, set())
+    downstream = {step: [] for step in remaining}
+    for step, upstream in remaining.items():
+        for u in upstream:
+            downstream[u].append(step)
+
+    results = {}
+    pool_class = ThreadPoolExecutor if executor == 'thread' else ProcessPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        running = {}
+        error = None
+
+        def start_ready():
+            for step in [s for s, upstream in remaining.items() if not upstream]:
+                del remaining[step]
+                logger.info("Starting step %s", step.fullname)
+                running[pool.submit(_run_step, step, step_arguments(step, kwargs))] = (step, time.time())
+
+        start_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step, start = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                except Exception as e:
+                    logger.error("Step %s failed: %s", step.fullname, e)
+                    error = error or e
+                    continue
+                logger.info("Step %s completed in %.2fs", step.fullname, time.time() - start)
+                for d in downstream[step]:
+                    remaining[d].discard(step)
+            if error is None:
+                start_ready()
+
+    if error is not None:
+        raise error
+    if remaining:
+        raise ValueError("Could not run steps {0} because of a dependency cycle.".format(
+            [s.name for s in remaining]
+        ))
+    return results
@@ -0,0 +1,263 @@
+"""
+Compressed, deduplicated storage of artifacts in a Coffer. A Packer stores each file it is
+given as a hidden blob object named after the sha256 hash of its content, compressed with
+zstd (if the zstandard package is installed) or gzip, and keeps an index object mapping
+artifact names to blobs. Files with identical content are stored once. Files which are
+already compressed (images, archives etc.) are stored as they are.
+
+Reading is transparent: coffers.list_objects lists indexed artifacts under their own names,
+sizes and checksums, and coffers.fetch and coffers.fetch_bytes decompress them, so downstream
+Steps read packed Coffers like any other. Writing is enabled for an ArtifactStep with its
+compress_outputs option.
+
+Blobs which are no longer referenced by any index (eg. after an incremental Step deletes
+stale outputs) are only removed by collect_garbage, which should be run while no Step is
+writing to the Coffer.
+"""
+from kungfupipelines import coffers, transfer
+from typing import Dict, List
+import threading
+import tempfile
+import hashlib
+import logging
+import base64
+import shutil
+import gzip
+import os
+import io
+
+logger = logging.getLogger(__name__)
+
+INDEX = '.index.json' # Name of the index object of an unsharded Step
+BLOB_PREFIX = '.blob-'
+EXTENSIONS = {'gzip': '.gz', 'zstd': '.zst'}
+ENCODINGS = ('auto', 'gzip', 'zstd')
+
+# Formats which are compressed already, and would only cost time to compress again.
+INCOMPRESSIBLE = (
+    '.gz', '.tgz', '.zst', '.bz2', '.xz', '.lz4', '.zip', '.npz', '.7z', '.jar', '.whl',
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.webm',
+    '.parquet', '.orc', '.avro', '.tfrecord', '.h5', '.hdf5',
+)
+
+CHUNK_SIZE = 1 << 20
+
+def zstd_available() -> bool:
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+def choose_encoding(name:str, preference:str = 'auto') -> str:
+    """
+    Returns the encoding to store an artifact with: None for formats which are already
+    compressed, otherwise preference, where 'auto' picks zstd if it is installed and gzip
+    if it isn't.
+    """
+    if name.lower().endswith(INCOMPRESSIBLE):
+        return None
+    if preference == 'auto':
+        return 'zstd' if zstd_available() else 'gzip'
+    return preference
+
+def _compressor(encoding:str, f:io.BufferedIOBase):
+    """ Returns a writable file object which compresses into f. """
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6, mtime=0)
+    import zstandard
+    return zstandard.ZstdCompressor(level=3).stream_writer(f, closefd=False)
+
+def _decompressor(encoding:str, f:io.BufferedIOBase):
+    """ Returns a readable file object which decompresses from f. """
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=f, mode='rb')
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(f, closefd=False)
+
+def decompress_file(source:str, destination:str, encoding:str):
+    """ Decompresses a stored blob into destination. """
+    if encoding is None:
+        os.replace(source, destination)
+        return
+    with open(source, 'rb') as f, _decompressor(encoding, f) as reader, open(destination, 'wb') as out:
+        shutil.copyfileobj(reader, out, CHUNK_SIZE)
+    os.remove(source)
+
+def decompress_bytes(data:bytes, encoding:str) -> bytes:
+
+    if encoding is None:
+        return data
+    with _decompressor(encoding, io.BytesIO(data)) as reader:
+        return reader.read()
+
+def _digests(path:str):
+    """ Returns the sha256 hex digest and base64 encoded md5 digest of a file. """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            md5.update(chunk)
+    return sha256.hexdigest(), base64.b64encode(md5.digest()).decode()
+
+def blob_hash(name:str) -> str:
+    """ Returns the content hash in the name of a blob object. """
+    return name[len(BLOB_PREFIX):].split('.')[0]
+
+def is_index(name:str) -> bool:
+    return name.startswith('.index') and name.endswith('.json')
+
+def read_indices(coffer:'Coffer', objects:List['ObjectInfo']) -> Dict[str, dict]:
+    """
+    Reads every index object among objects (a listing of coffer which includes hidden
+    objects), and returns the merged entries by artifact name.
+    """
+    entries = {}
+    for info in objects:
+        if is_index(info.name):
+            index = coffers.read_metadata(coffer, info.name) or {'objects': {}}
+            entries.update(index['objects'])
+    return entries
+
+class Packer():
+    """
+    Uploads artifacts to a Coffer as compressed, deduplicated blobs, and records them in an
+    index object. Entries already in the index are kept unless they are replaced or removed.
+    The index is only written by save, so that a Step can write it once all of its outputs
+    have been uploaded. A Packer can be used from several threads at once.
+
+    Args:
+        coffer: The Coffer to upload to. It must support object-level access.
+        index_name: The name of the index object to maintain. Concurrent writers to the same
+            Coffer (eg. the shards of a Step) must each use their own.
+        encoding: One of 'auto', 'gzip' or 'zstd' (see choose_encoding)
+        retries: Number of times to retry an upload which fails with a transient error
+    """
+    def __init__(self, coffer:'Coffer', index_name:str = INDEX, encoding:str = 'auto', retries:int = 3):
+        if not coffers.supports_objects(coffer):
+            raise coffers._unsupported(coffer)
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown encoding '{0}'. Choose one of {1}.".format(encoding, ENCODINGS))
+        if encoding == 'zstd' and not zstd_available():
+            raise ImportError("zstd compression requires the zstandard package: pip install zstandard")
+        self.coffer = coffer
+        self.index_name = index_name
+        self.encoding = encoding
+        self.retries = retries
+        self._lock = threading.Lock()
+        index = coffers.read_metadata(coffer, index_name) or {'objects': {}}
+        self.entries = index['objects']
+        objects = transfer.retry(coffers.list_objects, coffer, include_hidden=True, retries=retries)
+        self._blobs = {blob_hash(o.name): o.name for o in objects if o.name.startswith(BLOB_PREFIX)}
+        self.bytes_in = 0
+        self.bytes_stored = 0
+
+    def add_file(self, path:str, name:str = None) -> dict:
+        """ Stores a local file under name (its basename by default) and returns its index entry. """
+        name = name or os.path.basename(path)
+        sha256, md5 = _digests(path)
+        size = os.path.getsize(path)
+        with self._lock:
+            blob = self._blobs.get(sha256)
+            if blob is None: # Claim it, so that concurrent copies of the same content aren't uploaded twice
+                encoding = choose_encoding(name, self.encoding)
+                blob = self._blobs[sha256] = BLOB_PREFIX + sha256 + EXTENSIONS.get(encoding, '')
+                upload = True
+            else:
+                upload = False
+        if upload:
+            try:
+                stored = self._upload_blob(path, blob, encoding)
+            except BaseException:
+                with self._lock:
+                    del self._blobs[sha256]
+                raise
+        else:
+            stored = 0
+            logger.debug("%s has the same content as %s, which is stored already.", name, blob)
+
+        entry = {
+            'blob': blob,
+            'encoding': _blob_encoding(blob),
+            'size': size,
+            'checksum': md5,
+        }
+        with self._lock:
+            self.entries[name] = entry
+            self.bytes_in += size
+            self.bytes_stored += stored
+        return entry
+
+    def _upload_blob(self, path:str, blob:str, encoding:str) -> int:
+        """ Compresses a file into a temporary file and uploads it. Returns the bytes stored. """
+        if encoding is None:
+            transfer.retry(coffers.upload_file, self.coffer, path, blob, retries=self.retries)
+            return os.path.getsize(path)
+        fd, compressed = tempfile.mkstemp(prefix=BLOB_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                with open(path, 'rb') as f, _compressor(encoding, out) as writer:
+                    shutil.copyfileobj(f, writer, CHUNK_SIZE)
+            transfer.retry(coffers.upload_file, self.coffer, compressed, blob, retries=self.retries)
+            return os.path.getsize(compressed)
+        finally:
+            os.remove(compressed)
+
+    def add_artifact(self, artifact:'Artifact') -> dict:
+        """ Stores a caboodle Artifact, serialized as the Artifact's Coffer would store it. """
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                artifact.serialize(f)
+            return self.add_file(path, artifact.key)
+        finally:
+            os.remove(path)
+
+    def upload_files(self, paths:List[str], concurrency:int = 8):
+        """ Stores local files under their basenames, with up to concurrency uploads at once. """
+        transfer.pool_connections(self.coffer, concurrency)
+        transfer._run_all(self.add_file, paths, concurrency)
+
+    def upload_folder(self, folder:str, concurrency:int = 8):
+        """ Stores every file in a folder (see transfer.upload_folder). """
+        paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+        paths = [p for p in paths if os.path.isfile(p)]
+        logger.info("Packing {0} files into {1} with {2} threads.".format(len(paths), self.coffer.location, concurrency))
+        self.upload_files(paths, concurrency)
+
+    def remove(self, name:str) -> bool:
+        """ Removes an artifact from the index, and returns whether it was there. """
+        with self._lock:
+            return self.entries.pop(name, None) is not None
+
+    def save(self):
+        """ Writes the index to the Coffer. """
+        with self._lock:
+            record = {'objects': dict(self.entries)}
+            if self.bytes_in:
+                logger.info("Packed {0} bytes of outputs into {1} bytes ({2:.0%}).".format(
+                    self.bytes_in, self.bytes_stored, self.bytes_stored / self.bytes_in,
+                ))
+        transfer.retry(coffers.write_metadata, self.coffer, self.index_name, record, retries=self.retries)
+        coffers.forget_index(self.coffer)
+
+def _blob_encoding(blob:str) -> str:
+    for encoding, extension in EXTENSIONS.items():
+        if blob.endswith(extension):
+            return encoding
+    return None
+
+def collect_garbage(coffer:'Coffer') -> List[str]:
+    """
+    Deletes the blobs in a Coffer which no index refers to, and returns their names.
+    Blobs uploaded by a Step which is still running are not in its index yet, so this must
+    not be run while Steps are writing to the Coffer.
+    """
+    objects = coffers.list_objects(coffer, include_hidden=True)
+    referenced = {entry['blob'] for entry in read_indices(coffer, objects).values()}
+    unreferenced = [o.name for o in objects if o.name.startswith(BLOB_PREFIX) and o.name not in referenced]
+    for name in unreferenced:
+        coffers.delete_object(coffer, name)
+    logger.info("Deleted {0} unreferenced blobs from {1}.".format(len(unreferenced), coffer.location))
+    return unreferenced
@@ -0,0 +1,66 @@
+from kungfupipelines import packing, coffers
+from kungfupipelines.coffers import FolderCoffer
+import pytest
+
+def make_outputs(tmp_path):
+
+    folder = tmp_path / "local"
+    folder.mkdir()
+    (folder / "a.txt").write_bytes(b"spam " * 1000)
+    (folder / "b.txt").write_bytes(b"spam " * 1000) # Same content as a.txt
+    (folder / "c.txt").write_bytes(b"eggs " * 1000)
+    (folder / "d.png").write_bytes(b"\x89PNG" + bytes(range(256)))
+    return folder
+
+@pytest.mark.parametrize("encoding", ['auto', 'gzip'])
+def test_packer(tmp_path, encoding):
+
+    folder = make_outputs(tmp_path)
+    plain = FolderCoffer(str(tmp_path / "plain"))
+    packed = FolderCoffer(str(tmp_path / "packed"))
+    for path in sorted(folder.iterdir()):
+        coffers.upload_file(plain, str(path))
+
+    packer = packing.Packer(packed, encoding=encoding)
+    packer.upload_folder(str(folder), concurrency=2)
+    packer.save()
+
+    assert coffers.list_objects(packed) == coffers.list_objects(plain) # Packed Coffers list like plain ones
+    stored = sorted(p.name for p in (tmp_path / "packed").iterdir())
+    assert stored[-1] == '.index.json'
+    blobs = stored[:-1]
+    assert len(blobs) == 3 # a.txt and b.txt share a blob
+    assert sum(b.endswith('.gz') or b.endswith('.zst') for b in blobs) == 2 # The png is stored as is
+    assert packer.bytes_stored < packer.bytes_in
+
+    (tmp_path / "fetched").mkdir()
+    for info in coffers.list_objects(packed):
+        path = coffers.fetch(packed, info.name, str(tmp_path / "fetched"))
+        assert open(path, 'rb').read() == (folder / info.name).read_bytes()
+        assert coffers.fetch_bytes(packed, info.name) == (folder / info.name).read_bytes()
+    assert sorted(p.name for p in (tmp_path / "fetched").iterdir()) == ["a.txt", "b.txt", "c.txt", "d.png"]
+
+def test_packer_keeps_index(tmp_path):
+
+    folder = make_outputs(tmp_path)
+    packed = FolderCoffer(str(tmp_path / "packed"))
+    packer = packing.Packer(packed, encoding='gzip')
+    packer.upload_files([str(folder / "a.txt"), str(folder / "c.txt")])
+    packer.save()
+
+    # A later writer adds to the index, and reuses blobs which are stored already.
+    packer = packing.Packer(packed, encoding='gzip')
+    packer.add_file(str(folder / "b.txt"))
+    assert packer.bytes_stored == 0
+    assert packer.remove("c.txt")
+    packer.save()
+    assert [o.name for o in coffers.list_objects(packed)] == ["a.txt", "b.txt"]
+
+    assert len(packing.collect_garbage(packed)) == 1 # The blob of c.txt
+    assert coffers.fetch_bytes(packed, "b.txt") == (folder / "b.txt").read_bytes()
+
+def test_choose_encoding():
+
+    assert packing.choose_encoding("model.pickle", 'gzip') == 'gzip'
+    assert packing.choose_encoding("archive.tar.gz", 'gzip') is None
+    assert packing.choose_encoding("data.csv") == ('zstd' if packing.zstd_available() else 'gzip')
@@ -0,0 +1,285 @@
+"""
+Instrumentation for Steps. When profiling is enabled for a Step (with the profile option, or
+--profile on the command line), each run of the Step collects a StepProfile with its wall
+time, CPU time, peak memory, bytes transferred, and time spent per phase and per item, and
+emits it as a JSON record. Optionally, the run can also be profiled with cProfile and/or
+tracemalloc.
+
+Peak memory is measured for the run alone, also in processes which run many Steps (eg. a
+StepSwitch server, a sweep or a FusedStep). Where /proc can't be sampled, it may only be known
+as the peak over the lifetime of the process, and the record's peak_rss_lifetime is set.
+
+Callbacks registered with add_hook are called with every record, which makes it possible to
+forward the records to other monitoring systems.
+"""
+from contextlib import contextmanager
+from typing import Callable, List, Tuple
+import threading
+import logging
+import resource
+import pstats
+import time
+import json
+import io
+import os
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ('cprofile', 'tracemalloc')
+
+_hooks = []
+
+def add_hook(hook:Callable):
+    """ Registers a function to be called with the record (a dict) of every profiled Step run. """
+    _hooks.append(hook)
+
+def remove_hook(hook:Callable):
+    _hooks.remove(hook)
+
+def _peak_rss() -> Tuple[int, int]:
+    """
+    Returns the peak resident set sizes of this process and of its largest finished child in
+    bytes. These are peaks over the lifetime of the process, not of a single Step run.
+    """
+    return tuple(
+        resource.getrusage(who).ru_maxrss * 1024 # ru_maxrss is in kilobytes on Linux
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    )
+
+def _children() -> List[int]:
+    """ Returns the pids of the running children of this process. """
+    pid = os.getpid()
+    try:
+        children = []
+        for task in os.listdir('/proc/{0}/task'.format(pid)):
+            with open('/proc/{0}/task/{1}/children'.format(pid, task)) as f:
+                children.extend(int(p) for p in f.read().split())
+        return children
+    except OSError: # Kernels without CONFIG_PROC_CHILDREN
+        pass
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(name)) as f:
+                # The parent pid is the second field after the parenthesised command name.
+                if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                    children.append(int(name))
+        except (OSError, IndexError, ValueError):
+            pass
+    return children
+
+def _current_rss() -> int:
+    """
+    Returns the resident set size of this process and its running children in bytes, or None
+    where /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    for child in _children():
+        try:
+            with open('/proc/{0}/statm'.format(child)) as f:
+                pages += int(f.read().split()[1])
+        except (OSError, IndexError, ValueError): # The child has exited
+            pass
+    return pages * resource.getpagesize()
+
+class _RSSSampler():
+    """
+    Samples the resident set size of this process and its children in a background thread,
+    to measure the peak of a single Step run. Short spikes between samples are missed.
+    """
+    def __init__(self, interval:float = 0.1):
+        self.interval = interval
+        self.peak = _current_rss()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.peak is None:
+            return
+        self._thread = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _current_rss() or 0)
+
+    def stop(self) -> int:
+        """ Stops sampling and returns the peak, or None if it couldn't be sampled. """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.peak = max(self.peak, _current_rss() or 0)
+        return self.peak
+
+def _cpu_time() -> float:
+    """ Returns the CPU time used by this process and its finished children, in seconds. """
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+class NullProfile():
+    """ A profile which records nothing. Steps use this when profiling is disabled. """
+    enabled = False
+
+    @contextmanager
+    def phase(self, name:str):
+        yield
+
+    def record_item(self, item:str, seconds:float):
+        pass
+
+    def add_bytes(self, downloaded:int = 0, uploaded:int = 0):
+        pass
+
+NULL_PROFILE = NullProfile()
+
+class StepProfile(NullProfile):
+    """
+    Collects metrics for one run of a Step.
+
+    Args:
+        step_name: The name of the Step being profiled
+        profilers: Which additional profilers to run: any of 'cprofile' and 'tracemalloc'
+        top: The number of entries to keep from cProfile and tracemalloc statistics
+    """
+    enabled = True
+
+    def __init__(self, step_name:str, profilers:List[str] = None, top:int = 25):
+        self.step_name = step_name
+        self.profilers = list(profilers or [])
+        for profiler in self.profilers:
+            if profiler not in PROFILERS:
+                raise ValueError("Unknown profiler '{0}'. Choose from {1}.".format(profiler, PROFILERS))
+        self.top = top
+        self.phases = {}
+        self.items = {}
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.record = None
+        self._lock = threading.Lock()
+        self._cprofile = None
+
+    def start(self):
+
+        self._start_time = time.time()
+        self._start_wall = time.perf_counter()
+        self._start_cpu = _cpu_time()
+        self._start_peaks = _peak_rss()
+        self._sampler = _RSSSampler()
+        self._sampler.start()
+        if 'tracemalloc' in self.profilers:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cprofile' in self.profilers:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def stop(self, error:Exception = None) -> dict:
+        """ Stops profiling and returns the record. """
+        wall = time.perf_counter() - self._start_wall
+        cpu = _cpu_time() - self._start_cpu
+        peak, lifetime = self._peak_rss()
+        self.record = {
+            'step': self.step_name,
+            'started': self._start_time,
+            'succeeded': error is None,
+            'error': repr(error) if error is not None else None,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_rss_bytes': peak,
+            'peak_rss_lifetime': lifetime,
+            'bytes_downloaded': self.bytes_downloaded,
+            'bytes_uploaded': self.bytes_uploaded,
+            'phases': self.phases,
+            'items': self.items,
+        }
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self.record['cprofile'] = self._cprofile_stats()
+        if 'tracemalloc' in self.profilers:
+            import tracemalloc
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.record['tracemalloc'] = {
+                'peak_bytes': peak,
+                'top': [str(stat) for stat in snapshot.statistics('lineno')[:self.top]],
+            }
+        return self.record
+
+    def _peak_rss(self) -> Tuple[int, bool]:
+        """
+        Returns the peak resident set size of the run, and whether it is only known as the
+        peak over the lifetime of the process. The lifetime peaks given by getrusage belong to
+        the run if they rose during it; otherwise the run's peak is the sampled one.
+        """
+        sampled = self._sampler.stop()
+        peaks = [end for start, end in zip(self._start_peaks, _peak_rss()) if end > start]
+        if sampled is not None:
+            peaks.append(sampled)
+        if peaks:
+            return max(peaks), False
+        # Nothing was measured for this run alone, eg. a run in a long-lived process without /proc.
+        return max(_peak_rss()), True
+
+    def _cprofile_stats(self) -> List[dict]:
+
+        stats = pstats.Stats(self._cprofile, stream=io.StringIO())
+        entries = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in stats.stats.items():
+            entries.append({
+                'function': "{0}:{1}({2})".format(filename, line, function),
+                'calls': calls,
+                'tottime': tottime,
+                'cumtime': cumtime,
+            })
+        entries.sort(key=lambda e: e['cumtime'], reverse=True)
+        return entries[:self.top]
+
+    @contextmanager
+    def phase(self, name:str):
+        """ Adds the time spent in the with block to the named phase. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0.) + time.perf_counter() - start
+
+    def record_item(self, item:str, seconds:float):
+        """ Records the time it took to process a single item (eg. an input file). """
+        with self._lock:
+            self.items[os.path.basename(str(item))] = seconds
+
+    def add_bytes(self, downloaded:int = 0, uploaded:int = 0):
+        with self._lock:
+            self.bytes_downloaded += downloaded
+            self.bytes_uploaded += uploaded
+
+def emit(record:dict, output:str = None):
+    """
+    Logs a profile record, calls the registered hooks, and writes it to output if given.
+    If output is a directory, the record is written to a file named after the Step and the
+    time it started.
+    """
+    logger.info("Profile for step %s: %s", record['step'], json.dumps(
+        {k: v for k, v in record.items() if k not in ('items', 'cprofile', 'tracemalloc')}
+    ))
+    for hook in _hooks:
+        hook(record)
+    if output:
+        if os.path.isdir(output) or output.endswith('/'):
+            os.makedirs(output, exist_ok=True)
+            output = os.path.join(output, record_name(record))
+        with open(output, 'w') as f:
+            json.dump(record, f, indent=2)
+
+def record_name(record:dict) -> str:
+    """ Returns a filename for a profile record. """
+    return "{0}-{1}.json".format(record['step'], int(record['started'] * 1000))
@@ -0,0 +1,81 @@
+from kungfupipelines import profiling, step
+from kungfupipelines.coffers import FolderCoffer
+import json
+import time
+import os
+
+def test_profile_step(tmp_path):
+
+    records = []
+    profiling.add_hook(records.append)
+    try:
+        my_step = step.Step(
+            'sum', lambda n: sum(range(int(n))), ['n'],
+            profile='cprofile,tracemalloc', profile_output=str(tmp_path) + '/',
+        )
+        assert my_step(n=100000) == sum(range(100000))
+    finally:
+        profiling.remove_hook(records.append)
+
+    assert len(records) == 1
+    record = records[0]
+    assert record['step'] == 'sum'
+    assert record['succeeded']
+    assert record['wall_seconds'] > 0
+    assert record['peak_rss_bytes'] > 0
+    assert record['cprofile'] and record['tracemalloc']['peak_bytes'] >= 0
+    written, = os.listdir(str(tmp_path))
+    with open(os.path.join(str(tmp_path), written)) as f:
+        assert json.load(f)['step'] == 'sum'
+    assert my_step.profile is profiling.NULL_PROFILE
+
+def allocate(megabytes):
+    data = bytearray(int(megabytes) << 20)
+    data[::4096] = b"x" * len(data[::4096]) # Touch every page
+    time.sleep(0.3)
+    return len(data)
+
+def test_peak_rss_per_run():
+
+    records = []
+    profiling.add_hook(records.append)
+    try:
+        my_step = step.Step('allocate', allocate, ['megabytes'], profile=True)
+        my_step(megabytes=200)
+        my_step(megabytes=1) # In the same process, after the peak of the first run
+    finally:
+        profiling.remove_hook(records.append)
+
+    first, second = records
+    assert not first['peak_rss_lifetime'] and not second['peak_rss_lifetime']
+    assert first['peak_rss_bytes'] >= 200 << 20
+    assert second['peak_rss_bytes'] < first['peak_rss_bytes'] - (150 << 20)
+
+def copy_file(filename, output_dir):
+    with open(filename, 'rb') as f, open(os.path.join(output_dir, os.path.basename(filename)), 'wb') as g:
+        g.write(f.read())
+
+def test_profile_artifact_step(tmp_path):
+
+    inputs = FolderCoffer(str(tmp_path / "inputs"))
+    outputs = FolderCoffer(str(tmp_path / "outputs"))
+    for name in ['a', 'b', 'c']:
+        (tmp_path / "inputs" / name).write_bytes(b"12345")
+    for streaming in [False, True]:
+        my_step = step.ArtifactStep(
+            'copy', copy_file, [], inputs, outputs,
+            local_input=str(tmp_path / "local_input_{0}".format(streaming)),
+            local_output=str(tmp_path / "local_output_{0}".format(streaming)),
+            streaming=streaming,
+        )
+        my_step.configure(profile=True, profile_output='coffer')
+        my_step()
+
+        names = [p.name for p in (tmp_path / "outputs").iterdir() if p.name.startswith('.profile-')]
+        record = json.loads((tmp_path / "outputs" / sorted(names)[-1]).read_text())
+        assert record['bytes_downloaded'] == 15
+        assert record['bytes_uploaded'] == 15
+        assert sorted(record['items']) == ['a', 'b', 'c']
+        assert 'upload' in record['phases']
+        for p in (tmp_path / "outputs").iterdir():
+            p.unlink()
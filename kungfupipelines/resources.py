@@ -0,0 +1,268 @@
+"""
+Sizing the containers of Steps from measurements of previous runs. Profile records (see
+kungfupipelines.profiling) are collected in a ProfileStore, and a ResourceSizer turns the
+records of each Step into CPU and memory requests and limits for its ContainerOps:
+
+    store = ProfileStore("~/.cache/kungfupipelines/profiles")
+    store.import_records(output_coffer) # Records written with --profile-output coffer
+    workflow.generate_yaml("pipeline.tar.gz", image, script_path, sizer=ResourceSizer(store))
+
+Resources given to a Step explicitly (Step(..., resources=Resources(...))) take precedence
+over the measured ones.
+"""
+from kungfupipelines.streaming import parse_size
+from typing import List, Dict, Iterable
+import threading
+import logging
+import math
+import json
+import os
+
+logger = logging.getLogger(__name__)
+
+GPU_TOLERATION = {
+    'key': 'nvidia.com/gpu',
+    'operator': 'Equal',
+    'value': 'present',
+    'effect': 'NoSchedule',
+}
+
+def _parse_cpu(cpu) -> float:
+    """ Converts a CPU quantity such as 2, 0.5 or '250m' to a number of cores. """
+    if cpu is None or isinstance(cpu, (int, float)):
+        return cpu
+    cpu = str(cpu).strip()
+    if cpu.endswith('m'):
+        return int(cpu[:-1]) / 1000
+    return float(cpu)
+
+def _format_cpu(cores:float) -> str:
+    return "{0}m".format(int(math.ceil(cores * 1000)))
+
+def _format_memory(nbytes:int) -> str:
+    return "{0}Mi".format(int(math.ceil(nbytes / (1 << 20))))
+
+class Resources():
+    """
+    The resources to request for a container. Fields which are None are left unset.
+
+    Args:
+        cpu_request: Number of cores, eg. 2, 0.5 or '500m'
+        cpu_limit: Number of cores
+        memory_request: Number of bytes, eg. 1073741824 or '1G'
+        memory_limit: Number of bytes
+        gpus: Number of GPUs. Containers with GPUs also tolerate the GPU node taint.
+    """
+    FIELDS = ('cpu_request', 'cpu_limit', 'memory_request', 'memory_limit', 'gpus')
+
+    def __init__(self, cpu_request = None, cpu_limit = None, memory_request = None, memory_limit = None, gpus:int = None):
+        self.cpu_request = _parse_cpu(cpu_request)
+        self.cpu_limit = _parse_cpu(cpu_limit)
+        self.memory_request = parse_size(memory_request)
+        self.memory_limit = parse_size(memory_limit)
+        self.gpus = gpus
+
+    def __repr__(self):
+        return "Resources({0})".format(", ".join(
+            "{0}={1!r}".format(field, getattr(self, field)) for field in self.FIELDS if getattr(self, field) is not None
+        ))
+
+    def __eq__(self, other):
+        return isinstance(other, Resources) and vars(self) == vars(other)
+
+    def merge(self, overrides:'Resources') -> 'Resources':
+        """ Returns these resources with the fields that are set in overrides replaced. """
+        if overrides is None:
+            return self
+        return Resources(**{
+            field: getattr(overrides, field) if getattr(overrides, field) is not None else getattr(self, field)
+            for field in self.FIELDS
+        })
+
+    @classmethod
+    def maximum(cls, resources:Iterable['Resources']) -> 'Resources':
+        """ Returns the largest value of each field, eg. for Steps which run one after another. """
+        resources = [r for r in resources if r is not None]
+        if not resources:
+            return None
+        return cls(**{
+            field: max((getattr(r, field) for r in resources if getattr(r, field) is not None), default=None)
+            for field in cls.FIELDS
+        })
+
+    def apply(self, op):
+        """ Sets these resources on a dsl.ContainerOp. """
+        container = op.container
+        if self.cpu_request is not None:
+            container.set_cpu_request(_format_cpu(self.cpu_request))
+        if self.cpu_limit is not None:
+            container.set_cpu_limit(_format_cpu(self.cpu_limit))
+        if self.memory_request is not None:
+            container.set_memory_request(_format_memory(self.memory_request))
+        if self.memory_limit is not None:
+            container.set_memory_limit(_format_memory(self.memory_limit))
+        if self.gpus:
+            op.set_gpu_limit(self.gpus).add_toleration(GPU_TOLERATION)
+        return op
+
+class ProfileStore():
+    """
+    Keeps the profile records of Step runs in a local folder, as one JSON lines file per Step.
+    Only the fields needed for sizing are kept, along with at most max_records records per Step.
+    The add method can be registered as a profiling hook to record local runs:
+
+        profiling.add_hook(store.add)
+
+    Args:
+        path: The folder to keep records in
+        max_records: The number of most recent records to keep for each Step
+    """
+    KEPT_FIELDS = ('step', 'started', 'succeeded', 'wall_seconds', 'cpu_seconds', 'peak_rss_bytes', 'peak_rss_lifetime')
+
+    def __init__(self, path:str, max_records:int = 50):
+        self.path = os.path.expanduser(path)
+        self.max_records = max_records
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, step_name:str) -> str:
+        return os.path.join(self.path, step_name.replace(os.sep, '_') + '.jsonl')
+
+    def add(self, record:dict):
+        """ Stores a profile record. """
+        record = {k: record.get(k) for k in self.KEPT_FIELDS}
+        with self._lock:
+            filename = self._filename(record['step'])
+            with open(filename, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+            records = self._read(filename)
+            if len(records) > 2 * self.max_records: # Compact now and then rather than on every add
+                temp = filename + '.tmp'
+                with open(temp, 'w') as f:
+                    f.writelines(json.dumps(r, sort_keys=True) + '\n' for r in records[-self.max_records:])
+                os.replace(temp, filename)
+
+    def _read(self, filename:str) -> List[dict]:
+        try:
+            with open(filename) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def records(self, step_name:str) -> List[dict]:
+        """ Returns the most recent records of a Step, oldest first. """
+        return self._read(self._filename(step_name))[-self.max_records:]
+
+    def import_records(self, source) -> int:
+        """
+        Adds the profile records found in source, which is either a local folder of record
+        files (as written with profile_output set to a folder), or a Coffer holding records
+        written with profile_output='coffer'. Records which were imported before are skipped.
+        Returns the number of records added.
+        """
+        if isinstance(source, str):
+            records = []
+            for name in sorted(os.listdir(source)):
+                if name.endswith('.json'):
+                    with open(os.path.join(source, name)) as f:
+                        records.append(json.load(f))
+        else:
+            from kungfupipelines import coffers
+            records = [
+                coffers.read_metadata(source, o.name) for o in coffers.list_objects(source, include_hidden=True)
+                if o.name.startswith('.profile-')
+            ]
+        added = 0
+        for record in records:
+            if record is None or 'step' not in record:
+                continue
+            seen = {(r['step'], r['started']) for r in self.records(record['step'])}
+            if (record['step'], record.get('started')) not in seen:
+                self.add(record)
+                added += 1
+        return added
+
+def _percentile(values:List[float], percentile:float) -> float:
+    """ Returns the nearest-rank percentile of a list of values. """
+    values = sorted(values)
+    rank = int(math.ceil(percentile / 100 * len(values)))
+    return values[min(max(rank, 1), len(values)) - 1]
+
+class ResourceSizer():
+    """
+    Recommends Resources for Steps from their records in a ProfileStore. The CPU request is
+    the average number of cores used (CPU seconds over wall seconds) and the memory request is
+    the peak resident memory, each taken at the given percentile of recorded runs and scaled
+    up by headroom. Limits are set as multiples of the requests. CPU limits are not set by
+    default, since they throttle containers even when the node has idle cores. Records whose
+    peak memory is only known over the lifetime of the process that ran them (see
+    kungfupipelines.profiling) are not used for memory, since it may belong to earlier runs;
+    without any other records, no memory request is made.
+
+    Args:
+        store: The ProfileStore to read records from
+        headroom: The fraction to add to measured usage, eg. 0.25 for 25%
+        percentile: Which percentile of recorded runs to size for
+        memory_limit_factor: (optional) The memory limit as a multiple of the memory request
+        cpu_limit_factor: (optional) The CPU limit as a multiple of the CPU request
+        min_cpu: The smallest CPU request to make, in cores
+        min_memory: The smallest memory request to make
+        min_records: The number of records a Step needs before it is sized
+    """
+    def __init__(
+        self,
+        store:ProfileStore,
+        headroom:float = 0.25,
+        percentile:float = 95,
+        memory_limit_factor:float = 1.5,
+        cpu_limit_factor:float = None,
+        min_cpu = 0.1,
+        min_memory = '64M',
+        min_records:int = 1,
+    ):
+        self.store = store
+        self.headroom = headroom
+        self.percentile = percentile
+        self.memory_limit_factor = memory_limit_factor
+        self.cpu_limit_factor = cpu_limit_factor
+        self.min_cpu = _parse_cpu(min_cpu)
+        self.min_memory = parse_size(min_memory)
+        self.min_records = min_records
+
+    def recommend(self, step_name:str) -> Resources:
+        """ Returns the recommended Resources for a Step, or None if it has too few records. """
+        records = [r for r in self.store.records(step_name) if r.get('wall_seconds')]
+        if len(records) < max(self.min_records, 1):
+            return None
+        cores = _percentile([r['cpu_seconds'] / r['wall_seconds'] for r in records], self.percentile)
+        cpu_request = max(cores * (1 + self.headroom), self.min_cpu)
+        peaks = [r['peak_rss_bytes'] for r in records if r.get('peak_rss_bytes') and not r.get('peak_rss_lifetime')]
+        memory_request = memory_limit = None
+        if peaks:
+            memory = _percentile(peaks, self.percentile)
+            memory_request = max(int(memory * (1 + self.headroom)), self.min_memory)
+            memory_limit = int(memory_request * self.memory_limit_factor) if self.memory_limit_factor else None
+        return Resources(
+            cpu_request = cpu_request,
+            cpu_limit = cpu_request * self.cpu_limit_factor if self.cpu_limit_factor else None,
+            memory_request = memory_request,
+            memory_limit = memory_limit,
+        )
+
+    def apply(self, workflow) -> Dict[str, Resources]:
+        """
+        Sets the sized_resources of each Step in a Workflow (or a list of Steps) to its
+        recommended Resources, and returns them by Step name.
+        """
+        if isinstance(workflow, (list, tuple)):
+            steps = list(workflow)
+        else:
+            steps = list(getattr(workflow, 'steps', None) or workflow.dependencies())
+        recommended = {}
+        while steps:
+            step = steps.pop()
+            steps.extend(getattr(step, 'steps', [])) # The Steps inside a FusedStep
+            step.sized_resources = self.recommend(step.name)
+            recommended[step.name] = step.sized_resources
+            logger.info("Sized step {0}: {1}".format(step.name, step.sized_resources))
+        return recommended
@@ -0,0 +1,111 @@
+from kungfupipelines.resources import Resources, ProfileStore, ResourceSizer
+from kungfupipelines.workflow import SequentialWorkflow
+from kungfupipelines.step import Step, GPUStep, FusedStep
+from kungfupipelines import profiling
+import tarfile
+import json
+import yaml
+
+MiB = 1 << 20
+
+def record(step, started, cpu_seconds, peak_rss_bytes, wall_seconds=10.):
+    return {
+        'step': step, 'started': started, 'succeeded': True, 'wall_seconds': wall_seconds,
+        'cpu_seconds': cpu_seconds, 'peak_rss_bytes': peak_rss_bytes, 'phases': {},
+    }
+
+def container_resources(filename):
+
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+    return {
+        t['name']: t['container'].get('resources') for t in spec['spec']['templates'] if 'container' in t
+    }
+
+def test_resources():
+
+    resources = Resources(cpu_request='500m', memory_request='1G', gpus=1)
+    assert resources.cpu_request == 0.5
+    assert resources.memory_request == 1 << 30
+    merged = resources.merge(Resources(cpu_request=2, gpus=0))
+    assert merged == Resources(cpu_request=2, memory_request='1G', gpus=0)
+    assert Resources.maximum([Resources(cpu_request=1), None, Resources(cpu_request=0.5, memory_limit='2G')]) == \
+        Resources(cpu_request=1, memory_limit='2G')
+    assert Resources.maximum([None]) is None
+
+def test_profile_store(tmp_path):
+
+    store = ProfileStore(str(tmp_path / "store"), max_records=3)
+    for i in range(10):
+        store.add(record('a', i, 1, 100))
+    assert [r['started'] for r in store.records('a')] == [7, 8, 9]
+    assert 'phases' not in store.records('a')[0]
+    assert store.records('missing') == []
+
+    (tmp_path / "emitted").mkdir()
+    profiling.emit(record('b', 1, 2, 200), str(tmp_path / "emitted"))
+    profiling.emit(record('b', 2, 3, 300), str(tmp_path / "emitted"))
+    assert store.import_records(str(tmp_path / "emitted")) == 2
+    assert store.import_records(str(tmp_path / "emitted")) == 0 # Already imported
+    assert [r['cpu_seconds'] for r in store.records('b')] == [2, 3]
+
+def test_resource_sizer(tmp_path):
+
+    store = ProfileStore(str(tmp_path / "store"))
+    for i, (cpu, rss) in enumerate([(5, 100 * MiB), (10, 200 * MiB), (20, 400 * MiB)]):
+        store.add(record('work', i, cpu, rss))
+    store.add(record('idle', 0, 0.01, MiB))
+
+    sizer = ResourceSizer(store, headroom=0.5, percentile=50, memory_limit_factor=2, cpu_limit_factor=2)
+    assert sizer.recommend('work') == Resources(
+        cpu_request=1.5, cpu_limit=3., memory_request=300 * MiB, memory_limit=600 * MiB,
+    )
+    idle = sizer.recommend('idle') # Clamped to the minimums
+    assert idle.cpu_request == 0.1 and idle.memory_request == 64 * MiB
+    assert sizer.recommend('unknown') is None
+
+    # Peaks over the lifetime of a process may belong to earlier runs, so they aren't sized for.
+    store.add(dict(record('work', 3, 10, 4000 * MiB), peak_rss_lifetime=True))
+    assert sizer.recommend('work').memory_request == 300 * MiB
+    store.add(dict(record('warm', 0, 10, 4000 * MiB), peak_rss_lifetime=True))
+    assert sizer.recommend('warm') == Resources(cpu_request=1.5, cpu_limit=3.)
+
+def test_generate_yaml_with_sizer(tmp_path):
+
+    store = ProfileStore(str(tmp_path / "store"))
+    store.add(record('first', 0, 10, 100 * MiB))
+    store.add(record('second', 0, 20, 400 * MiB))
+    store.add(record('third', 0, 5, 200 * MiB))
+    sizer = ResourceSizer(store, headroom=0)
+
+    workflow = SequentialWorkflow('sized', [
+        Step('first', print, [], resources=Resources(memory_limit='1G')),
+        GPUStep('gpu', print, [], resources=Resources(gpus=2)),
+        FusedStep([Step('second', print, []), Step('third', print, [])]),
+    ])
+    workflow.generate_yaml(str(tmp_path / "sized.tar.gz"), 'image', 'script.py', sizer=sizer)
+    resources = container_resources(str(tmp_path / "sized.tar.gz"))
+
+    # Explicit resources take precedence over sized ones.
+    assert resources['first'] == {
+        'requests': {'cpu': '1000m', 'memory': '100Mi'},
+        'limits': {'memory': '1024Mi'},
+    }
+    assert resources['gpu'] == {'limits': {'nvidia.com/gpu': 2}}
+    # A FusedStep requests the most that any of its Steps needs.
+    assert resources['second-third'] == {
+        'requests': {'cpu': '2000m', 'memory': '400Mi'},
+        'limits': {'memory': '600Mi'},
+    }
+
+def test_gpu_step_tolerations():
+
+    for step, gpus in [
+        (GPUStep('gpu', print, [], resources=Resources(gpus=2)), 2),
+        (GPUStep('gpu', print, []), 1),
+    ]:
+        op = step.dslContainerOp('image', 'script.py')
+        assert op.container.resources.limits['nvidia.com/gpu'] == gpus
+        assert len(op.tolerations) == 1
+    op = GPUStep('gpu', print, [], resources=Resources(gpus=2)).dslContainerOp('image', 'script.py', num_gpus=4)
+    assert op.container.resources.limits['nvidia.com/gpu'] == 4 and len(op.tolerations) == 1
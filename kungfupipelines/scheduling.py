@@ -0,0 +1,53 @@
+"""
+Ordering and splitting the inputs of an ArtifactStep by how much work they are. The executors
+hand inputs to workers one at a time as workers become free, so a run ends soon after its last
+input starts. If that input is one of the largest, every other worker sits idle while it is
+processed. Starting the largest inputs first (longest processing time first) leaves the small
+ones to fill the gaps at the end, and splitting inputs between shards by cost rather than by
+count keeps one shard from getting most of the work.
+
+The cost of an input is its size by default, or the result of a function of its ObjectInfo
+(eg. one which looks up how long the input took in an earlier run).
+"""
+from typing import List, Callable, TYPE_CHECKING
+import heapq
+
+if TYPE_CHECKING:
+    from kungfupipelines.coffers import ObjectInfo
+
+SCHEDULES = ('largest-first', 'listed')
+SHARD_BY = ('cost', 'name')
+
+def size_cost(info:'ObjectInfo') -> float:
+    """ The default cost of an input: its size in bytes. """
+    return info.size or 0
+
+def largest_first(objects:List['ObjectInfo'], cost:Callable = None) -> List['ObjectInfo']:
+    """ Sorts objects by decreasing cost, and objects of equal cost by name. """
+    cost = cost or size_cost
+    return sorted(objects, key=lambda o: (-cost(o), o.name))
+
+def schedule(objects:List['ObjectInfo'], order:str = 'largest-first', cost:Callable = None) -> List['ObjectInfo']:
+    """
+    Returns objects in the order they should be processed: largest first, or as listed.
+    """
+    if order not in SCHEDULES:
+        raise ValueError("Unknown schedule '{0}'. Choose one of {1}.".format(order, SCHEDULES))
+    if order == 'listed':
+        return list(objects)
+    return largest_first(objects, cost)
+
+def balance(objects:List['ObjectInfo'], count:int, cost:Callable = None) -> List[List['ObjectInfo']]:
+    """
+    Splits objects into count groups of about equal total cost, by giving each object in turn,
+    largest first, to the group with the least cost so far. The result only depends on the
+    names and costs of the objects, so separate processes which list the same objects (eg.
+    the shards of a Step) agree on it.
+    """
+    groups = [[] for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for o in largest_first(objects, cost):
+        load, i = heapq.heappop(heap)
+        groups[i].append(o)
+        heapq.heappush(heap, (load + (cost or size_cost)(o), i))
+    return groups
@@ -0,0 +1,29 @@
+from kungfupipelines.scheduling import largest_first, schedule, balance
+from kungfupipelines.coffers import ObjectInfo
+from kungfupipelines.step import shard_of
+import pytest
+
+def make_objects(sizes):
+    return [ObjectInfo("{0}.bin".format(i), size, None) for i, size in enumerate(sizes)]
+
+def test_schedule():
+
+    objects = make_objects([1, 5, 3, 5])
+    assert [o.name for o in largest_first(objects)] == ['1.bin', '3.bin', '2.bin', '0.bin']
+    assert schedule(objects, 'listed') == objects
+    assert [o.name for o in schedule(objects, cost=lambda o: -o.size)] == ['0.bin', '2.bin', '1.bin', '3.bin']
+    with pytest.raises(ValueError):
+        schedule(objects, 'random')
+
+def test_balance():
+
+    objects = make_objects([100, 90, 60, 50, 40, 30, 20, 10, 5, 5, 3, 2] * 5)
+    groups = balance(objects, 4)
+    assert sorted(o.name for g in groups for o in g) == sorted(o.name for o in objects)
+    loads = [sum(o.size for o in g) for g in groups]
+    assert max(loads) - min(loads) <= 5
+
+    # Splitting by name is far less even.
+    hashed = [sum(o.size for o in objects if shard_of(o.name, 4) == i) for i in range(4)]
+    assert max(hashed) - min(hashed) > max(loads) - min(loads)
+    assert balance(list(reversed(objects)), 4) == groups # Each shard lists the objects itself
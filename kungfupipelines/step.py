@@ -1,15 +1,57 @@
-from caboodle.coffer import Coffer, LocalCoffer
-from caboodle.artifacts import Artifact
-from typing import List, Dict, Callable
-from kfp import dsl
+from typing import List, Dict, Callable, Tuple, TYPE_CHECKING
 import pprint
 import logging
 import os
+import io
 import shutil
-from tqdm import tqdm
+import tempfile
+import hashlib
+import signal
+import threading
+import time
+import copy
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from kungfupipelines.executor import run_items, imap_items, batched, EXECUTORS, ItemFailure, ItemPolicy
+from kungfupipelines.streaming import DiskBudget, prefetch, parse_size
+from kungfupipelines.profiling import StepProfile, NULL_PROFILE
+from kungfupipelines import profiling
+
+# kfp and caboodle (along with the Google Cloud clients it loads) take a long time to import,
+# so they are only imported where they are used: kfp when compiling, and caboodle when an
+# ArtifactStep runs. Containers which run a plain Step never import them.
+if TYPE_CHECKING:
+    from caboodle.coffer import Coffer
+    from caboodle.artifacts import Artifact
+    from kungfupipelines.coffers import ObjectInfo
+    from kungfupipelines.resources import Resources
+    from kfp import dsl
 
 logger = logging.getLogger(__name__)
 
+MANIFEST = '.manifest.json' # Name of the object in which incremental ArtifactSteps track their inputs
+QUARANTINE = '.quarantine.json' # Name of the object listing the inputs an ArtifactStep failed on
+
+class ArtifactStepError(RuntimeError):
+    """
+    Raised when an ArtifactStep's function fails on one or more input files.
+    The failures attribute contains an ItemFailure for each file that failed.
+    """
+    def __init__(self, step_name:str, failures:List[ItemFailure]):
+        self.step_name = step_name
+        self.failures = failures
+        super().__init__("Step {0} failed on {1} files: {2}".format(
+            step_name,
+            len(failures),
+            ", ".join(os.path.basename(str(f.item)) for f in failures),
+        ))
+
+def _as_bool(value) -> bool:
+    """ Interprets command line values such as 'true', 'False' or '0' as booleans. """
+    if isinstance(value, str):
+        return value.lower() not in ('false', 'no', '0', '')
+    return bool(value)
+
 def _always_run(*args, **kwargs) -> bool:
     """ This returns False to indicate that the step is not already completed. """
     return False
@@ -29,8 +71,26 @@ class Step():
         name: The name of the Step
         function: The function to be called when this Step is invoked
         arguments: A list containing the names of the arguments expected for this function
+        check_if_complete: (optional) A function which is called with the Step's arguments and
+            returns True if the Step has already been completed, in which case it is skipped.
+            If this object has a bind(step) method, the result of calling it with this Step is
+            used instead, and if it has a mark_complete method, that is called with the Step's
+            arguments after the Step runs successfully. See kungfupipelines.cache.StepCache.
         fullname: (optional) The fullname of the step
         description: (optional) The description for the step
+        profile: (optional) Whether to profile runs of this Step (see kungfupipelines.profiling).
+            This can also be a list of additional profilers to run ('cprofile', 'tracemalloc').
+        profile_output: (optional) Where to write profile records: a file or directory path,
+            or for ArtifactSteps, 'coffer' to write them into the output coffer as hidden
+            objects. Records are always logged.
+        resources: (optional) The Resources to request for the Step's containers. Fields set
+            here take precedence over resources sized from profiles (see kungfupipelines.resources).
+        setup: (optional) A function which is called before the Step first runs, and returns a
+            dictionary of keyword arguments (eg. a loaded model or an open client) which are
+            passed to function on every run. They are kept until the Step is torn down, so a
+            StepSwitch serving many invocations only sets the Step up once (see StepSwitch.serve).
+        teardown: (optional) A function which is called with that dictionary when the Step is
+            torn down, eg. to close clients.
     """
     
     def __init__(
@@ -41,27 +101,145 @@ class Step():
         check_if_complete:Callable = None,
         fullname:str = None,
         description:str = None,
+        profile = False,
+        profile_output:str = None,
+        resources:'Resources' = None,
+        setup:Callable = None,
+        teardown:Callable = None,
     ):
 
         self.name = name
         self.function = function
-        self.check_if_complete = check_if_complete or _always_run
+        check_if_complete = check_if_complete or _always_run
+        if hasattr(check_if_complete, 'bind'):
+            check_if_complete = check_if_complete.bind(self)
+        self.check_if_complete = check_if_complete
         self.fullname = fullname or self.name
         self.description = description or ""
         self.arguments = arguments
+        self.profile = NULL_PROFILE # The profile of the current run
+        self.profilers = None
+        self.profile_output = None
+        self.resources = resources
+        self.sized_resources = None # Set by ResourceSizer
+        self.setup_function = setup
+        self.teardown_function = teardown
+        self.state = None # The keyword arguments returned by setup, while the Step is set up
+        self.options = ['profile', 'profile-output']
+        Step.configure(self, profile=profile, profile_output=profile_output)
+
+    def __copy__(self):
+        # Copies are configured and run on their own (eg. by StepSwitch), so a cache has to
+        # fingerprint the copy, with its options, rather than the original.
+        step = self.__class__.__new__(self.__class__)
+        step.__dict__.update(self.__dict__)
+        if hasattr(step.check_if_complete, 'bind'):
+            step.check_if_complete = step.check_if_complete.bind(step)
+        return step
+
+    def configure(self, profile = None, profile_output:str = None, **options):
+        """
+        Sets runtime options for this Step. Options differ from arguments in that they control
+        how the Step runs rather than being passed to its function. The names of the options a
+        Step accepts are listed in its options attribute, which StepSwitch uses to pick them
+        out of the command line.
+        On the command line, --profile enables profiling, and --profile cprofile,tracemalloc
+        also enables the given profilers.
+        """
+        if options:
+            raise TypeError("Step {0} does not accept the options {1}".format(self.name, list(options)))
+        if profile is not None:
+            if isinstance(profile, str) and profile.lower() not in ('true', 'false', '0', '1', ''):
+                self.profilers = profile.split(',')
+            elif isinstance(profile, (list, tuple)):
+                self.profilers = list(profile)
+            else:
+                self.profilers = [] if _as_bool(profile) else None
+        if profile_output is not None:
+            self.profile_output = profile_output
 
     def __call__(self, *args, **kwargs):
 
-        if self.check_if_complete(*args, **kwargs):
+        if self.is_complete(*args, **kwargs):
             self._on_skip(*args, **kwargs)
-        else:
-            return self.function(*args, **kwargs)
+            return
+        if self.profilers is None:
+            result = self._run_with_state(*args, **kwargs)
+            self._on_complete(*args, **kwargs)
+            return result
+
+        self.profile = StepProfile(self.name, self.profilers)
+        self.profile.start()
+        error = None
+        try:
+            result = self._run_with_state(*args, **kwargs)
+            self._on_complete(*args, **kwargs)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            record = self.profile.stop(error)
+            self.profile = NULL_PROFILE
+            self._emit_profile(record)
+
+    def _emit_profile(self, record:dict):
+        """ Logs and stores the profile record of a run. """
+        profiling.emit(record, self.profile_output)
+
+    def _run_with_state(self, *args, **kwargs):
+        """ Sets the Step up if needed, and runs it with the keyword arguments returned by setup. """
+        state = self.setup()
+        if state:
+            kwargs = dict(state, **kwargs)
+        return self.run(*args, **kwargs)
+
+    def setup(self) -> dict:
+        """
+        Calls the setup function, unless the Step is set up already, and returns the keyword
+        arguments it returned.
+        """
+        if self.state is None:
+            if self.setup_function is None:
+                return {}
+            logger.info("Setting up step {0}.".format(self.fullname))
+            self.state = dict(self.setup_function() or {})
+        return self.state
+
+    def teardown(self):
+        """ Calls the teardown function if the Step is set up, so that the next run sets it up again. """
+        if self.state is None:
+            return
+        state, self.state = self.state, None
+        if self.teardown_function is not None:
+            logger.info("Tearing down step {0}.".format(self.fullname))
+            self.teardown_function(state)
+
+    def is_complete(self, *args, **kwargs) -> bool:
+        """ Whether the Step can be skipped. By default, this asks check_if_complete. """
+        return self.check_if_complete(*args, **kwargs)
+
+    def run(self, *args, **kwargs):
+        """ Runs the Step unconditionally. """
+        return self.function(*args, **kwargs)
 
     def _on_skip(self, *args, **kwargs):
         """ This is ran if the step is skipped. """
         logger.info("Skipping step {0} because it has already been completed.".format(self.fullname))
 
-    def dslContainerOp(self, image, command=None, **kwargs) -> dsl.ContainerOp:
+    def _on_complete(self, *args, **kwargs):
+        """ This is ran after the step runs successfully. """
+        mark_complete = getattr(self.check_if_complete, 'mark_complete', None)
+        if mark_complete is not None:
+            mark_complete(*args, **kwargs)
+
+    def effective_resources(self) -> 'Resources':
+        """ The Resources to request for this Step's containers: the sized ones with the explicit ones on top. """
+        if self.sized_resources is None:
+            return self.resources
+        return self.sized_resources.merge(self.resources)
+
+    def dslContainerOp(self, image, command=None, **kwargs) -> 'dsl.ContainerOp':
         """
         Returns a dsl.ContainerOp that runs the Step function.
         The command is going to be something like:
@@ -71,6 +249,18 @@ class Step():
         the name of the Step you want to run. Following that, we insert the
         arguments to the Step.
         """
+        return self._container_op(image, command, self.fullname, [], kwargs)
+
+    def dslContainerOps(self, image, command=None, **kwargs) -> List['dsl.ContainerOp']:
+        """
+        Returns the list of dsl.ContainerOps which together run this Step. For most Steps
+        this is just [self.dslContainerOp(...)], but a sharded ArtifactStep runs as several
+        parallel ContainerOps. Workflows use this method so that they support both.
+        """
+        return [self.dslContainerOp(image, command, **kwargs)]
+
+    def _container_op(self, image, command, name:str, extra_arguments:List, kwargs:dict) -> 'dsl.ContainerOp':
+
         positionals = []
         if command:
             positionals.append(command)
@@ -79,26 +269,118 @@ class Step():
         for arg in self.arguments:
             if arg in kwargs:
                 options += ['--{0}'.format(arg), kwargs[arg]]
-        all_arguments = positionals + options
-        return dsl.ContainerOp(
-            name = self.fullname,
+        all_arguments = positionals + options + extra_arguments
+        from kfp import dsl
+        op = dsl.ContainerOp(
+            name = name,
             image = image,
             arguments = all_arguments,
         )
+        resources = self.effective_resources()
+        if resources is not None:
+            resources.apply(op)
+        return op
 
 class GPUStep(Step):
     """
-    Represents a Step that requires a GPU to run.
+    Represents a Step that requires a GPU to run. It requests one GPU unless its resources
+    or num_gpus say otherwise.
     """
-    def dslContainerOp(self, image, script_path, num_gpus=1, **kwargs) -> dsl.ContainerOp:
+    def dslContainerOp(self, image, script_path, num_gpus=None, **kwargs) -> 'dsl.ContainerOp':
 
         op = super().dslContainerOp(image, script_path, **kwargs)
-        return op.set_gpu_limit(num_gpus).add_toleration({
-            'key': 'nvidia.com/gpu',
-            'operator': 'Equal',
-            'value': 'present',
-            'effect': 'NoSchedule',
-        })
+        resources = self.effective_resources()
+        if resources is not None and resources.gpus:
+            # Resources.apply has already set the limit and the toleration.
+            if num_gpus is not None and num_gpus != resources.gpus:
+                op.set_gpu_limit(num_gpus)
+            return op
+        from kungfupipelines.resources import GPU_TOLERATION
+        return op.set_gpu_limit(1 if num_gpus is None else num_gpus).add_toleration(GPU_TOLERATION)
+
+def _run_in_folder(item, function, *args, **kwargs):
+    """ Calls an ArtifactStep function on an (input filename or batch of filenames, output folder) pair. """
+    filename, output_dir = item
+    return function(filename, output_dir, *args, **kwargs)
+
+def _run_on_artifact(artifact, function, *args, **kwargs) -> List['Artifact']:
+    """ Calls an in-memory ArtifactStep function and returns its outputs as a list. """
+    from caboodle.artifacts import Artifact
+    outputs = function(artifact, *args, **kwargs)
+    if outputs is None:
+        return []
+    if isinstance(outputs, Artifact):
+        return [outputs]
+    return list(outputs)
+
+def _folder_size(path:str) -> int:
+    """ Returns the total size of the files in a folder. """
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def shard_of(name:str, shard_count:int) -> int:
+    """
+    Returns the shard that an input object belongs to. This depends only on the object's name,
+    so inputs stay in the same shard when other inputs are added or removed.
+    """
+    return int(hashlib.md5(name.encode()).hexdigest()[:8], 16) % shard_count
+
+@contextmanager
+def _sigterm_as_exit():
+    """
+    Turns SIGTERM, which Kubernetes sends to a pod before killing it (eg. when its node is
+    preempted), into a SystemExit so that cleanup code runs. Signal handlers can only be set
+    from the main thread, so elsewhere this does nothing.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        yield
+        return
+    def handler(signum, frame):
+        raise SystemExit(128 + signum)
+    previous = signal.signal(signal.SIGTERM, handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+
+class _Checkpoint():
+    """
+    Records the inputs of a resumable ArtifactStep as they complete, and saves them to its
+    manifest at most once every interval seconds (and whenever save is called).
+    """
+    def __init__(self, step:'ArtifactStep', entries:dict, checksums:dict, interval:float):
+        self.step = step
+        self.entries = dict(entries)
+        self.checksums = checksums
+        self.interval = interval
+        self.completed = 0
+        self._saved = time.time()
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def complete(self, name:str, outputs:List[str]):
+
+        with self._lock:
+            self.entries[name] = {'checksum': self.checksums[name], 'outputs': outputs}
+            self.completed += 1
+            self._dirty = True
+            if time.time() - self._saved >= self.interval:
+                self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+
+        if not self._dirty:
+            return
+        from kungfupipelines import coffers
+        if self.step.packer is not None: # The outputs in the manifest must be in the index
+            self.step.packer.save()
+        coffers.write_metadata(self.step.output_coffer, self.step.manifest_name, {'inputs': self.entries})
+        logger.info("Checkpointed {0} completed inputs of step {1}.".format(self.completed, self.step.name))
+        self._saved = time.time()
+        self._dirty = False
 
 class ArtifactStep(Step):
     """
@@ -113,6 +395,132 @@ class ArtifactStep(Step):
 
     This is a common use-case, as you may have some software which you just want
     to run against files, and you need this as a step in your workflow.
+
+    Files can be processed serially (the default) or concurrently using a thread or process
+    pool. A process pool is best for CPU-bound functions, but requires the function and its
+    arguments (including any returned by setup) to be picklable. These can also be set from the command line with the
+    --executor and --workers options.
+
+    In streaming mode, input artifacts are downloaded one by one in the background while
+    earlier ones are being processed, and each file's outputs are uploaded as soon as the
+    function returns. Local files are deleted once they are no longer needed, and the total
+    size of files held on disk can be capped with disk_budget. This is useful when the inputs
+    don't fit on local disk, or to keep the network busy while computing. Because outputs are
+    uploaded as they are produced, output filenames must be unique across input files.
+
+    In in-memory mode, nothing is written to local disk. Instead of a filename and an output
+    folder, the function receives a caboodle Artifact whose path_or_buffer is an io.BytesIO
+    holding the downloaded object. Its content is deserialized on first access of
+    artifact.data (eg. unpickled for a PickleArtifact), and the raw bytes can be read without
+    copying through artifact.path_or_buffer.getbuffer(). The function returns an Artifact, a
+    list of Artifacts or None, and the returned Artifacts are uploaded with
+    output_coffer.upload as soon as the function returns. Inputs of at least mmap_threshold
+    bytes are downloaded to local disk instead and memory-mapped (see workspace.MappedFile),
+    so that large inputs don't have to fit in memory. Columnar inputs (.npy and Arrow files,
+    see kungfupipelines.columnar) are always memory-mapped, and their data is a view onto the
+    mapped file rather than a copy, restricted to read_columns if that is set. Only Arrow
+    files store each column apart, so only for them does read_columns save reading the other
+    columns; the fields of an .npy array are stored row by row, and a column spans the file.
+
+    Each run works in a Workspace of its own: a unique local directory which is removed when
+    the run ends, even if it fails or the pod receives SIGTERM (see kungfupipelines.workspace).
+    Its capacity is the smaller of disk_budget and the free space on its filesystem. If the
+    inputs don't fit, they are streamed through it rather than downloaded all at once.
+    local_input and local_output can be set to use fixed folders instead, which are kept.
+
+    In incremental mode, a manifest of the inputs processed so far and the outputs each
+    produced is kept alongside the outputs, and subsequent runs only process inputs that are
+    new or have changed (see run_incremental).
+
+    Resumable (checkpoint) mode is incremental mode in which the manifest is also saved while
+    the Step runs, every checkpoint_interval seconds, as inputs complete and their outputs are
+    uploaded. If the pod is killed (eg. because its node was preempted), the retried Step
+    resumes where the last checkpoint left off. A checkpoint is also saved when the Step fails,
+    or receives SIGTERM. A resumable Step is skipped altogether if its manifest shows that
+    every input has already been processed (see is_complete).
+
+    Setting shards compiles the Step into that many parallel ContainerOps (see
+    dslContainerOps), each of which processes a slice of the input objects and uploads its
+    outputs to the same output_coffer, so the outputs look the same as for an unsharded run.
+    At runtime the slice is chosen with the --shard-index and --shard-count options. Sharded
+    runs always fetch their inputs object by object, as in streaming mode. Inputs are split so
+    that each shard gets about the same total cost (see kungfupipelines.scheduling), except in
+    incremental mode, where each input has to stay in the same shard between runs and inputs
+    are split by a hash of their names.
+
+    Inputs are processed largest first by default, so that the largest inputs don't hold up the
+    end of a run while the other workers are idle. Workers take the next input as soon as they
+    are free, so the work evens out between them.
+
+    In batch mode (when batch_size or batch_bytes is set), the function is called with a list
+    of inputs instead of a single one: a list of filenames followed by the output folder, or
+    in in-memory mode a list of Artifacts. This lets the function vectorize over its inputs,
+    or load a model once per batch. Batches hold at most batch_size inputs whose sizes add up
+    to at most batch_bytes; an input larger than batch_bytes is a batch of its own. In
+    streaming mode, batches are also capped at disk_budget. If the function raises, every
+    input of the batch is reported as failed. In incremental mode, the outputs of a batch are
+    recorded against every input in it, so they are only deleted once none of those inputs
+    remain, and functions should write one output per input where possible.
+
+    A failure on one input never stops the others from being processed. Each call of the
+    function can be given a timeout (item_timeout) and retried with exponential backoff
+    (item_retries, item_backoff). The inputs which still fail are listed, with their errors,
+    in a hidden quarantine object in output_coffer, and the Step raises an ArtifactStepError
+    unless they are within max_failures. A run with quarantined inputs isn't marked complete
+    (see check_if_complete), so the next run retries them. Timeouts interrupt the function when it runs in the
+    main thread of a process (the serial and process executors); with the thread executor, a
+    call which times out is abandoned and left to finish in the background.
+
+    Artifacts can be passed from one ArtifactStep to the next on local disk or a shared volume
+    instead of through remote storage, with the handoff_output option of the producer and the
+    handoff_input option of the consumer (see configure). The producer then writes its outputs
+    to the given folder and only uploads them if upload_outputs is set, and the consumer reads
+    its inputs from that folder in place. FusedSteps and Workflows with a shared volume set
+    these options (see kungfupipelines.volumes).
+
+    With compress_outputs set, outputs are compressed and deduplicated by content as they are
+    uploaded, and listed in an index object in output_coffer (see kungfupipelines.packing).
+    Steps reading from that Coffer decompress them transparently. Set it to True to choose
+    zstd (if installed) or gzip automatically, or to 'gzip' or 'zstd'.
+
+    Args:
+        executor: One of 'serial', 'thread' or 'process'
+        workers: Maximum number of concurrent workers (defaults to the executor's default)
+        streaming: Whether to stream artifacts instead of downloading them all up front
+        prefetch: (streaming only) Maximum number of downloaded files waiting to be processed
+        local_input: (optional) A folder to download inputs to instead of the Workspace
+        local_output: (optional) A folder for the function to write outputs to instead of the Workspace
+        disk_budget: Maximum bytes of inputs and outputs to hold on local disk, either as a
+            number or a string such as '10G' (defaults to the free space)
+        in_memory: Whether to pass Artifacts to the function instead of local files
+        incremental: Whether to only process inputs which changed since the last run
+        checkpoint: Whether to save progress while running, so that the Step can resume
+        checkpoint_interval: (checkpoint only) Minimum number of seconds between checkpoints
+        shards: Number of parallel ContainerOps to split the Step into when compiling
+        shard_index: Which shard of the inputs to process at runtime (0 to shard_count-1)
+        shard_count: The number of shards the inputs are split into at runtime
+        batch_size: (batch mode) Maximum number of inputs to pass to each call of the function
+        batch_bytes: (batch mode) Maximum total size of the inputs passed to each call, either
+            as a number or a string such as '512M'
+        transfer_concurrency: Number of objects to download or upload at once
+        transfer_retries: Number of times to retry a transfer which fails with a transient error
+        compress_outputs: Whether to compress and deduplicate outputs, or which encoding to use
+        workspace_root: (optional) The folder to create Workspaces in (defaults to the system's
+            temporary folder)
+        mmap_threshold: (in-memory only) The size from which inputs are memory-mapped instead
+            of read into memory, either as a number or a string such as '256M'
+        read_columns: (in-memory only) The names of the columns to read from columnar inputs
+            (see kungfupipelines.columnar), or on the command line, a comma separated list
+        item_timeout: (optional) The number of seconds after which a call of the function fails
+        item_retries: The number of times to call the function again on an input after it fails
+        item_backoff: The number of seconds to wait before the first retry, doubling after that
+        max_failures: The number of inputs (or, below 1, the fraction of inputs) that may fail
+            without failing the Step
+        schedule: The order to process inputs in: 'largest-first' (by cost) or 'listed' (by name)
+        shard_by: How to split inputs between shards: 'cost', so that shards get about the same
+            total cost, or 'name', so that each input always goes to the same shard
+        cost: (optional) A function which returns the cost of processing an input given its
+            ObjectInfo (defaults to its size)
     """
 
     def __init__(
@@ -120,59 +528,910 @@ class ArtifactStep(Step):
         name:str,
         function: Callable,
         arguments:List[str],
-        input_coffer: Coffer,
-        output_coffer: Coffer,
+        input_coffer: 'Coffer',
+        output_coffer: 'Coffer',
         check_if_complete:Callable = None,
         fullname:str = None,
         description:str = None,
-        local_input="/tmp/input/",
-        local_output="/tmp/output/",
+        local_input:str = None,
+        local_output:str = None,
+        executor:str = 'serial',
+        workers:int = None,
+        streaming:bool = False,
+        prefetch:int = 4,
+        disk_budget = None,
+        in_memory:bool = False,
+        incremental:bool = False,
+        checkpoint:bool = False,
+        checkpoint_interval:float = 30,
+        shards:int = 1,
+        shard_index:int = 0,
+        shard_count:int = 1,
+        batch_size:int = None,
+        batch_bytes = None,
+        transfer_concurrency:int = 8,
+        transfer_retries:int = 3,
+        compress_outputs = False,
+        workspace_root:str = None,
+        mmap_threshold = None,
+        item_timeout:float = None,
+        item_retries:int = 0,
+        item_backoff:float = 1.,
+        max_failures:float = 0,
+        schedule:str = 'largest-first',
+        shard_by:str = 'cost',
+        cost:Callable = None,
+        read_columns:List[str] = None,
+        profile = False,
+        profile_output:str = None,
+        resources:'Resources' = None,
+        setup:Callable = None,
+        teardown:Callable = None,
     ):
-        super().__init__(name, function, arguments, check_if_complete, fullname, description)
+        super().__init__(
+            name, function, arguments, check_if_complete, fullname, description, profile, profile_output, resources,
+            setup, teardown,
+        )
         self.input_coffer = input_coffer
         self.output_coffer = output_coffer
         self.local_input = local_input
         self.local_output = local_output
+        self.shards = shards
+        self.download_inputs = True # These are turned off to pass artifacts on local disk (see configure)
+        self.upload_outputs = True
+        self.handoff_output = None
+        self.executor = 'serial'
+        self.workers = None
+        self.disk_budget = None
+        self.batch_size = None
+        self.batch_bytes = None
+        self.compress_outputs = None
+        self.workspace_root = None
+        self.mmap_threshold = None
+        self.item_timeout = None
+        self.cost = cost
+        self.read_columns = None
+        self.packer = None # The Packer of the current run, if compressing outputs
+        self.workspace = None # The Workspace of the current run
+        self.quarantined = [] # The names of the inputs that failed in the last run
+        self.options += [
+            'executor', 'workers', 'streaming', 'prefetch', 'disk-budget', 'in-memory', 'incremental',
+            'checkpoint', 'checkpoint-interval', 'shard-index', 'shard-count', 'batch-size', 'batch-bytes', 'transfer-concurrency',
+            'transfer-retries', 'compress-outputs', 'workspace-root', 'mmap-threshold', 'item-timeout',
+            'item-retries', 'item-backoff', 'max-failures', 'schedule', 'shard-by', 'read-columns', 'handoff-input',
+            'handoff-output', 'upload-outputs',
+        ]
+        self.configure(
+            executor=executor,
+            workers=workers,
+            streaming=streaming,
+            prefetch=prefetch,
+            disk_budget=disk_budget,
+            in_memory=in_memory,
+            incremental=incremental,
+            checkpoint=checkpoint,
+            checkpoint_interval=checkpoint_interval,
+            shard_index=shard_index,
+            shard_count=shard_count,
+            batch_size=batch_size,
+            batch_bytes=batch_bytes,
+            transfer_concurrency=transfer_concurrency,
+            transfer_retries=transfer_retries,
+            compress_outputs=compress_outputs,
+            workspace_root=workspace_root,
+            mmap_threshold=mmap_threshold,
+            item_timeout=item_timeout,
+            item_retries=item_retries,
+            item_backoff=item_backoff,
+            max_failures=max_failures,
+            schedule=schedule,
+            shard_by=shard_by,
+            read_columns=read_columns,
+        )
 
-    def __call__(self, *args, **kwargs):
+    def configure(
+        self,
+        executor:str = None,
+        workers:int = None,
+        streaming:bool = None,
+        prefetch:int = None,
+        disk_budget = None,
+        in_memory:bool = None,
+        incremental:bool = None,
+        checkpoint:bool = None,
+        checkpoint_interval:float = None,
+        shard_index:int = None,
+        shard_count:int = None,
+        batch_size:int = None,
+        batch_bytes = None,
+        transfer_concurrency:int = None,
+        transfer_retries:int = None,
+        compress_outputs = None,
+        workspace_root:str = None,
+        mmap_threshold = None,
+        item_timeout:float = None,
+        item_retries:int = None,
+        item_backoff:float = None,
+        max_failures:float = None,
+        schedule:str = None,
+        shard_by:str = None,
+        read_columns:List[str] = None,
+        handoff_input:str = None,
+        handoff_output:str = None,
+        upload_outputs:bool = None,
+        **options
+    ):
+        """
+        Sets runtime options for this Step. These are the arguments of the constructor with the
+        same names, and:
+            handoff_input: A local folder to read inputs from in place, instead of downloading
+                them from input_coffer
+            handoff_output: A local folder to write outputs to, which are not uploaded to
+                output_coffer unless upload_outputs is set afterwards
+            upload_outputs: Whether to upload outputs to output_coffer
+        Either handoff option switches the Step to processing a folder of files: streaming and
+        sharded modes are turned off, and the Step is never skipped. In-memory, incremental and
+        checkpointed Steps can't be handed artifacts this way (see can_hand_off).
+        """
+        super().configure(**options)
+        if executor is not None:
+            if executor not in EXECUTORS:
+                raise ValueError("Unknown executor '{0}'. Choose one of {1}.".format(executor, EXECUTORS))
+            self.executor = executor
+        if workers is not None:
+            self.workers = int(workers)
+        if streaming is not None:
+            self.streaming = _as_bool(streaming)
+        if prefetch is not None:
+            self.prefetch = int(prefetch)
+        if disk_budget is not None:
+            self.disk_budget = parse_size(disk_budget)
+        if in_memory is not None:
+            self.in_memory = _as_bool(in_memory)
+        if incremental is not None:
+            self.incremental = _as_bool(incremental)
+        if checkpoint is not None:
+            self.checkpoint = _as_bool(checkpoint)
+        if checkpoint_interval is not None:
+            self.checkpoint_interval = float(checkpoint_interval)
+        if shard_index is not None:
+            self.shard_index = int(shard_index)
+        if shard_count is not None:
+            self.shard_count = int(shard_count)
+        if batch_size is not None:
+            self.batch_size = int(batch_size)
+        if batch_bytes is not None:
+            self.batch_bytes = parse_size(batch_bytes)
+        if transfer_concurrency is not None:
+            self.transfer_concurrency = int(transfer_concurrency)
+        if transfer_retries is not None:
+            self.transfer_retries = int(transfer_retries)
+        if compress_outputs is not None:
+            if isinstance(compress_outputs, str) and compress_outputs in ('auto', 'gzip', 'zstd'):
+                self.compress_outputs = compress_outputs
+            else:
+                self.compress_outputs = 'auto' if _as_bool(compress_outputs) else None
+        if workspace_root is not None:
+            self.workspace_root = workspace_root
+        if mmap_threshold is not None:
+            self.mmap_threshold = parse_size(mmap_threshold)
+        if item_timeout is not None:
+            self.item_timeout = float(item_timeout) or None # 0 turns the timeout off
+        if item_retries is not None:
+            self.item_retries = int(item_retries)
+        if item_backoff is not None:
+            self.item_backoff = float(item_backoff)
+        if max_failures is not None:
+            self.max_failures = float(max_failures)
+        if schedule is not None:
+            from kungfupipelines.scheduling import SCHEDULES
+            if schedule not in SCHEDULES:
+                raise ValueError("Unknown schedule '{0}'. Choose one of {1}.".format(schedule, SCHEDULES))
+            self.schedule = schedule
+        if shard_by is not None:
+            from kungfupipelines.scheduling import SHARD_BY
+            if shard_by not in SHARD_BY:
+                raise ValueError("Unknown shard_by '{0}'. Choose one of {1}.".format(shard_by, SHARD_BY))
+            self.shard_by = shard_by
+        if read_columns is not None:
+            self.read_columns = read_columns.split(',') if isinstance(read_columns, str) else list(read_columns)
+        if handoff_input is not None or handoff_output is not None:
+            if not self.can_hand_off:
+                raise ValueError("Step {0} can't pass artifacts on local disk in in-memory, incremental or checkpoint mode.".format(self.name))
+            # Artifacts on local disk are always processed as a folder of files.
+            self.streaming = False
+            self.shard_index, self.shard_count = 0, 1
+            # The Step's completion check looks at the coffers, which won't reflect local artifacts.
+            self.check_if_complete = _always_run
+        if handoff_input is not None:
+            self.local_input = handoff_input
+            self.download_inputs = False
+        if handoff_output is not None:
+            self.local_output = self.handoff_output = handoff_output
+            self.upload_outputs = False
+        if upload_outputs is not None:
+            self.upload_outputs = _as_bool(upload_outputs)
 
-        if self.check_if_complete(*args, **kwargs):
-            self._on_skip(*args, **kwargs)
-        else:
+    def run(self, *args, **kwargs):
+
+        with self._workspace(), self._packing():
             return self.download_run_upload(*args, **kwargs)
 
-    def download_run_upload(self, *args, **kwargs) -> List[Artifact]:
+    @contextmanager
+    def _workspace(self):
+        """
+        Gives the run a Workspace, which is removed when the run ends, including when the pod
+        is sent SIGTERM.
+        """
+        from kungfupipelines.workspace import Workspace
+        workspace = Workspace(self.workspace_root, self.local_input, self.local_output, self.disk_budget)
+        with _sigterm_as_exit(), workspace:
+            self.workspace = workspace
+            try:
+                yield workspace
+            finally:
+                self.workspace = None
+
+    @contextmanager
+    def _packing(self):
+        """ Gives the run a Packer if it compresses its outputs, and saves its index at the end. """
+        if not (self.compress_outputs and self.upload_outputs):
+            yield
+            return
+        from kungfupipelines.packing import Packer
+        self.packer = Packer(self.output_coffer, self.index_name, self.compress_outputs, self.transfer_retries)
+        try:
+            yield
+        finally:
+            # Outputs uploaded before a failure are indexed too, as they would be if uncompressed.
+            packer, self.packer = self.packer, None
+            packer.save()
+
+    @property
+    def input_dir(self) -> str:
+        """ The folder that inputs are downloaded to in the current run. """
+        return self.workspace.input_dir if self.workspace is not None else self.local_input
+
+    @property
+    def output_dir(self) -> str:
+        """ The folder that the function writes outputs to in the current run. """
+        return self.workspace.output_dir if self.workspace is not None else self.local_output
+
+    def _upload_files(self, paths:List[str], concurrency:int):
+        """ Uploads local files to output_coffer, through the Packer if compressing outputs. """
+        from kungfupipelines import transfer
+        if self.packer is not None:
+            self.packer.upload_files(paths, concurrency)
+        else:
+            transfer.upload_files(self.output_coffer, paths, concurrency, self.transfer_retries)
+
+    def _emit_profile(self, record:dict):
+
+        if self.profile_output == 'coffer':
+            from kungfupipelines import coffers
+            profiling.emit(record)
+            coffers.write_metadata(self.output_coffer, '.profile-' + profiling.record_name(record), record)
+        else:
+            super()._emit_profile(record)
+
+    def dslContainerOps(self, image, command=None, **kwargs) -> List['dsl.ContainerOp']:
+        """
+        Returns one ContainerOp per shard, each of which is passed its --shard-index and
+        --shard-count. Downstream ops should run after all of them.
+        """
+        if self.shards <= 1:
+            return super().dslContainerOps(image, command, **kwargs)
+        return [
+            self._container_op(
+                image,
+                command,
+                "{0}-shard-{1}".format(self.fullname, i),
+                ['--shard-index', str(i), '--shard-count', str(self.shards)],
+                kwargs,
+            )
+            for i in range(self.shards)
+        ]
+
+    @property
+    def sharded(self) -> bool:
+        return self.shard_count > 1
+
+    @property
+    def can_hand_off(self) -> bool:
+        """
+        Whether the Step can read its inputs from, or write its outputs to, a local folder of
+        files (see configure). In-memory, incremental and checkpointed Steps need their Coffers.
+        """
+        return not (self.in_memory or self.incremental or self.checkpoint)
+
+    @property
+    def batched(self) -> bool:
+        return self.batch_size is not None or self.batch_bytes is not None
+
+    def _batches(self, items:List, size:Callable, max_bytes:int = None) -> List[List]:
+        """ Groups items into batches, or into lists of one item each when not in batch mode. """
+        if not self.batched:
+            return [[item] for item in items]
+        return list(batched(items, self.batch_size, max_bytes, size))
+
+    def _record_batch(self, items:List, seconds:float):
+        """ Records the time taken by a batch, split evenly between its items. """
+        for item in items:
+            self.profile.record_item(item, seconds / len(items))
+
+    def select_inputs(self) -> List['ObjectInfo']:
+        """ Lists the input objects that this run of the Step should process. """
+        from kungfupipelines import coffers, transfer
+        with self.profile.phase('list'):
+            objects = transfer.retry(coffers.list_objects, self.input_coffer, retries=self.transfer_retries)
+        from kungfupipelines import scheduling
+        if self.sharded:
+            if not 0 <= self.shard_index < self.shard_count:
+                raise ValueError("Shard index {0} is out of range for {1} shards.".format(self.shard_index, self.shard_count))
+            # Incremental shards keep their own manifests, so each input has to stay in the same
+            # shard from one run to the next, whatever else is added or removed.
+            if self.shard_by == 'cost' and not (self.incremental or self.checkpoint):
+                objects = scheduling.balance(objects, self.shard_count, self.cost)[self.shard_index]
+            else:
+                objects = [o for o in objects if shard_of(o.name, self.shard_count) == self.shard_index]
+            logger.info("Processing shard {0} of {1}: {2} inputs.".format(self.shard_index, self.shard_count, len(objects)))
+        return scheduling.schedule(objects, self.schedule, self.cost)
+
+    def _schedule_files(self, filenames:List[str]) -> List[str]:
+        """ Orders local input files in the same way as select_inputs orders objects. """
+        from kungfupipelines import scheduling
+        from kungfupipelines.coffers import ObjectInfo
+        folders = {os.path.basename(f): os.path.dirname(f) for f in filenames}
+        files = [ObjectInfo(name, os.path.getsize(os.path.join(folder, name)), None) for name, folder in folders.items()]
+        return [os.path.join(folders[o.name], o.name) for o in scheduling.schedule(files, self.schedule, self.cost)]
+
+    def is_complete(self, *args, **kwargs) -> bool:
+        """
+        In addition to check_if_complete, a resumable ArtifactStep is complete if its manifest
+        lists every current input with an unchanged checksum, and nothing else.
+        """
+        if super().is_complete(*args, **kwargs):
+            return True
+        if not self.checkpoint:
+            return False
+        from kungfupipelines import coffers
+        manifest = coffers.read_metadata(self.output_coffer, self.manifest_name)
+        if manifest is None:
+            return False
+        done = {name: entry['checksum'] for name, entry in manifest['inputs'].items()}
+        return done == {o.name: o.checksum for o in self.select_inputs()}
+
+    @property
+    def manifest_name(self) -> str:
+        """ Each shard of an incremental ArtifactStep keeps its own manifest. """
+        if self.sharded:
+            return '.manifest-{0}-of-{1}.json'.format(self.shard_index, self.shard_count)
+        return MANIFEST
+
+    @property
+    def quarantine_name(self) -> str:
+        """ Each shard of an ArtifactStep keeps its own quarantine list. """
+        if self.sharded:
+            return '.quarantine-{0}-of-{1}.json'.format(self.shard_index, self.shard_count)
+        return QUARANTINE
+
+    @property
+    def item_policy(self) -> ItemPolicy:
+        return ItemPolicy(self.item_timeout, self.item_retries, self.item_backoff)
+
+    def _on_complete(self, *args, **kwargs):
+        # A run with quarantined inputs isn't marked complete, so that running the Step
+        # again retries them instead of being skipped by check_if_complete.
+        if self.quarantined:
+            logger.info("Not marking step {0} as complete, since {1} of its inputs are quarantined.".format(
+                self.fullname, len(self.quarantined),
+            ))
+            return
+        super()._on_complete(*args, **kwargs)
+
+    def _check_failures(self, failures:List[ItemFailure], total:int):
+        """
+        Lists the inputs that failed in the quarantine object in output_coffer (or removes it
+        if there were none), and raises an ArtifactStepError if there are more failures than
+        max_failures allows for total inputs.
+        """
+        from kungfupipelines import coffers
+        self.quarantined = sorted(os.path.basename(str(f.item)) for f in failures)
+        if self.upload_outputs:
+            if failures:
+                coffers.write_metadata(self.output_coffer, self.quarantine_name, {
+                    'step': self.name,
+                    'time': time.time(),
+                    'inputs': {
+                        os.path.basename(str(f.item)): {
+                            'error_type': f.error_type,
+                            'message': f.message,
+                            'traceback': f.traceback,
+                            'attempts': f.attempts,
+                        }
+                        for f in failures
+                    },
+                })
+            elif coffers.read_metadata(self.output_coffer, self.quarantine_name) is not None:
+                coffers.delete_object(self.output_coffer, self.quarantine_name)
+        if not failures:
+            return
+        allowed = self.max_failures if self.max_failures >= 1 else self.max_failures * total
+        if len(failures) > allowed:
+            raise ArtifactStepError(self.name, failures)
+        logger.warning("{0} of {1} inputs of step {2} failed, which is within max_failures ({3}). They are listed in {4}.".format(
+            len(failures), total, self.name, self.max_failures, self.quarantine_name,
+        ))
+
+    @property
+    def index_name(self) -> str:
+        """ Each shard of an ArtifactStep which compresses its outputs keeps its own index. """
+        if self.sharded:
+            return '.index-{0}-of-{1}.json'.format(self.shard_index, self.shard_count)
+        return '.index.json'
+
+    def download_run_upload(self, *args, **kwargs) -> List['Artifact']:
         """
         Downloads artifacts from input_coffer, runs the step's function on each
         artifact, and uploads results to output_coffer.
         It is assumed that the function takes as its first argument a filepath
         (location on disk of artifact) and as second argument a directory path
         (folder where to send results)
-        # TODO: Enable storing artifacts in memory.
+        If the function raises for any file, the remaining files are still processed, and then
+        an ArtifactStepError listing every failure is raised before anything is uploaded, unless
+        the failures are within max_failures. In that case the outputs are uploaded, including
+        any that failed calls wrote before raising (streaming mode discards those).
+        If the inputs don't fit in the run's Workspace, they are streamed instead.
         """
+        if self.incremental or self.checkpoint:
+            return self.run_incremental(*args, **kwargs)
+        if self.in_memory:
+            return self.run_in_memory(*args, **kwargs)
+        if self.streaming or self.sharded:
+            return self.stream_run_upload(*args, **kwargs)
+        from kungfupipelines import coffers, transfer
+        from tqdm import tqdm
+        os.makedirs(self.input_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+
         # Download
-        logger.info("Beginning {0} step. Downloading artifacts from {1}".format(self.name, self.input_coffer.location))
-        self.input_coffer.download(self.local_input)
+        if self.download_inputs:
+            logger.info("Beginning {0} step. Downloading artifacts from {1}".format(self.name, self.input_coffer.location))
+            if self.workspace is not None and coffers.supports_objects(self.input_coffer):
+                objects = self.select_inputs()
+                total = sum(o.size or 0 for o in objects)
+                if not self.workspace.fits(total):
+                    logger.warning(
+                        "The inputs of {0} ({1} bytes) don't fit in the {2} bytes of local disk available, so they will be streamed.".format(
+                            self.name, total, self.workspace.capacity(),
+                        )
+                    )
+                    return self.stream_run_upload(*args, **kwargs)
+                with self.profile.phase('download'):
+                    transfer.download_objects(self.input_coffer, objects, self.input_dir, self.transfer_concurrency, self.transfer_retries)
+            else:
+                with self.profile.phase('download'):
+                    transfer.download_all(self.input_coffer, self.input_dir, self.transfer_concurrency, self.transfer_retries)
+            self.profile.add_bytes(downloaded=_folder_size(self.input_dir))
         
         # Compute
-        for f in tqdm([x for x in os.listdir(self.local_input)]):
-            filename = os.path.join(self.local_input, f)
-            self.function(filename, self.local_output, *args, **kwargs)
+        filenames = self._schedule_files([
+            os.path.join(self.input_dir, f) for f in sorted(os.listdir(self.input_dir))
+            if not coffers.is_hidden(f)
+        ])
+        logger.info("Running {0} on {1} files with the {2} executor.".format(self.name, len(filenames), self.executor))
+        batches = self._batches(filenames, os.path.getsize, self.batch_bytes)
+        with tqdm(total=len(batches)) as progress, self.profile.phase('compute'):
+            _, failures = run_items(
+                self.function,
+                batches if self.batched else filenames,
+                args=(self.output_dir,) + args,
+                kwargs=kwargs,
+                executor=self.executor,
+                workers=self.workers,
+                progress=progress,
+                record_item=self._record_batch if self.batched else self.profile.record_item,
+                policy=self.item_policy,
+            )
+        if self.batched:
+            failures = [f._replace(item=item) for f in failures for item in f.item]
+        self._check_failures(failures, len(filenames))
 
         # Upload
-        logger.info("{0} step completed. Now Uploading artifacts to {1}".format(self.name, self.output_coffer.location))
-        self.output_coffer.upload_folder(self.local_output)
-
-    # def download_run_upload(*args, **kwargs):
-    # 
-    #     # Download artifacts
-    #     logger.info("Downloading files from {0}.".format(self.input_coffer.location))
-    #     artifacts = self.input_coffer.download()
-    #     # Compute
-    #     output = self.function(artifacts, *args, **kwargs)
-    #     # Upload results
-    #     logger.info("Uploading files to {0}".format(self.output_coffer.location))
-    #     self.output_coffer.upload(output)
+        if self.upload_outputs:
+            logger.info("{0} step completed. Now Uploading artifacts to {1}".format(self.name, self.output_coffer.location))
+            with self.profile.phase('upload'):
+                if self.packer is not None:
+                    self.packer.upload_folder(self.output_dir, self.transfer_concurrency)
+                else:
+                    transfer.upload_folder(self.output_coffer, self.output_dir, self.transfer_concurrency, self.transfer_retries)
+            self.profile.add_bytes(uploaded=_folder_size(self.output_dir))
+
+    def stream_run_upload(self, *args, **kwargs):
+        """
+        Streaming version of download_run_upload. Inputs are prefetched in the background and
+        each file's outputs are written to a folder of their own, which is uploaded and deleted
+        as soon as the function returns. Outputs which are handed off on local disk (see
+        configure) are moved to output_dir instead, and only uploaded if upload_outputs is set. Files that fail are reported in an ArtifactStepError
+        once all files have been processed; the outputs of other files are uploaded regardless.
+        """
+        logger.info("Beginning {0} step. Streaming artifacts from {1}".format(self.name, self.input_coffer.location))
+        objects = self.select_inputs()
+        _, failures = self._stream(objects, args, kwargs)
+        logger.info("{0} step completed. Outputs were uploaded to {1}".format(self.name, self.output_coffer.location))
+        self._check_failures(failures, len(objects))
+
+    def _stream(
+        self,
+        objects:List['ObjectInfo'],
+        args:tuple,
+        kwargs:dict,
+        on_complete:Callable = None,
+    ) -> Tuple[Dict[str, List[str]], List[ItemFailure]]:
+        """
+        Streams the given input objects through the function. Returns a dictionary mapping the
+        name of each input that succeeded to the names of the outputs it produced, along with
+        the list of failures. If given, on_complete is called with the name of each input and
+        its outputs once those outputs have been uploaded.
+        """
+        from kungfupipelines import transfer
+        from tqdm import tqdm
+        os.makedirs(self.input_dir, exist_ok=True)
+        os.makedirs(self.output_dir, exist_ok=True)
+        budget = self.workspace.budget() if self.workspace is not None else DiskBudget(self.disk_budget)
+        # A batch must fit in the disk budget, since its inputs are all held on disk at once.
+        max_bytes = min((b for b in (self.batch_bytes, budget.limit) if b is not None), default=None)
+        batches = self._batches(objects, lambda info: info.size or 0, max_bytes)
+
+        def items():
+            arrivals = prefetch(
+                self.input_coffer, objects, self.input_dir, budget, self.prefetch,
+                concurrency=self.transfer_concurrency, retries=self.transfer_retries,
+            )
+            try:
+                for batch in batches: # Objects arrive in the order they were listed
+                    filenames = []
+                    for _ in batch:
+                        with self.profile.phase('download_wait'): # Time spent waiting for the prefetcher
+                            info, filename = next(arrivals)
+                        self.profile.add_bytes(downloaded=info.size or 0)
+                        filenames.append(filename)
+                    yield filenames if self.batched else filenames[0], tempfile.mkdtemp(dir=self.output_dir)
+            finally:
+                arrivals.close()
+
+        def upload(output_dir, nbytes, names, outputs, keep):
+            try:
+                with self.profile.phase('upload'):
+                    paths = [os.path.join(output_dir, f) for f in outputs]
+                    self._upload_files(paths, concurrency=1)
+                self.profile.add_bytes(uploaded=nbytes)
+                if on_complete is not None:
+                    for name in names:
+                        on_complete(name, outputs)
+            finally:
+                if not keep:
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    budget.release(nbytes)
+
+        def release(item):
+            # Called as soon as a worker is done with its inputs, since the prefetcher may be
+            # waiting for their space before the next inputs can be handed to a worker.
+            filenames, _ = item
+            for filename in (filenames if self.batched else [filenames]):
+                budget.release(os.path.getsize(filename))
+                os.remove(filename)
+
+        # Outputs passed on local disk (see configure), or not uploaded at all, stay in output_dir
+        # like in download_run_upload, instead of being removed once uploaded.
+        keep = self.handoff_output is not None or not self.upload_outputs
+        produced = {}
+        failures = []
+        uploads = []
+        transfer.pool_connections(self.output_coffer, self.transfer_concurrency)
+        with ThreadPoolExecutor(max_workers=self.transfer_concurrency) as uploader, tqdm(total=len(objects)) as progress:
+            results = imap_items(
+                _run_in_folder,
+                items(),
+                args=(self.function,) + args,
+                kwargs=kwargs,
+                executor=self.executor,
+                workers=self.workers,
+                policy=self.item_policy,
+                on_done=release,
+            )
+            for (filenames, output_dir), ok, value, seconds in results:
+                if not self.batched:
+                    filenames = [filenames]
+                self._record_batch(filenames, seconds)
+                progress.update(len(filenames))
+                if not ok:
+                    logger.error("Failed on %s: %s: %s", ", ".join(filenames), value.error_type, value.message)
+                    failures.extend(value._replace(item=filename) for filename in filenames)
+                    shutil.rmtree(output_dir, ignore_errors=True)
+                    continue
+                outputs = sorted(os.listdir(output_dir))
+                names = [os.path.basename(filename) for filename in filenames]
+                for name in names:
+                    produced[name] = outputs
+                nbytes = sum(os.path.getsize(os.path.join(output_dir, f)) for f in outputs)
+                if keep:
+                    for f in outputs:
+                        os.replace(os.path.join(output_dir, f), os.path.join(self.output_dir, f))
+                    os.rmdir(output_dir)
+                    output_dir = self.output_dir
+                else:
+                    budget.reserve(nbytes)
+                if self.upload_outputs:
+                    uploads.append(uploader.submit(upload, output_dir, nbytes, names, outputs, keep))
+                elif on_complete is not None:
+                    for name in names:
+                        on_complete(name, outputs)
+        for future in uploads:
+            future.result() # Raise any upload errors
+
+        return produced, failures
+
+    def run_in_memory(self, *args, **kwargs):
+        """
+        In-memory version of download_run_upload. Each object in input_coffer is downloaded
+        into memory and handed to the function as an Artifact, and the Artifacts returned by
+        the function are uploaded directly to output_coffer.
+        """
+        logger.info("Beginning {0} step. Reading artifacts from {1} into memory".format(self.name, self.input_coffer.location))
+        objects = self.select_inputs()
+        _, failures = self._in_memory(objects, args, kwargs)
+        logger.info("{0} step completed. Outputs were uploaded to {1}".format(self.name, self.output_coffer.location))
+        self._check_failures(failures, len(objects))
+
+    def _in_memory(
+        self,
+        objects:List['ObjectInfo'],
+        args:tuple,
+        kwargs:dict,
+        on_complete:Callable = None,
+    ) -> Tuple[Dict[str, List[str]], List[ItemFailure]]:
+        """
+        Runs the function on the given input objects in memory. Arguments and return values
+        are the same as for _stream.
+        """
+        from kungfupipelines import coffers, transfer
+        from kungfupipelines.workspace import MappedFile
+        from kungfupipelines.columnar import ColumnarArtifact, is_columnar
+        from caboodle.coffer import infer_type
+        from tqdm import tqdm
+        def fetch(info):
+            # Columnar artifacts are views onto their bytes, so mapping them means only the
+            # parts the function touches are read from disk.
+            if is_columnar(info.name) or (self.mmap_threshold is not None and (info.size or 0) >= self.mmap_threshold):
+                os.makedirs(self.input_dir, exist_ok=True)
+                path = transfer.retry(coffers.fetch, self.input_coffer, info.name, self.input_dir, retries=self.transfer_retries)
+                return MappedFile(path)
+            return io.BytesIO(transfer.retry(coffers.fetch_bytes, self.input_coffer, info.name, retries=self.transfer_retries))
+
+        def release(artifacts):
+            # Mapped inputs are deleted from local disk once the function is done with them.
+            for artifact in artifacts:
+                if isinstance(artifact.path_or_buffer, MappedFile):
+                    artifact.path_or_buffer.close()
+                    os.remove(artifact.path_or_buffer.path)
+
+        def artifacts():
+            # Up to transfer_concurrency objects are downloaded ahead of the workers.
+            transfer.pool_connections(self.input_coffer, self.transfer_concurrency)
+            contents = transfer.read_ahead(fetch, objects, self.transfer_concurrency)
+            for batch in self._batches(objects, lambda info: info.size or 0, self.batch_bytes):
+                loaded = []
+                for info in batch:
+                    with self.profile.phase('download_wait'):
+                        buffer = next(contents)
+                    self.profile.add_bytes(downloaded=info.size or 0)
+                    artifact = infer_type(info.name)(info.name, path_or_buffer=buffer)
+                    if isinstance(artifact, ColumnarArtifact):
+                        artifact.columns = self.read_columns
+                    loaded.append(artifact)
+                yield loaded if self.batched else loaded[0]
+
+        produced = {}
+        failures = []
+        with tqdm(total=len(objects)) as progress:
+            results = imap_items(
+                _run_on_artifact,
+                artifacts(),
+                args=(self.function,) + args,
+                kwargs=kwargs,
+                executor=self.executor,
+                workers=self.workers,
+                policy=self.item_policy,
+            )
+            for batch, ok, value, seconds in results:
+                release(batch if self.batched else [batch])
+                keys = [artifact.key for artifact in (batch if self.batched else [batch])]
+                self._record_batch(keys, seconds)
+                progress.update(len(keys))
+                if ok:
+                    with self.profile.phase('upload'):
+                        if self.packer is not None:
+                            for artifact in value:
+                                self.packer.add_artifact(artifact)
+                        else:
+                            transfer.retry(self.output_coffer.upload, value, retries=self.transfer_retries)
+                    outputs = sorted(output.key for output in value)
+                    for key in keys:
+                        produced[key] = outputs
+                        if on_complete is not None:
+                            on_complete(key, outputs)
+                else:
+                    logger.error("Failed on %s: %s: %s", ", ".join(keys), value.error_type, value.message)
+                    failures.extend(value._replace(item=key) for key in keys)
+
+        return produced, failures
+
+    def _reconcile_outputs(self, written:set, stale:set):
+        """
+        Brings the index of packed outputs (see kungfupipelines.packing) and the plain objects
+        in output_coffer in line with an incremental run, which may have been compressed when
+        an earlier run wasn't or vice versa. Outputs written by this run replace any copy in
+        the other form, since packed entries take the place of plain objects with the same
+        name. Stale outputs are removed in whichever forms they exist.
+        """
+        from kungfupipelines import coffers
+        from kungfupipelines.packing import Packer
+        index = self.packer
+        if index is None and coffers.read_metadata(self.output_coffer, self.index_name) is not None:
+            index = Packer(self.output_coffer, self.index_name, retries=self.transfer_retries)
+        plain = {o.name for o in coffers.list_objects(self.output_coffer, include_packed=False)}
+        if index is None:
+            replaced = set()
+        elif self.packer is None:
+            replaced = {output for output in written if index.remove(output)}
+        else:
+            replaced = written & plain
+            for output in replaced:
+                coffers.delete_object(self.output_coffer, output)
+        if replaced:
+            logger.info("Replaced {0} outputs stored {1} by an earlier run.".format(
+                len(replaced), "packed" if self.packer is None else "plain",
+            ))
+        for output in sorted(stale):
+            logger.info("Deleting stale output %s", output)
+            if index is not None:
+                index.remove(output)
+            if output in plain:
+                coffers.delete_object(self.output_coffer, output)
+        if index is not None:
+            index.save()
+
+    def run_incremental(self, *args, **kwargs):
+        """
+        Incremental version of download_run_upload. A manifest stored in output_coffer records
+        the checksum of each input along with the outputs it produced. Only inputs which are new
+        or whose checksum has changed since the last run are downloaded and processed (streamed,
+        or in memory if in_memory is set); the outputs of other inputs are left in place.
+        Outputs which no longer belong to any input (because their input was removed, or no
+        longer produces them) are deleted, whether they were stored packed or plain, so
+        compress_outputs can change between runs. Inputs that fail are left out of the manifest,
+        so they are retried on the next run.
+        With checkpoint set, the manifest is also saved as inputs complete. Until an input
+        completes, its entry from the previous manifest is kept, so that its old outputs are
+        still cleaned up if the run is interrupted.
+        """
+        from kungfupipelines import coffers
+        objects = self.select_inputs()
+        manifest = coffers.read_metadata(self.output_coffer, self.manifest_name) or {'inputs': {}}
+        previous = manifest['inputs']
+        changed = [o for o in objects if previous.get(o.name, {}).get('checksum') != o.checksum]
+        logger.info(
+            "Beginning {0} step. {1} of {2} inputs in {3} are new or changed.".format(
+                self.name, len(changed), len(objects), self.input_coffer.location,
+            )
+        )
+        checksums = {o.name: o.checksum for o in changed}
+        process = self._in_memory if self.in_memory else self._stream
+        if self.checkpoint:
+            checkpoint = _Checkpoint(self, previous, checksums, self.checkpoint_interval)
+            try:
+                with _sigterm_as_exit():
+                    produced, failures = process(changed, args, kwargs, on_complete=checkpoint.complete)
+            except BaseException:
+                checkpoint.save() # Otherwise the full manifest is written below
+                raise
+        else:
+            produced, failures = process(changed, args, kwargs)
+
+        entries = {o.name: previous[o.name] for o in objects if o.name in previous and o.name not in checksums}
+        for name, outputs in produced.items():
+            entries[name] = {'checksum': checksums[name], 'outputs': outputs}
+        current = {output for entry in entries.values() for output in entry['outputs']}
+        stale = {output for entry in previous.values() for output in entry['outputs']} - current
+        self._reconcile_outputs({output for outputs in produced.values() for output in outputs}, stale)
+        coffers.write_metadata(self.output_coffer, self.manifest_name, {'inputs': entries})
+
+        logger.info("{0} step completed. Outputs were uploaded to {1}".format(self.name, self.output_coffer.location))
+        self._check_failures(failures, len(changed))
+
+class FusedStep(Step):
+    """
+    Runs a chain of Steps one after another in a single invocation, and thus in a single
+    container when compiled. This saves the container start up time for each Step, and when
+    an ArtifactStep is followed by an ArtifactStep whose input_coffer has the same location as
+    its output_coffer, the intermediate artifacts are passed on local disk instead of being
+    uploaded and downloaded again (unless either Step can't hand off, see
+    ArtifactStep.can_hand_off). Those intermediates are only uploaded if keep_intermediates
+    is set.
+    The name of a FusedStep is the names of its Steps joined by commas, which is how a
+    StepSwitch is told to run several of its Steps in a row (eg. myscript.py step1,step2).
+
+    Args:
+        steps: The Steps to run, in order
+        keep_intermediates: Whether to also upload artifacts which are passed on local disk
+        local_dir: (optional) Where to keep intermediate artifacts (defaults to a temporary directory)
+    """
+    def __init__(self, steps: List[Step], keep_intermediates:bool = False, local_dir:str = None):
+        arguments = []
+        for step in steps:
+            arguments.extend(arg for arg in step.arguments if arg not in arguments)
+        super().__init__(
+            name = ",".join(step.name for step in steps),
+            function = None,
+            arguments = arguments,
+            fullname = " ".join(step.fullname for step in steps),
+            description = "Runs {0} in sequence.".format(", ".join(step.name for step in steps)),
+        )
+        self.steps = steps
+        self.keep_intermediates = keep_intermediates
+        self.local_dir = local_dir
+
+    def effective_resources(self) -> 'Resources':
+        """ The Steps run one after another, so the container needs the most that any of them does. """
+        from kungfupipelines.resources import Resources
+        combined = Resources.maximum(step.effective_resources() for step in self.steps)
+        if combined is None:
+            return super().effective_resources()
+        return combined.merge(super().effective_resources())
+
+    def setup(self) -> dict:
+        """ Sets up each of the Steps, so that the copies which run share their state. """
+        for step in self.steps:
+            step.setup()
+        return {}
+
+    def teardown(self):
+        for step in self.steps:
+            step.teardown()
+
+    @staticmethod
+    def _hands_off(producer:Step, consumer:Step) -> bool:
+        """ Whether producer's output artifacts can be passed to consumer on local disk. """
+        return (
+            isinstance(producer, ArtifactStep) and isinstance(consumer, ArtifactStep)
+            and producer.can_hand_off and consumer.can_hand_off
+            and producer.output_coffer.location == consumer.input_coffer.location
+        )
+
+    def run(self, **kwargs):
+
+        local_dir = self.local_dir or tempfile.mkdtemp(prefix="fused-")
+        # Work on copies, since the Steps may also be used on their own.
+        steps = [copy.copy(step) for step in self.steps]
+        for i, (producer, consumer) in enumerate(zip(steps, steps[1:])):
+            if not self._hands_off(producer, consumer):
+                continue
+            handoff = os.path.join(local_dir, "{0}-{1}".format(i, producer.name))
+            producer.configure(handoff_output=handoff, upload_outputs=self.keep_intermediates)
+            consumer.configure(handoff_input=handoff)
+            logger.info("Passing artifacts from {0} to {1} through {2}".format(producer.name, consumer.name, handoff))
+
+        results = []
+        try:
+            for step in steps:
+                names = [arg.replace('-','_') for arg in step.arguments]
+                arguments = {name: kwargs[name] for name in names if name in kwargs}
+                results.append(step(**arguments))
+        finally:
+            if self.local_dir is None:
+                shutil.rmtree(local_dir, ignore_errors=True)
+        return results
 
 # class BinaryExecutableStep(ArtifactStep):
 #     """
@@ -2,8 +2,14 @@ from kungfupipelines import step
 from kfp import dsl
 from caboodle.gcs import get_storage_client
 from caboodle.coffer import GCSCoffer
-from caboodle.artifacts import PickleArtifact
+from kungfupipelines.coffers import FolderCoffer
+from caboodle.artifacts import PickleArtifact, BinaryArtifact
 import os
+import pickle
+import json
+import shutil
+import signal
+import pytest
 
 def test_step():
     
@@ -82,3 +88,540 @@ def test_artifact_step():
     # Clean up
     input_coffer.delete()
     output_coffer.delete()    
+
+def make_local_coffers(tmp_path, contents):
+
+    input_coffer = FolderCoffer(str(tmp_path / "inputs"))
+    output_coffer = FolderCoffer(str(tmp_path / "outputs"))
+    for name, data in contents.items():
+        (tmp_path / "inputs" / name).write_bytes(data)
+    return input_coffer, output_coffer
+
+def shout(filename, output_dir, suffix="!"):
+    if filename.endswith("bad.txt"):
+        raise ValueError("bad input")
+    with open(filename, "rb") as f:
+        text = f.read().decode().upper() + suffix
+    with open(os.path.join(output_dir, os.path.basename(filename)), "w") as f:
+        f.write(text)
+
+@pytest.mark.parametrize("mode", [
+    {},
+    {'executor': 'thread', 'workers': 2},
+    {'streaming': True, 'prefetch': 1, 'disk_budget': 4},
+    {'streaming': True, 'executor': 'process', 'workers': 2},
+    {'streaming': True, 'executor': 'thread', 'workers': 2, 'disk_budget': 8}, # Less than two inputs fit
+    {'streaming': True, 'executor': 'process', 'workers': 2, 'disk_budget': 8},
+])
+def test_local_artifact_step(tmp_path, mode):
+
+    input_coffer, output_coffer = make_local_coffers(
+        tmp_path, {"a.txt": b"howdy", "b.txt": b"there", "c.txt": b"partner"}
+    )
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout,
+        arguments=["suffix"],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        **mode
+    )
+    my_step(suffix="?")
+
+    outputs = {p.name: p.read_text() for p in (tmp_path / "outputs").iterdir()}
+    assert outputs == {"a.txt": "HOWDY?", "b.txt": "THERE?", "c.txt": "PARTNER?"}
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_artifact_step_failures(tmp_path, streaming):
+
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {"a.txt": b"howdy", "bad.txt": b"?"})
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        streaming=streaming,
+    )
+    with pytest.raises(step.ArtifactStepError) as error:
+        my_step()
+    assert [os.path.basename(f.item) for f in error.value.failures] == ["bad.txt"]
+    assert error.value.failures[0].error_type == "ValueError"
+
+@pytest.mark.parametrize("mode", [{}, {'streaming': True}, {'incremental': True}])
+def test_artifact_step_max_failures(tmp_path, mode):
+
+    input_coffer, output_coffer = make_local_coffers(
+        tmp_path, {"a.txt": b"howdy", "b.txt": b"there", "bad.txt": b"?", "flaky.txt": b"oops"}
+    )
+    attempts = []
+    def shout_flaky(filename, output_dir):
+        if filename.endswith("flaky.txt"):
+            attempts.append(filename)
+            if len(attempts) == 1:
+                raise ConnectionError("connection reset")
+        shout(filename, output_dir)
+
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout_flaky,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        workspace_root=str(tmp_path / "workspaces"),
+        item_retries=1,
+        item_backoff=0,
+        max_failures=0.25,
+        **mode
+    )
+    my_step() # One of four inputs failing is within max_failures
+    outputs = sorted(p.name for p in (tmp_path / "outputs").iterdir() if not p.name.startswith('.'))
+    assert outputs == ["a.txt", "b.txt", "flaky.txt"]
+    quarantine = json.loads((tmp_path / "outputs" / ".quarantine.json").read_text())
+    assert list(quarantine['inputs']) == ["bad.txt"]
+    assert quarantine['inputs']["bad.txt"]['error_type'] == "ValueError"
+    assert quarantine['inputs']["bad.txt"]['attempts'] == 2
+
+    my_step.configure(max_failures=0)
+    with pytest.raises(step.ArtifactStepError):
+        my_step()
+
+    (tmp_path / "inputs" / "bad.txt").unlink()
+    my_step()
+    assert not (tmp_path / "outputs" / ".quarantine.json").exists()
+
+def test_quarantined_inputs_are_retried(tmp_path):
+
+    from kungfupipelines.cache import StepCache, LocalCacheStore
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {"a.txt": b"a", "flaky.txt": b"b"})
+    broken = [True]
+    def shout_flaky(filename, output_dir):
+        if filename.endswith("flaky.txt") and broken[0]:
+            raise ConnectionError("connection reset")
+        shout(filename, output_dir)
+
+    step_cache = StepCache(LocalCacheStore(str(tmp_path / "cache")))
+    my_step = step.ArtifactStep(
+        "shout", shout_flaky, [], input_coffer, output_coffer,
+        local_input=str(tmp_path / "local_input"), local_output=str(tmp_path / "local_output"),
+        max_failures=1, check_if_complete=step_cache,
+    )
+    my_step()
+    assert my_step.quarantined == ["flaky.txt"]
+    broken[0] = False
+    my_step() # Not skipped, since an input was quarantined
+    assert sorted(p.name for p in (tmp_path / "outputs").iterdir()) == ["a.txt", "flaky.txt"]
+    my_step()
+    assert step_cache.hits == 1
+
+def double_pickle(artifact, factor="2"):
+    return PickleArtifact(artifact.key, [x * int(factor) for x in artifact.data])
+
+@pytest.mark.parametrize("executor", ['serial', 'thread'])
+def test_in_memory_artifact_step(tmp_path, executor):
+
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {})
+    input_coffer.upload([PickleArtifact('a.pickle', [1,2,3]), PickleArtifact('b.pickle', ['a','b'])])
+    my_step = step.ArtifactStep(
+        name="double",
+        function=double_pickle,
+        arguments=["factor"],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        executor=executor,
+        in_memory=True,
+    )
+    my_step(factor="3")
+
+    outputs = {p.name: pickle.loads(p.read_bytes()) for p in (tmp_path / "outputs").iterdir()}
+    assert outputs == {'a.pickle': [3,6,9], 'b.pickle': ['aaa','bbb']}
+    assert not os.path.exists(str(tmp_path / "local_input"))
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_incremental_artifact_step(tmp_path, in_memory):
+
+    calls = []
+    def count_files(filename, output_dir):
+        calls.append(os.path.basename(filename))
+        shout(filename, output_dir)
+
+    def count_artifacts(artifact):
+        calls.append(artifact.key)
+        return BinaryArtifact(artifact.key, artifact.data.upper())
+
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {"a.txt": b"a", "b.txt": b"b", "c.txt": b"c"})
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=count_artifacts if in_memory else count_files,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        in_memory=in_memory,
+        incremental=True,
+    )
+    my_step()
+    assert sorted(calls) == ["a.txt", "b.txt", "c.txt"]
+
+    # Change one input, remove one and add one.
+    calls.clear()
+    (tmp_path / "inputs" / "a.txt").write_bytes(b"aa")
+    (tmp_path / "inputs" / "c.txt").unlink()
+    (tmp_path / "inputs" / "d.txt").write_bytes(b"d")
+    my_step()
+    assert sorted(calls) == ["a.txt", "d.txt"]
+
+    outputs = sorted(p.name for p in (tmp_path / "outputs").iterdir() if not p.name.startswith('.'))
+    assert outputs == ["a.txt", "b.txt", "d.txt"]
+    assert (tmp_path / "outputs" / "a.txt").read_bytes().startswith(b"AA")
+
+@pytest.mark.parametrize("in_memory", [False, True])
+def test_resumable_artifact_step(tmp_path, in_memory):
+
+    calls = []
+    preempt_after = [3]
+    def process(item, output_dir=None):
+        name = item.key if in_memory else os.path.basename(item)
+        if len(calls) == preempt_after[0]:
+            os.kill(os.getpid(), signal.SIGTERM) # What Kubernetes sends when a node is preempted
+        calls.append(name)
+        if in_memory:
+            return BinaryArtifact(name, item.data.upper())
+        shout(item, output_dir)
+
+    contents = {"{0}.txt".format(i): str(i).encode() for i in range(6)}
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=process,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        in_memory=in_memory,
+        checkpoint=True,
+        checkpoint_interval=1000,
+    )
+    with pytest.raises(SystemExit):
+        my_step()
+    assert len(calls) == 3
+    assert not my_step.is_complete()
+
+    # The restarted Step only processes the remaining inputs.
+    calls.clear()
+    preempt_after[0] = None
+    my_step()
+    assert sorted(calls) == sorted(contents)[3:]
+    outputs = sorted(p.name for p in (tmp_path / "outputs").iterdir() if not p.name.startswith('.'))
+    assert outputs == sorted(contents)
+
+    # Once every input is done, the whole Step is skipped.
+    calls.clear()
+    assert my_step.is_complete()
+    my_step()
+    assert calls == []
+
+def shout_batch(filenames, output_dir, suffix="!"):
+    assert isinstance(filenames, list)
+    for filename in filenames:
+        shout(filename, output_dir, suffix + str(len(filenames)))
+
+@pytest.mark.parametrize("mode", [
+    {'batch_size': 2},
+    {'batch_size': 2, 'executor': 'thread', 'workers': 2},
+    {'batch_bytes': 10, 'streaming': True, 'prefetch': 1},
+    {'batch_size': 2, 'streaming': True, 'disk_budget': 5},
+])
+def test_batched_artifact_step(tmp_path, mode):
+
+    input_coffer, output_coffer = make_local_coffers(
+        tmp_path, {"a.txt": b"howdy", "b.txt": b"there", "c.txt": b"partner"}
+    )
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout_batch,
+        arguments=["suffix"],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        **mode
+    )
+    my_step(suffix="?")
+
+    outputs = {p.name: p.read_text() for p in (tmp_path / "outputs").iterdir()}
+    if mode.get('disk_budget'): # Each input fills the budget, so every batch has one input
+        assert outputs == {"a.txt": "HOWDY?1", "b.txt": "THERE?1", "c.txt": "PARTNER?1"}
+    elif mode.get('batch_bytes'): # The largest input comes first, and the others don't fit with it
+        assert outputs == {"a.txt": "HOWDY?2", "b.txt": "THERE?2", "c.txt": "PARTNER?1"}
+    else: # Largest first
+        assert outputs == {"a.txt": "HOWDY?2", "b.txt": "THERE?1", "c.txt": "PARTNER?2"}
+
+def test_batched_in_memory_artifact_step(tmp_path):
+
+    def double_batch(artifacts):
+        if any(a.key == 'bad.pickle' for a in artifacts):
+            raise ValueError("bad input")
+        return [double_pickle(a) for a in artifacts]
+
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {})
+    input_coffer.upload([PickleArtifact(name, [1]) for name in ('a.pickle', 'b.pickle', 'bad.pickle')])
+    my_step = step.ArtifactStep(
+        name="double",
+        function=double_batch,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        in_memory=True,
+        batch_size=2,
+    )
+    with pytest.raises(step.ArtifactStepError) as error:
+        my_step()
+    assert [f.item for f in error.value.failures] == ['bad.pickle']
+    assert sorted(p.name for p in (tmp_path / "outputs").iterdir()) == ['.quarantine.json', 'a.pickle', 'b.pickle']
+    assert list(json.loads((tmp_path / "outputs" / ".quarantine.json").read_text())['inputs']) == ['bad.pickle']
+
+def test_sharded_artifact_step(tmp_path):
+
+    contents = {"{0}.txt".format(i): str(i).encode() for i in range(20)}
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+    )
+    processed = []
+    for i in range(3):
+        my_step.configure(shard_index=str(i), shard_count="3")
+        processed.append({o.name for o in my_step.select_inputs()})
+        my_step()
+
+    assert set().union(*processed) == set(contents)
+    assert sum(len(p) for p in processed) == len(contents)
+    assert sorted(p.name for p in (tmp_path / "outputs").iterdir()) == sorted(contents)
+
+@pytest.mark.parametrize("schedule", ['largest-first', 'listed'])
+def test_scheduled_artifact_step(tmp_path, schedule):
+
+    contents = {"{0}.txt".format(i): b"x" * size for i, size in enumerate([3, 40, 1, 20, 10, 30])}
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    order = []
+    my_step = step.ArtifactStep(
+        name="record",
+        function=lambda filename, output_dir: order.append(os.path.basename(filename)),
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        schedule=schedule,
+        workspace_root=str(tmp_path / "workspaces"),
+    )
+    my_step()
+    if schedule == 'listed':
+        assert order == sorted(contents)
+    else:
+        assert order == ["1.txt", "5.txt", "3.txt", "4.txt", "0.txt", "2.txt"]
+
+    # Shards get about the same number of bytes.
+    loads = []
+    for i in range(2):
+        my_step.configure(shard_index=i, shard_count=2)
+        loads.append(sum(o.size for o in my_step.select_inputs()))
+    assert loads == [53, 51]
+    my_step.configure(incremental=True) # Inputs have to stay in their shard
+    assert {o.name for o in my_step.select_inputs()} == {n for n in contents if step.shard_of(n, 2) == 1}
+
+def test_artifact_step_workspace(tmp_path):
+
+    contents = {"{0}.txt".format(i): b"x" * 100 for i in range(5)}
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    seen = []
+    def check(filename, output_dir):
+        seen.append(os.path.dirname(filename))
+        # The inputs don't fit in the disk budget, so they are streamed through it.
+        assert len(os.listdir(os.path.dirname(filename))) <= 2
+        shout(filename, output_dir)
+
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=check,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        disk_budget=250,
+        workspace_root=str(tmp_path / "workspaces"),
+    )
+    my_step()
+    assert all(folder.startswith(str(tmp_path / "workspaces")) for folder in seen)
+    assert list((tmp_path / "workspaces").iterdir()) == [] # Removed after the run
+    assert sorted(p.name for p in (tmp_path / "outputs").iterdir()) == sorted(contents)
+
+@pytest.mark.parametrize("upload_outputs", [False, True])
+def test_streamed_handoff_artifact_step(tmp_path, upload_outputs):
+
+    contents = {"{0}.txt".format(i): b"x" * 100 for i in range(5)}
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    my_step = step.ArtifactStep(
+        "shout", shout, [], input_coffer, output_coffer,
+        disk_budget=250, workspace_root=str(tmp_path / "workspaces"),
+    )
+    # The inputs don't fit in the Workspace, so they are streamed, but the outputs are still handed off.
+    my_step.configure(handoff_output=str(tmp_path / "handoff"), upload_outputs=upload_outputs)
+    my_step()
+    assert sorted(p.name for p in (tmp_path / "handoff").iterdir()) == sorted(contents)
+    uploaded = sorted(p.name for p in (tmp_path / "outputs").iterdir())
+    assert uploaded == (sorted(contents) if upload_outputs else [])
+
+def test_mmap_artifact_step(tmp_path):
+
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {})
+    input_coffer.upload([PickleArtifact('small.pickle', [1]), PickleArtifact('large.pickle', list(range(1000)))])
+    buffers = {}
+    def double(artifact):
+        buffers[artifact.key] = type(artifact.path_or_buffer).__name__
+        return double_pickle(artifact)
+
+    my_step = step.ArtifactStep(
+        name="double",
+        function=double,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        in_memory=True,
+        mmap_threshold='1K',
+        workspace_root=str(tmp_path / "workspaces"),
+    )
+    my_step()
+    assert buffers == {'small.pickle': 'BytesIO', 'large.pickle': 'MappedFile'}
+    assert pickle.loads((tmp_path / "outputs" / "large.pickle").read_bytes()) == [x * 2 for x in range(1000)]
+    assert list((tmp_path / "workspaces").iterdir()) == []
+
+def shout_artifact(artifact):
+    return BinaryArtifact(artifact.key, artifact.data.upper() + b"!")
+
+@pytest.mark.parametrize("mode", [
+    {},
+    {'streaming': True},
+    {'in_memory': True},
+    {'incremental': True},
+    {'shards': 2},
+])
+def test_compressed_artifact_step(tmp_path, mode):
+
+    contents = {"{0}.txt".format(i): b"same " * 100 for i in range(4)}
+    contents["other.txt"] = b"other"
+    input_coffer, output_coffer = make_local_coffers(tmp_path, contents)
+    shards = mode.pop('shards', 1)
+    my_step = step.ArtifactStep(
+        name="shout",
+        function=shout_artifact if mode.get('in_memory') else shout,
+        arguments=[],
+        input_coffer=input_coffer,
+        output_coffer=output_coffer,
+        local_input=str(tmp_path / "local_input"),
+        local_output=str(tmp_path / "local_output"),
+        compress_outputs=True,
+        **mode
+    )
+    for i in range(shards):
+        my_step.configure(shard_index=i, shard_count=shards)
+        my_step()
+    stored = [p.name for p in (tmp_path / "outputs").iterdir() if p.name.startswith('.blob-')]
+    assert len(stored) == 2 # Identical outputs are stored once
+
+    # A downstream Step reads the compressed outputs like any others.
+    final_coffer = FolderCoffer(str(tmp_path / "final"))
+    downstream = step.ArtifactStep(
+        name="copy",
+        function=lambda filename, output_dir: shutil.copy(filename, output_dir),
+        arguments=[],
+        input_coffer=output_coffer,
+        output_coffer=final_coffer,
+        local_input=str(tmp_path / "downstream_input"),
+        local_output=str(tmp_path / "downstream_output"),
+    )
+    downstream()
+    outputs = {p.name: p.read_bytes() for p in (tmp_path / "final").iterdir()}
+    assert outputs == {name: data.upper() + b"!" for name, data in contents.items()}
+
+def test_incremental_step_switching_compression(tmp_path):
+
+    from kungfupipelines import coffers
+    input_coffer, output_coffer = make_local_coffers(tmp_path, {"a.txt": b"a", "b.txt": b"b"})
+    my_step = step.ArtifactStep(
+        "shout", shout, [], input_coffer, output_coffer,
+        local_input=str(tmp_path / "local_input"), local_output=str(tmp_path / "local_output"),
+        incremental=True, compress_outputs=True,
+    )
+    def outputs():
+        return {o.name: coffers.fetch_bytes(output_coffer, o.name) for o in coffers.list_objects(output_coffer)}
+
+    my_step()
+    assert outputs() == {"a.txt": b"A!", "b.txt": b"B!"}
+
+    # Packed to plain: the new output replaces the packed one, and the stale packed output is removed.
+    (tmp_path / "inputs" / "a.txt").write_bytes(b"aa")
+    (tmp_path / "inputs" / "b.txt").unlink()
+    my_step.configure(compress_outputs=False)
+    my_step()
+    assert outputs() == {"a.txt": b"AA!"}
+    assert (tmp_path / "outputs" / "a.txt").exists()
+
+    # Plain to packed: the plain object is replaced by the packed one.
+    (tmp_path / "inputs" / "a.txt").write_bytes(b"aaa")
+    (tmp_path / "inputs" / "c.txt").write_bytes(b"c")
+    my_step.configure(compress_outputs=True)
+    my_step()
+    assert outputs() == {"a.txt": b"AAA!", "c.txt": b"C!"}
+    assert not (tmp_path / "outputs" / "a.txt").exists()
+
+def test_fused_step(tmp_path):
+
+    input_coffer, final_coffer = make_local_coffers(tmp_path, {"a.txt": b"a", "b.txt": b"b"})
+    intermediate_coffer = FolderCoffer(str(tmp_path / "intermediate"))
+    calls = []
+    first = step.ArtifactStep(
+        "first", shout, ["suffix"], input_coffer, intermediate_coffer,
+        local_input=str(tmp_path / "local_input"), streaming=True,
+    )
+    second = step.ArtifactStep(
+        "second", shout, ["suffix"], intermediate_coffer, final_coffer,
+        local_output=str(tmp_path / "local_output"),
+    )
+    third = step.Step("third", lambda: calls.append("third"), [])
+
+    fused = step.FusedStep([first, second, third])
+    assert fused.name == "first,second,third"
+    assert fused.arguments == ["suffix"]
+    fused(suffix="?")
+
+    outputs = {p.name: p.read_text() for p in (tmp_path / "outputs").iterdir()}
+    assert outputs == {"a.txt": "A??", "b.txt": "B??"}
+    assert list((tmp_path / "intermediate").iterdir()) == [] # Passed on local disk
+    assert calls == ["third"]
+    assert first.streaming and first.upload_outputs # The original Steps are untouched
+
+def test_fused_in_memory_steps(tmp_path):
+
+    input_coffer, final_coffer = make_local_coffers(tmp_path, {})
+    input_coffer.upload([PickleArtifact('a.pickle', [1, 2])])
+    intermediate_coffer = FolderCoffer(str(tmp_path / "intermediate"))
+    first = step.ArtifactStep("first", double_pickle, ["factor"], input_coffer, intermediate_coffer, in_memory=True)
+    second = step.ArtifactStep("second", double_pickle, ["factor"], intermediate_coffer, final_coffer, in_memory=True)
+    step.FusedStep([first, second])(factor="3")
+
+    assert pickle.loads((tmp_path / "outputs" / "a.pickle").read_bytes()) == [9, 18]
+    assert (tmp_path / "intermediate" / "a.pickle").exists() # Passed through the Coffer
+    with pytest.raises(ValueError):
+        first.configure(handoff_output=str(tmp_path / "handoff"))
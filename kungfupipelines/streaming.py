@@ -0,0 +1,142 @@
+"""
+Building blocks for ArtifactSteps which overlap downloading, computing and uploading
+instead of running them one after another.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import List, Iterator, Tuple, TYPE_CHECKING
+import threading
+import queue
+import re
+
+if TYPE_CHECKING:
+    from kungfupipelines.coffers import ObjectInfo
+    from caboodle.coffer import Coffer
+
+_size_units = {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+def parse_size(size) -> int:
+    """
+    Converts a size such as 1048576, '512M' or '10Gi' to a number of bytes.
+    Units are powers of 1024. Returns None if size is None.
+    """
+    if size is None or isinstance(size, int):
+        return size
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B?)\s*', str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("Could not parse size '{0}'.".format(size))
+    number, unit = match.groups()
+    return int(float(number) * _size_units[unit.upper()])
+
+class DiskBudget():
+    """
+    Keeps track of the number of bytes held on local disk and blocks callers which would
+    exceed the limit until enough space has been released. A single object larger than the
+    whole budget is still let through when nothing else is held, so progress is always possible.
+
+    Args:
+        limit: The maximum number of bytes to hold at once, or None for no limit
+    """
+    def __init__(self, limit:int = None):
+        self.limit = limit
+        self.used = 0
+        self._condition = threading.Condition()
+
+    def would_block(self, nbytes:int) -> bool:
+        """ Whether acquiring nbytes would currently block. """
+        with self._condition:
+            return self.limit is not None and self.used and self.used + (nbytes or 0) > self.limit
+
+    def acquire(self, nbytes:int, stop:threading.Event = None):
+        """ Blocks until nbytes fit in the budget and then holds them. """
+        nbytes = nbytes or 0
+        with self._condition:
+            while self.limit is not None and self.used and self.used + nbytes > self.limit:
+                if stop is not None and stop.is_set():
+                    return
+                self._condition.wait(timeout=1)
+            self.used += nbytes
+
+    def reserve(self, nbytes:int):
+        """ Holds nbytes without blocking. Used for bytes which are already on disk. """
+        with self._condition:
+            self.used += nbytes or 0
+
+    def release(self, nbytes:int):
+        with self._condition:
+            self.used -= nbytes or 0
+            self._condition.notify_all()
+
+_done = object()
+
+def prefetch(
+    coffer:'Coffer',
+    objects:List['ObjectInfo'],
+    local_dir:str,
+    budget:DiskBudget = None,
+    depth:int = 4,
+    concurrency:int = 1,
+    retries:int = 3,
+) -> Iterator[Tuple['ObjectInfo', str]]:
+    """
+    Downloads objects from a Coffer in the background and yields tuples
+    (object_info, local_path) in the order of objects. At most depth downloaded objects wait
+    to be consumed at any time, and each download first acquires the object's size from
+    budget. The consumer is responsible for releasing that space once it is done with the file.
+    Up to concurrency downloads run at once, each retried on transient errors (see
+    kungfupipelines.transfer).
+    """
+    from kungfupipelines.coffers import fetch
+    from kungfupipelines.transfer import retry, pool_connections
+    pool_connections(coffer, concurrency)
+    budget = budget or DiskBudget()
+    arrivals = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(entry):
+        while not stop.is_set():
+            try:
+                arrivals.put(entry, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def put_next(pending):
+        info, future = pending.popleft()
+        put((info, future.result()))
+
+    def download():
+        try:
+            with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+                pending = deque()
+                for info in objects:
+                    # Hand over the downloads in flight before waiting for space, since it is
+                    # only released once the consumer is done with them.
+                    if budget.would_block(info.size):
+                        while pending:
+                            put_next(pending)
+                    budget.acquire(info.size, stop)
+                    if stop.is_set():
+                        return
+                    pending.append((info, pool.submit(retry, fetch, coffer, info.name, local_dir, retries=retries)))
+                    # Hand over finished downloads in order, and wait once all threads are busy.
+                    while pending and (pending[0][1].done() or len(pending) >= max(concurrency, 1)):
+                        put_next(pending)
+                while pending:
+                    put_next(pending)
+            put(_done)
+        except Exception as e:
+            put(e)
+
+    worker = threading.Thread(target=download, name="prefetch-{0}".format(coffer.location), daemon=True)
+    worker.start()
+    try:
+        while True:
+            entry = arrivals.get()
+            if entry is _done:
+                return
+            if isinstance(entry, Exception):
+                raise entry
+            yield entry
+    finally:
+        stop.set()
@@ -0,0 +1,235 @@
+"""
+Parameter sweeps: running a Step once for each of many argument sets (configurations) in a
+single process, so that imports and the Step's setup (eg. loading data) are shared between
+them instead of being repeated in a pod of their own for each configuration.
+
+Configurations are dictionaries mapping argument names to values. They can be given as a
+list, or loaded from JSON (a list of objects) or JSON Lines (one object per line) in a local
+file, a Coffer object, or inline (see load_configurations). From the command line, a
+StepSwitch runs a sweep with
+    python myscript.py step1 --sweep configs.jsonl [--sweep-start 0 --sweep-stop 10]
+        [--sweep-executor process --sweep-workers 4]
+where arguments given on the command line are shared by every configuration, and values in
+the configurations take precedence. A SweepStep compiles a sweep into ContainerOps which run
+several configurations each.
+"""
+from kungfupipelines.step import Step
+from kungfupipelines.executor import imap_items, ItemFailure
+from typing import List, Union, TYPE_CHECKING
+import logging
+import json
+import copy
+import math
+
+if TYPE_CHECKING:
+    from caboodle.coffer import Coffer
+    from kungfupipelines.resources import Resources
+    from kfp import dsl
+
+logger = logging.getLogger(__name__)
+
+class SweepError(RuntimeError):
+    """
+    Raised when a Step fails on one or more configurations of a sweep. The failures attribute
+    contains an ItemFailure for each, whose item is the pair (index, configuration).
+    """
+    def __init__(self, step_name:str, failures:List[ItemFailure]):
+        self.step_name = step_name
+        self.failures = failures
+        super().__init__("Sweep of step {0} failed on {1} configurations: {2}".format(
+            step_name,
+            len(failures),
+            ", ".join(str(f.item[0]) for f in failures),
+        ))
+
+def parse_configurations(text:str) -> List[dict]:
+    """ Parses configurations from JSON (an object or a list of objects) or JSON Lines. """
+    try:
+        configurations = json.loads(text)
+    except ValueError:
+        configurations = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if isinstance(configurations, dict):
+        configurations = [configurations]
+    if not isinstance(configurations, list) or not all(isinstance(c, dict) for c in configurations):
+        raise ValueError("Expected a list of configurations, each of which is a JSON object.")
+    return configurations
+
+def load_configurations(source:Union[str, List[dict]], coffer:'Coffer' = None) -> List[dict]:
+    """
+    Loads the configurations of a sweep.
+
+    Args:
+        source: A list of configurations, inline JSON, a 'gs://bucket/folder/name' URL, or the
+            path of a local JSON or JSON Lines file
+        coffer: (optional) A Coffer containing source as an object
+    """
+    if not isinstance(source, str):
+        return [dict(c) for c in source]
+    if coffer is not None or source.startswith('gs://'):
+        from kungfupipelines import coffers
+        if coffer is None:
+            from caboodle.coffer import GCSCoffer
+            folder, source = source.rsplit('/', 1)
+            coffer = GCSCoffer(folder)
+        text = coffers.fetch_bytes(coffer, source).decode()
+    elif source.lstrip().startswith(('[', '{')):
+        text = source
+    else:
+        with open(source) as f:
+            text = f.read()
+    return parse_configurations(text)
+
+# The Steps which process pool workers have set up, by name, so that each worker sets a Step
+# up once rather than for every configuration.
+_worker_steps = {}
+
+def _run_configuration(item, step:Step, arguments:dict, in_worker:bool):
+
+    index, configuration = item
+    if in_worker:
+        step = _worker_steps.setdefault(step.name, step)
+    step.setup()
+    # Runs are independent, so concurrent runs each get a copy of the Step sharing its setup.
+    return index, copy.copy(step)(**dict(arguments, **configuration))
+
+def _argument_names(step:Step, configuration:dict) -> dict:
+    """ Converts the keys of a configuration to keyword argument names, checking that the Step accepts them. """
+    unknown = [key for key in configuration if key not in step.arguments and key.replace('_', '-') not in step.arguments]
+    if unknown:
+        raise ValueError("Step {0} does not accept the arguments {1}".format(step.name, unknown))
+    return {key.replace('-', '_'): value for key, value in configuration.items()}
+
+def run_sweep(
+    step:Step,
+    configurations:List[dict],
+    arguments:dict = None,
+    executor:str = 'serial',
+    workers:int = None,
+) -> List:
+    """
+    Runs a Step once for each configuration and returns the results in the same order. The
+    Step is set up once and shared by every run. With the process executor, each worker
+    process sets up a copy of the Step for itself (which is not torn down), and the Step must
+    be picklable. Configurations which fail don't stop the others, but a SweepError is raised
+    once all have run.
+
+    Args:
+        step: The Step to run
+        configurations: The arguments for each run
+        arguments: (optional) Arguments shared by every run. Those in a configuration take
+            precedence.
+        executor: One of 'serial', 'thread' or 'process'
+        workers: Maximum number of configurations to run at once
+    """
+    arguments = {key.replace('-', '_'): value for key, value in (arguments or {}).items()}
+    items = [(i, _argument_names(step, c)) for i, c in enumerate(configurations)]
+    in_worker = executor == 'process' and workers != 1
+    if in_worker:
+        step = copy.copy(step)
+        step.state = None # Don't send the parent's setup to the workers
+    logger.info("Running step {0} on {1} configurations".format(step.fullname, len(items)))
+
+    results = [None] * len(items)
+    failures = []
+    for item, ok, value, seconds in imap_items(
+        _run_configuration, items, (step, arguments, in_worker), executor=executor, workers=workers,
+    ):
+        if ok:
+            results[value[0]] = value[1]
+        else:
+            logger.error("Failed on configuration {0} {1}: {2}: {3}".format(item[0], item[1], value.error_type, value.message))
+            failures.append(value)
+    if failures:
+        raise SweepError(step.name, sorted(failures, key=lambda f: f.item[0]))
+    return results
+
+class SweepStep(Step):
+    """
+    Runs a Step once for each of a list of configurations. When compiled, the configurations
+    are packed into ContainerOps which run per_pod configurations each, so that a large sweep
+    doesn't pay for a pod start up (and the Step's setup) for every configuration. Arguments
+    given when compiling or running the SweepStep are shared by every configuration.
+
+    Args:
+        step: The Step to sweep
+        configurations: A list of configurations, or a source to load them from (see
+            load_configurations). The containers load a source themselves, so it must be
+            reachable from them (eg. a gs:// URL); a list is passed to them inline.
+        per_pod: The number of configurations to run in each ContainerOp
+        executor: (optional) How each ContainerOp runs its configurations: 'serial', 'thread' or 'process'
+        workers: (optional) Maximum number of configurations each ContainerOp runs at once
+    """
+    def __init__(
+        self,
+        step:Step,
+        configurations:Union[str, List[dict]],
+        per_pod:int = 1,
+        executor:str = None,
+        workers:int = None,
+    ):
+        super().__init__(
+            name = step.name,
+            function = None,
+            arguments = step.arguments,
+            fullname = "{0}-sweep".format(step.fullname),
+            description = "Runs {0} on each configuration of a sweep.".format(step.name),
+        )
+        self.step = step
+        self.source = configurations if isinstance(configurations, str) else None
+        self._configurations = None if self.source else load_configurations(configurations)
+        self.per_pod = per_pod
+        self.executor = executor
+        self.workers = workers
+
+    @property
+    def configurations(self) -> List[dict]:
+        """ The configurations of the sweep, loaded from the source when first needed. """
+        if self._configurations is None:
+            self._configurations = load_configurations(self.source)
+        return self._configurations
+
+    def setup(self) -> dict:
+        self.step.setup()
+        return {}
+
+    def teardown(self):
+        self.step.teardown()
+
+    def run(self, **kwargs):
+        return run_sweep(self.step, self.configurations, kwargs, self.executor or 'serial', self.workers)
+
+    def effective_resources(self) -> 'Resources':
+        return self.step.effective_resources()
+
+    def _sweep_arguments(self, start:int, stop:int) -> List[str]:
+        """ The command line options telling a StepSwitch to run configurations start to stop. """
+        if self.source:
+            arguments = ['--sweep', self.source, '--sweep-start', str(start), '--sweep-stop', str(stop)]
+        else:
+            arguments = ['--sweep', json.dumps(self.configurations[start:stop])]
+        if self.executor:
+            arguments += ['--sweep-executor', self.executor]
+        if self.workers:
+            arguments += ['--sweep-workers', str(self.workers)]
+        return arguments
+
+    def dslContainerOp(self, image, command=None, **kwargs) -> 'dsl.ContainerOp':
+        """ Returns a single ContainerOp which runs every configuration. """
+        return self._container_op(image, command, self.fullname, self._sweep_arguments(0, len(self.configurations)), kwargs)
+
+    def dslContainerOps(self, image, command=None, **kwargs) -> List['dsl.ContainerOp']:
+        """ Returns one ContainerOp for every per_pod configurations. """
+        count = len(self.configurations)
+        pods = max(math.ceil(count / self.per_pod), 1)
+        if pods == 1:
+            return [self.dslContainerOp(image, command, **kwargs)]
+        return [
+            self._container_op(
+                image,
+                command,
+                "{0}-{1}".format(self.fullname, i),
+                self._sweep_arguments(i * self.per_pod, min((i + 1) * self.per_pod, count)),
+                kwargs,
+            )
+            for i in range(pods)
+        ]
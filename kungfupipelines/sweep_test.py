@@ -0,0 +1,77 @@
+from kungfupipelines.sweep import SweepStep, SweepError, load_configurations, run_sweep
+from kungfupipelines.coffers import FolderCoffer
+from kungfupipelines.cli import StepSwitch
+from kungfupipelines.step import Step
+import pytest
+import json
+import os
+
+def setup_model():
+    return {'model': {'pid': os.getpid()}}
+
+def train(learning_rate, layers=1, model=None):
+    if learning_rate == 'bad':
+        raise ValueError("bad learning rate")
+    return {'score': float(learning_rate) * int(layers), 'pid': model['pid']}
+
+def test_load_configurations(tmp_path):
+
+    configurations = [{'learning-rate': 0.1}, {'learning-rate': 0.2, 'layers': 2}]
+    (tmp_path / "sweep.jsonl").write_text("".join(json.dumps(c) + "\n" for c in configurations))
+    (tmp_path / "sweep.json").write_text(json.dumps(configurations))
+    coffer = FolderCoffer(str(tmp_path / "coffer"))
+    (tmp_path / "coffer" / "sweep.json").write_text(json.dumps(configurations))
+
+    assert load_configurations(str(tmp_path / "sweep.jsonl")) == configurations
+    assert load_configurations(str(tmp_path / "sweep.json")) == configurations
+    assert load_configurations(json.dumps(configurations)) == configurations
+    assert load_configurations("sweep.json", coffer) == configurations
+    with pytest.raises(ValueError):
+        load_configurations("[1, 2]")
+
+@pytest.mark.parametrize("executor", ['serial', 'thread', 'process'])
+def test_run_sweep(executor):
+
+    calls = []
+    step = Step('train', train, ['learning-rate', 'layers'], setup=lambda: calls.append(1) or setup_model())
+    if executor == 'process': # The setup has to be picklable
+        step.setup_function = setup_model
+    configurations = [{'learning-rate': rate} for rate in (1, 2, 3, 4)] + [{'learning_rate': 5, 'layers': 1}]
+    results = run_sweep(step, configurations, {'layers': 2}, executor=executor, workers=2)
+    assert [r['score'] for r in results] == [2, 4, 6, 8, 5]
+    if executor == 'process':
+        assert len({r['pid'] for r in results}) <= 2 # Set up once per worker
+    else:
+        assert calls == [1] and step.state is not None
+
+    with pytest.raises(SweepError) as error:
+        run_sweep(step, [{'learning-rate': 1}, {'learning-rate': 'bad'}], executor=executor)
+    assert [f.item[0] for f in error.value.failures] == [1]
+    with pytest.raises(ValueError):
+        run_sweep(step, [{'epochs': 1}])
+
+def test_sweep_switch():
+
+    calls = []
+    switch = StepSwitch('test', [Step('train', train, ['learning-rate', 'layers'], setup=lambda: calls.append(1) or setup_model())])
+    configurations = json.dumps([{'learning-rate': rate} for rate in (1, 2, 3)])
+    results = switch(['train', '--layers', '3', '--sweep', configurations, '--sweep-start', '1', '--sweep-executor', 'thread'])
+    assert [r['score'] for r in results] == [6, 9]
+    assert calls == [1]
+    with pytest.raises(ValueError, match="--sweep needs"):
+        switch(['train', '--sweep'])
+
+def test_sweep_step():
+
+    step = Step('train', train, ['learning-rate', 'layers'], setup=setup_model)
+    sweep = SweepStep(step, [{'learning-rate': rate} for rate in range(5)], per_pod=2, executor='thread')
+    assert [r['score'] for r in sweep(layers=1)] == [0, 1, 2, 3, 4]
+
+    ops = sweep.dslContainerOps('image', 'script.py', layers='2')
+    assert [op.name.split()[0] for op in ops] == ['train-sweep-0', 'train-sweep-1', 'train-sweep-2']
+    assert ops[2].arguments == [
+        'script.py', 'train', '--layers', '2', '--sweep', json.dumps([{'learning-rate': 4}]), '--sweep-executor', 'thread',
+    ]
+
+    ops = SweepStep(step, 'gs://bucket/sweep.jsonl', per_pod=2)._sweep_arguments(2, 4)
+    assert ops == ['--sweep', 'gs://bucket/sweep.jsonl', '--sweep-start', '2', '--sweep-stop', '4']
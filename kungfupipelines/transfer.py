@@ -0,0 +1,156 @@
+"""
+Concurrent transfers between Coffers and local disk. A Coffer's own download and upload_folder
+methods move one object at a time, so on prefixes with many small objects they spend most of
+their time waiting on round trips. The functions here list a Coffer and move its objects
+with a bounded pool of threads sharing one client, retrying transient errors with
+exponential backoff.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from kungfupipelines import coffers
+from kungfupipelines.coffers import ObjectInfo
+from caboodle.coffer import Coffer, GCSCoffer
+from typing import Callable, List, Iterable, Iterator
+import threading
+import logging
+import random
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+def is_transient(error:Exception) -> bool:
+    """
+    Whether an error is worth retrying: connection problems, timeouts, and HTTP responses
+    such as 429 Too Many Requests or 503 Service Unavailable.
+    """
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    if getattr(error, 'code', None) in RETRYABLE_STATUS_CODES: # google.api_core exceptions
+        return True
+    try:
+        from requests import exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (exceptions.ConnectionError, exceptions.Timeout))
+
+def retry(
+    function:Callable,
+    *args,
+    retries:int = 3,
+    backoff:float = 0.5,
+    max_backoff:float = 30.,
+    **kwargs
+):
+    """
+    Calls function(*args, **kwargs), retrying up to retries times if it raises a transient
+    error (see is_transient). The n-th retry waits backoff * 2**n seconds, capped at
+    max_backoff and randomized by up to 50% so that concurrent workers don't retry in lockstep.
+    """
+    attempt = 0
+    while True:
+        try:
+            return function(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_transient(e):
+                raise
+            delay = min(backoff * 2 ** attempt, max_backoff) * random.uniform(0.5, 1.)
+            logger.warning("Retrying %s in %.1fs after %s: %s", getattr(function, '__name__', function), delay, type(e).__name__, e)
+            time.sleep(delay)
+            attempt += 1
+
+_pool_lock = threading.Lock()
+
+def pool_connections(coffer:Coffer, concurrency:int):
+    """
+    Makes sure that the HTTP connection pool of a GCSCoffer's client can hold a connection for
+    each of concurrency threads. By default it keeps 10, and threads beyond that open a new
+    connection for every request. Other Coffers are left as they are.
+    """
+    if not isinstance(coffer, GCSCoffer):
+        return
+    session = getattr(coffer.storage_client, '_http', None)
+    if session is None or not hasattr(session, 'mount'):
+        return
+    with _pool_lock:
+        if getattr(session, '_kungfupipelines_pool_size', 0) >= concurrency:
+            return
+        from requests.adapters import HTTPAdapter
+        session.mount('https://', HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+        session._kungfupipelines_pool_size = concurrency
+
+def _run_all(function:Callable, items:List, concurrency:int) -> List:
+    """ Calls function on each item with up to concurrency threads and returns the results in order. """
+    if concurrency <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(function, items))
+
+def read_ahead(function:Callable, items:Iterable, concurrency:int = 8) -> Iterator:
+    """
+    Lazily yields function(item) for each item, in order, while computing the results for up
+    to concurrency items ahead in a thread pool. This keeps downloads in flight while earlier
+    results are being consumed, without holding more than concurrency results in memory.
+    """
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        pending = deque()
+        for item in items:
+            if len(pending) >= max(concurrency, 1):
+                yield pending.popleft().result()
+            pending.append(pool.submit(function, item))
+        while pending:
+            yield pending.popleft().result()
+
+def download_objects(
+    coffer:Coffer,
+    objects:List[ObjectInfo],
+    local_dir:str,
+    concurrency:int = 8,
+    retries:int = 3,
+) -> List[str]:
+    """
+    Downloads the given objects from a Coffer into local_dir, concurrently, and returns their
+    local paths in the same order.
+    """
+    os.makedirs(local_dir, exist_ok=True)
+    pool_connections(coffer, concurrency)
+    return _run_all(
+        lambda info: retry(coffers.fetch, coffer, info.name, local_dir, retries=retries),
+        objects,
+        concurrency,
+    )
+
+def download_all(coffer:Coffer, local_dir:str, concurrency:int = 8, retries:int = 3) -> List[str]:
+    """
+    Lists a Coffer and downloads every artifact in it into local_dir (see download_objects).
+    Coffers which don't support object-level access fall back to coffer.download.
+    """
+    if not coffers.supports_objects(coffer):
+        coffer.download(local_dir)
+        return [os.path.join(local_dir, f) for f in os.listdir(local_dir)]
+    objects = retry(coffers.list_objects, coffer, retries=retries)
+    logger.info("Downloading {0} objects from {1} with {2} threads.".format(len(objects), coffer.location, concurrency))
+    return download_objects(coffer, objects, local_dir, concurrency, retries)
+
+def upload_files(coffer:Coffer, paths:List[str], concurrency:int = 8, retries:int = 3):
+    """
+    Uploads local files to a Coffer concurrently. Each file is stored under its basename.
+    """
+    pool_connections(coffer, concurrency)
+    _run_all(lambda path: retry(coffers.upload_file, coffer, path, retries=retries), paths, concurrency)
+
+def upload_folder(coffer:Coffer, folder:str, concurrency:int = 8, retries:int = 3):
+    """
+    Uploads every file in a folder to a Coffer concurrently. This is the concurrent
+    equivalent of coffer.upload_folder(folder), which it falls back to for Coffers which don't
+    support object-level access.
+    """
+    if not coffers.supports_objects(coffer):
+        coffer.upload_folder(folder)
+        return
+    paths = [os.path.join(folder, f) for f in sorted(os.listdir(folder))]
+    paths = [p for p in paths if os.path.isfile(p)]
+    logger.info("Uploading {0} files to {1} with {2} threads.".format(len(paths), coffer.location, concurrency))
+    upload_files(coffer, paths, concurrency, retries)
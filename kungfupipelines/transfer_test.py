@@ -0,0 +1,90 @@
+from kungfupipelines import transfer
+from kungfupipelines.coffers import FolderCoffer, list_objects
+from kungfupipelines.streaming import prefetch, DiskBudget
+import threading
+import time
+import pytest
+
+def test_retry():
+
+    attempts = []
+    def flaky(x):
+        attempts.append(x)
+        if len(attempts) < 3:
+            raise ConnectionError("connection reset")
+        return x * 2
+
+    assert transfer.retry(flaky, 4, retries=3, backoff=0) == 8
+    assert len(attempts) == 3
+
+    attempts.clear()
+    with pytest.raises(ConnectionError):
+        transfer.retry(flaky, 4, retries=1, backoff=0)
+    assert len(attempts) == 2
+
+    attempts.clear()
+    def broken():
+        attempts.append(None)
+        raise FileNotFoundError("missing")
+    with pytest.raises(FileNotFoundError): # Not transient, so not retried
+        transfer.retry(broken, retries=3, backoff=0)
+    assert len(attempts) == 1
+
+def test_is_transient():
+
+    class ServiceUnavailable(Exception):
+        code = 503
+
+    assert transfer.is_transient(ServiceUnavailable())
+    assert transfer.is_transient(TimeoutError())
+    assert not transfer.is_transient(ValueError())
+
+def test_read_ahead():
+
+    in_flight = 0
+    most_in_flight = 0
+    lock = threading.Lock()
+    def slow_square(x):
+        nonlocal in_flight, most_in_flight
+        with lock:
+            in_flight += 1
+            most_in_flight = max(most_in_flight, in_flight)
+        time.sleep(0.01)
+        with lock:
+            in_flight -= 1
+        return x * x
+
+    assert list(transfer.read_ahead(slow_square, range(20), concurrency=4)) == [x * x for x in range(20)]
+    assert 1 < most_in_flight <= 4
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_download_and_upload_folder(tmp_path, concurrency):
+
+    source = FolderCoffer(str(tmp_path / "source"))
+    for i in range(10):
+        (tmp_path / "source" / "{0}.txt".format(i)).write_text(str(i))
+    (tmp_path / "source" / ".manifest.json").write_text("{}")
+
+    paths = transfer.download_all(source, str(tmp_path / "local"), concurrency=concurrency)
+    assert sorted(p.name for p in (tmp_path / "local").iterdir()) == sorted("{0}.txt".format(i) for i in range(10))
+    assert len(paths) == 10
+
+    destination = FolderCoffer(str(tmp_path / "destination"))
+    transfer.upload_folder(destination, str(tmp_path / "local"), concurrency=concurrency)
+    assert list_objects(destination) == list_objects(source)
+
+def test_concurrent_prefetch_keeps_order(tmp_path):
+
+    source = FolderCoffer(str(tmp_path / "source"))
+    for i in range(10):
+        (tmp_path / "source" / "{0}.txt".format(i)).write_text("x" * 10)
+    objects = list_objects(source)
+    (tmp_path / "local").mkdir()
+
+    # The budget only holds two files, so downloads in flight must be handed over first.
+    budget = DiskBudget(20)
+    arrived = []
+    for info, path in prefetch(source, objects, str(tmp_path / "local"), budget, depth=1, concurrency=4):
+        arrived.append(info.name)
+        budget.release(info.size)
+    assert arrived == [o.name for o in objects]
@@ -0,0 +1,144 @@
+"""
+Passing artifacts between the ContainerOps of a Workflow on a shared volume. Normally each
+ArtifactStep uploads its outputs to its output_coffer, and the next ArtifactStep downloads them
+again from its input_coffer. With a SharedVolume, the Workflow provisions a PersistentVolumeClaim
+(a kfp VolumeOp) and mounts it into its ContainerOps: the producer writes its outputs to a
+folder on the volume, and the consumer reads them from there in place.
+
+    workflow = SequentialWorkflow('pipeline', steps, shared_volume=SharedVolume('100Gi'))
+
+An ArtifactStep hands its outputs off to an ArtifactStep which runs directly after it and whose
+input_coffer has the same location as its output_coffer, if no other ArtifactStep of the
+Workflow writes to that location. Its outputs are still uploaded if any other ArtifactStep of
+the Workflow reads them from the Coffer, or if it is listed in the Workflow's final outputs.
+Sharded, in-memory, incremental and checkpointed ArtifactSteps and FusedSteps always use their
+Coffers.
+"""
+from kungfupipelines.step import Step, ArtifactStep
+from collections import namedtuple
+from typing import Dict, List, Iterable, TYPE_CHECKING
+import posixpath
+import logging
+
+if TYPE_CHECKING:
+    from kfp import dsl
+
+logger = logging.getLogger(__name__)
+
+Handoff = namedtuple('Handoff', ['producer', 'consumers', 'folder', 'upload'])
+Handoff.__doc__ = """
+Describes the artifacts of one ArtifactStep which are passed on a shared volume.
+
+Args:
+    producer: The ArtifactStep which writes the artifacts
+    consumers: The ArtifactSteps which read them
+    folder: The folder on the volume holding the artifacts
+    upload: Whether the producer also uploads them to its output_coffer
+"""
+
+def _eligible(step:Step) -> bool:
+    return isinstance(step, ArtifactStep) and step.shards <= 1 and step.can_hand_off
+
+class SharedVolume():
+    """
+    A volume which a Workflow provisions and mounts into its ContainerOps in order to pass
+    artifacts between them (see the module documentation). The PersistentVolumeClaim is
+    named after the workflow run, and is not deleted when the run ends.
+
+    Args:
+        size: The size of the volume, eg. '100Gi'. It has to hold the outputs of every Step
+            which hands them off.
+        mount_path: Where to mount the volume in the containers
+        storage_class: (optional) The storage class of the volume
+        modes: (optional) The access modes of the volume (defaults to ReadWriteMany, which
+            Steps running in parallel on different nodes need)
+        name: The name of the VolumeOp and of the PersistentVolumeClaim
+    """
+    def __init__(
+        self,
+        size:str,
+        mount_path:str = '/mnt/kungfupipelines',
+        storage_class:str = None,
+        modes:List[str] = None,
+        name:str = 'shared-volume',
+    ):
+        self.size = size
+        self.mount_path = mount_path
+        self.storage_class = storage_class
+        self.modes = modes
+        self.name = name
+
+    def plan(self, dependencies:Dict[Step, List[Step]], final_outputs:Iterable[str] = ()) -> List[Handoff]:
+        """
+        Decides which artifacts to pass on the volume.
+
+        Args:
+            dependencies: A dictionary mapping each Step to the Steps it runs directly after
+            final_outputs: The names of Steps whose outputs are uploaded even if they are
+                passed on the volume
+        """
+        final_outputs = set(final_outputs)
+        steps = list(dependencies)
+        artifact_steps = [s for s in steps if isinstance(s, ArtifactStep)]
+        consumers = {}
+        for consumer in steps:
+            if not _eligible(consumer):
+                continue
+            location = consumer.input_coffer.location
+            writers = [s for s in artifact_steps if s.output_coffer.location == location]
+            if len(writers) == 1 and writers[0] in dependencies[consumer] and _eligible(writers[0]):
+                consumers.setdefault(writers[0], []).append(consumer)
+
+        handoffs = []
+        for producer in steps:
+            if producer not in consumers:
+                continue
+            readers = [s for s in artifact_steps if s.input_coffer.location == producer.output_coffer.location]
+            handoffs.append(Handoff(
+                producer,
+                consumers[producer],
+                posixpath.join(self.mount_path, producer.name),
+                producer.name in final_outputs or any(r not in consumers[producer] for r in readers),
+            ))
+        return handoffs
+
+    def apply(self, ops:Dict[Step, List['dsl.ContainerOp']], handoffs:List[Handoff]) -> 'dsl.VolumeOp':
+        """
+        Provisions the volume and configures the ContainerOps of the Steps in handoffs to use it.
+        This has to be called inside a pipeline function. Returns the VolumeOp, or None if
+        there is nothing to hand off.
+
+        Args:
+            ops: A dictionary mapping each Step to its ContainerOps
+            handoffs: The result of plan
+        """
+        if not handoffs:
+            return None
+        from kfp import dsl
+        kwargs = {'modes': self.modes} if self.modes else {}
+        volume_op = dsl.VolumeOp(
+            name=self.name,
+            resource_name=self.name,
+            size=self.size,
+            storage_class=self.storage_class,
+            **kwargs
+        )
+        mounted = set()
+        def mount(step:Step, arguments:List[str]):
+            for op in ops[step]:
+                op.arguments.extend(arguments)
+                if id(op) not in mounted:
+                    op.add_pvolumes({self.mount_path: volume_op.volume})
+                    mounted.add(id(op))
+
+        for handoff in handoffs:
+            logger.info("Passing artifacts from {0} to {1} through {2} on {3}".format(
+                handoff.producer.name, ", ".join(c.name for c in handoff.consumers), handoff.folder, self.name,
+            ))
+            arguments = ['--handoff-output', handoff.folder]
+            if handoff.upload:
+                arguments += ['--upload-outputs', 'true']
+            mount(handoff.producer, arguments)
+            for consumer in handoff.consumers:
+                mount(consumer, ['--handoff-input', handoff.folder])
+        return volume_op
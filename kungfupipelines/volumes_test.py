@@ -0,0 +1,77 @@
+from kungfupipelines import workflow
+from kungfupipelines.volumes import SharedVolume
+from kungfupipelines.step import Step, ArtifactStep
+from kungfupipelines.coffers import FolderCoffer
+from kungfupipelines.cli import StepSwitch
+from kungfupipelines.step_test import shout
+import tarfile
+import yaml
+import pytest
+
+def make_steps(tmp_path):
+
+    raw, clean, features, report = (FolderCoffer(str(tmp_path / name)) for name in ("raw", "clean", "features", "report"))
+    return [
+        ArtifactStep('clean', shout, [], raw, clean),
+        ArtifactStep('featurize', shout, [], clean, features),
+        ArtifactStep('train', shout, [], features, report),
+        ArtifactStep('audit', shout, [], clean, report, shards=2), # Reads clean from the Coffer
+    ]
+
+def test_plan(tmp_path):
+
+    clean, featurize, train, audit = make_steps(tmp_path)
+    volume = SharedVolume('10Gi', mount_path='/mnt/shared')
+    handoffs = volume.plan({clean: [], featurize: [clean], train: [featurize], audit: [clean]})
+    assert [(h.producer, h.consumers, h.folder, h.upload) for h in handoffs] == [
+        (clean, [featurize], '/mnt/shared/clean', True), # audit still needs the upload
+        (featurize, [train], '/mnt/shared/featurize', False),
+    ]
+    handoffs = volume.plan({clean: [], featurize: [clean], train: [featurize]}, final_outputs=['featurize'])
+    assert [h.upload for h in handoffs] == [False, True]
+    other = ArtifactStep('other', shout, [], clean.input_coffer, clean.output_coffer)
+    assert volume.plan({clean: [], other: [], featurize: [clean, other]}) == [] # Both write the inputs of featurize
+
+@pytest.mark.parametrize("mode", [{'in_memory': True}, {'incremental': True}, {'checkpoint': True}])
+def test_plan_skips_modes_without_handoff(tmp_path, mode):
+
+    clean, featurize, train, _ = make_steps(tmp_path)
+    featurize.configure(**mode)
+    assert SharedVolume('10Gi').plan({clean: [], featurize: [clean], train: [featurize]}) == []
+
+def test_shared_volume_workflow(tmp_path):
+
+    clean, featurize, train, _ = make_steps(tmp_path)
+    my_workflow = workflow.SequentialWorkflow(
+        'volume', [Step('start', print, []), clean, featurize, train], shared_volume=SharedVolume('10Gi'),
+    )
+    filename = str(tmp_path / "pipeline.tar.gz")
+    my_workflow.generate_yaml(filename, 'image', 'script.py')
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+
+    templates = {t['name']: t for t in spec['spec']['templates']}
+    assert templates['shared-volume']['resource']['action'] == 'create'
+    assert templates['clean']['container']['args'] == ['script.py', 'clean', '--handoff-output', '/mnt/kungfupipelines/clean']
+    assert templates['featurize']['container']['args'] == [
+        'script.py', 'featurize',
+        '--handoff-input', '/mnt/kungfupipelines/clean', '--handoff-output', '/mnt/kungfupipelines/featurize',
+    ]
+    assert templates['train']['container']['args'] == ['script.py', 'train', '--handoff-input', '/mnt/kungfupipelines/featurize']
+    for name in ('clean', 'featurize', 'train'):
+        assert templates[name]['container']['volumeMounts'][0]['mountPath'] == '/mnt/kungfupipelines'
+    assert 'volumeMounts' not in templates['start']['container']
+
+def test_handoff_options(tmp_path):
+
+    clean, featurize, train, _ = make_steps(tmp_path)
+    (tmp_path / "raw" / "a.txt").write_text("a")
+    switch = StepSwitch('volume', [clean, featurize, train])
+    switch(['clean', '--handoff-output', str(tmp_path / "volume" / "clean")])
+    switch(['featurize', '--handoff-input', str(tmp_path / "volume" / "clean"), '--handoff-output', str(tmp_path / "volume" / "featurize"), '--upload-outputs', 'true'])
+    switch(['train', '--handoff-input', str(tmp_path / "volume" / "featurize")])
+
+    assert list((tmp_path / "clean").iterdir()) == [] # Only passed on the volume
+    assert (tmp_path / "features" / "a.txt").read_text() == "A!!"
+    assert (tmp_path / "report" / "a.txt").read_text() == "A!!!"
+    assert clean.download_inputs and clean.upload_outputs # Options only apply to one invocation
@@ -1,26 +1,34 @@
 import abc
-import kfp
-from kfp import components, dsl, gcp
-import wrapt
-from typing import Callable, List
-from kungfupipelines.step import Step
+from typing import Callable, List, Union, Dict, Any, Tuple, TYPE_CHECKING
+from kungfupipelines.step import Step, ArtifactStep, FusedStep
 from kungfupipelines.cli import StepSwitch
+from kungfupipelines import local, graph
 
-def make_sequence(ops: List[dsl.ContainerOp]) -> None:
+if TYPE_CHECKING:
+    from kfp import dsl
+    from kungfupipelines.volumes import SharedVolume
+
+def _as_list(ops: Union['dsl.ContainerOp', List['dsl.ContainerOp']]) -> List['dsl.ContainerOp']:
+    return ops if isinstance(ops, list) else [ops]
+
+def make_sequence(ops: List[Union['dsl.ContainerOp', List['dsl.ContainerOp']]]) -> None:
     """ 
     Links a sequence of pipeline operations so that they are configured
     to take place one after another.
+    Each element can also be a list of operations which run in parallel (eg. the shards of
+    an ArtifactStep), in which case every operation in the next element runs after all of them.
     Args:
-        ops - list[dsl.ContainerOp]
+        ops - list[dsl.ContainerOp or list[dsl.ContainerOp]]
     """
     l = len(ops)
     if l <= 1:
         return
     i = 0
-    before = ops[i]
+    before = _as_list(ops[i])
     for op in ops[1:]:
-        op.after(before)
-        before = op
+        for o in _as_list(op):
+            o.after(*before)
+        before = _as_list(op)
     
 class Workflow(abc.ABC):
     """
@@ -43,13 +51,43 @@ class Workflow(abc.ABC):
         """
         pass
 
-    def generate_yaml(self, filename, *compile_args):
+    def generate_yaml(self, filename, *compile_args, cache=None, sizer=None):
         """
         Generates an argo workflow.yaml spec which can be used to submit this
         workflow to Argo / Kubeflow.
+        If a kungfupipelines.compiler.CompileCache is given, the spec is copied from it when
+        this workflow has been compiled with the same arguments before, and added to it
+        otherwise. To compile many workflows at once, see kungfupipelines.compiler.compile_many.
+        If a kungfupipelines.resources.ResourceSizer is given, the Steps' containers request
+        resources sized from their recorded profiles.
         """
+        if sizer is not None:
+            sizer.apply(self)
+        if cache is not None:
+            from kungfupipelines.compiler import fingerprint
+            key = fingerprint(self, *compile_args)
+            if cache.get(key, filename):
+                return
+        import kfp.compiler # Imported here since kfp is only needed for compiling
         pipeline = self.compile(*compile_args)
         kfp.compiler.Compiler().compile(pipeline, filename)
+        if cache is not None:
+            cache.put(key, filename)
+
+    def dependencies(self) -> Dict[Step, List[Step]]:
+        """
+        Returns a dictionary mapping each Step in this Workflow to the list of Steps which
+        must complete before it runs. This mirrors the structure that compile() encodes.
+        """
+        raise NotImplementedError("{0} does not describe its dependencies.".format(type(self).__name__))
+
+    def run_local(self, executor:str = 'thread', workers:int = None, **kwargs) -> Dict[str, Any]:
+        """
+        Runs this Workflow in the current process instead of on a cluster, by calling the
+        Steps directly. Steps which don't depend on each other run concurrently.
+        See kungfupipelines.local.run_local for a description of the arguments.
+        """
+        return local.run_local(self.dependencies(), executor=executor, workers=workers, **kwargs)
 
 class BasicMLWorkflow(Workflow):
     """
@@ -96,47 +134,214 @@ class BasicMLWorkflow(Workflow):
         
         def pipeline(*args, **kwargs):
 
-            make_dataset_op = self.make_dataset.dslContainerOp(self.image, self.script_path, **kwargs)
-            train_test_split_op = self.train_test_split.dslContainerOp(self.image, self.script_path, **kwargs)
-            train_op = self.train.dslContainerOp(
-                self.image, self.script_path, **kwargs
-                ).set_gpu_limit(1).add_toleration({
-                    'key': 'nvidia.com/gpu',
-                    'operator': 'Equal',
-                    'value': 'present',
-                    'effect': 'NoSchedule'
-                    })
+            make_dataset_ops = self.make_dataset.dslContainerOps(self.image, self.script_path, **kwargs)
+            train_test_split_ops = self.train_test_split.dslContainerOps(self.image, self.script_path, **kwargs)
+            train_ops = self.train.dslContainerOps(self.image, self.script_path, **kwargs)
+            resources = self.train.effective_resources()
+            if resources is None or resources.gpus is None: # Otherwise the Step already set its GPUs
+                for op in train_ops:
+                    op.set_gpu_limit(1).add_toleration({
+                        'key': 'nvidia.com/gpu',
+                        'operator': 'Equal',
+                        'value': 'present',
+                        'effect': 'NoSchedule'
+                        })
             postprocess_ops = [
-                pp.dslContainerOp(self.image, self.script_path, **kwargs)
+                pp.dslContainerOps(self.image, self.script_path, **kwargs)
                 for pp in self.postprocess_ops
             ]
 
-            make_sequence([make_dataset_op, train_test_split_op, train_op])
+            make_sequence([make_dataset_ops, train_test_split_ops, train_ops])
             for pp in postprocess_ops:
-                pp.after(train_op)
+                make_sequence([train_ops, pp])
 
         return pipeline
 
+    def dependencies(self) -> Dict[Step, List[Step]]:
+
+        dependencies = {
+            self.make_dataset: [],
+            self.train_test_split: [self.make_dataset],
+            self.train: [self.train_test_split],
+        }
+        for pp in self.postprocess_ops:
+            dependencies[pp] = [self.train]
+        return dependencies
+
 class SequentialWorkflow(Workflow):
-    
-    def __init__(self, name: str, steps: List[Step]):
+    """
+    A Workflow which runs its Steps one after another.
+
+    Args:
+        name: Name to use for the pipeline
+        steps: The Steps to run, in order
+        fuse: Whether to compile runs of consecutive Steps into a single ContainerOp (see
+            FusedStep). Sharded ArtifactSteps run in ContainerOps of their own.
+        keep_intermediates: Whether to upload artifacts passed between fused Steps, or on the
+            shared volume
+        shared_volume: (optional) A SharedVolume to pass artifacts between ContainerOps on,
+            instead of through remote storage (see kungfupipelines.volumes)
+        final_outputs: (optional) The names of Steps whose outputs are uploaded even if they
+            are passed on the shared volume
+    """
+    def __init__(
+        self,
+        name: str,
+        steps: List[Step],
+        fuse: bool = False,
+        keep_intermediates: bool = False,
+        shared_volume: 'SharedVolume' = None,
+        final_outputs: List[str] = None,
+    ):
         self.steps = steps
         self.step_switch = StepSwitch(name, steps)
+        self.fuse = fuse
+        self.keep_intermediates = keep_intermediates
+        self.shared_volume = shared_volume
+        self.final_outputs = final_outputs or []
 
-    def compile(self, image: str):
+    def stages(self) -> List[Step]:
+        """ Returns the Steps that will be compiled into ContainerOps, fusing them if requested. """
+        if not self.fuse:
+            return self.steps
+        stages = []
+        group = []
+        def close_group():
+            if len(group) == 1:
+                stages.append(group[0])
+            elif group:
+                stages.append(FusedStep(list(group), keep_intermediates=self.keep_intermediates))
+            group.clear()
+        for step in self.steps:
+            if isinstance(step, ArtifactStep) and step.shards > 1:
+                close_group()
+                stages.append(step)
+            else:
+                group.append(step)
+        close_group()
+        return stages
+
+    def compile(self, image: str, script_path: str = None):
+
+        stages = self.stages()
+        handoffs = _plan_handoffs(self, self.keep_intermediates)
 
         def pipeline(*args, **kwargs):
-            ops = []
-            for step in self.steps:
-                op = step.dslContainerOp(image)
+            ops = {}
+            for step in stages:
+                ops[step] = step.dslContainerOps(image, script_path, **kwargs)
             
-            make_sequence(ops)
+            make_sequence([ops[step] for step in stages])
+            if handoffs:
+                self.shared_volume.apply(ops, handoffs)
+
+        return pipeline
+
+    def dependencies(self) -> Dict[Step, List[Step]]:
+
+        stages = self.stages()
+        return {step: stages[i-1:i] for i, step in enumerate(stages)}
+
+class DAGWorkflow(Workflow):
+    """
+    A Workflow with an arbitrary acyclic dependency structure, such as diamonds where two
+    branches run in parallel and are then joined. Each Step declares the Steps it runs after.
+    Only the minimal set of dependencies needed to preserve the declared ordering (the
+    transitive reduction) is compiled into the pipeline.
+
+    Args:
+        name: Name to use for the pipeline
+        steps: The Steps in the workflow
+        dependencies: A dictionary mapping Step names to the names of the Steps they run after.
+            Steps which don't appear in it can start immediately.
+        shared_volume: (optional) A SharedVolume to pass artifacts between ContainerOps on,
+            instead of through remote storage (see kungfupipelines.volumes)
+        final_outputs: (optional) The names of Steps whose outputs are uploaded even if they
+            are passed on the shared volume
+    Raises:
+        ValueError: If a dependency refers to an unknown Step or the dependencies form a cycle
+    """
+    def __init__(
+        self,
+        name: str,
+        steps: List[Step],
+        dependencies: Dict[str, List[str]] = None,
+        shared_volume: 'SharedVolume' = None,
+        final_outputs: List[str] = None,
+    ):
+        self.name = name
+        self.steps = steps
+        self.shared_volume = shared_volume
+        self.final_outputs = final_outputs or []
+        self.step_switch = StepSwitch(name, steps)
+        steps_dict = self.step_switch.steps_dict
+        dependencies = dependencies or {}
+        for step_name, upstream in dependencies.items():
+            for u in [step_name] + list(upstream):
+                if u not in steps_dict:
+                    raise ValueError("Unknown step '{0}' in dependencies of {1}.".format(u, name))
+        self._dependencies = {
+            step: [steps_dict[u] for u in dependencies.get(step.name, [])]
+            for step in steps
+        }
+        self.order = graph.topological_order(self._dependencies) # Raises if there is a cycle
+
+    def dependencies(self) -> Dict[Step, List[Step]]:
+
+        return self._dependencies
+
+    def reduced_dependencies(self) -> Dict[Step, List[Step]]:
+        """ Returns the transitive reduction of the dependencies, which is what gets compiled. """
+        return graph.transitive_reduction(self._dependencies)
+
+    def critical_path(self, durations: Dict[str, float] = None) -> Tuple[List[Step], float]:
+        """
+        Returns the chain of Steps with the greatest total duration, along with that duration.
+        No matter how much parallelism is available, the pipeline cannot finish faster.
+
+        Args:
+            durations: (optional) A dictionary mapping Step names to their expected durations.
+                Steps which are missing are assumed to take 1 unit of time, so by default
+                this returns the longest chain of Steps and its length.
+        """
+        durations = durations or {}
+        return graph.critical_path(self._dependencies, lambda step: durations.get(step.name, 1))
+
+    def max_width(self) -> int:
+        """ Returns the maximum number of Steps which can run in parallel. """
+        return graph.max_width(self._dependencies)
+
+    def compile(self, image: str, script_path: str = None):
+
+        reduced = self.reduced_dependencies()
+        handoffs = _plan_handoffs(self)
+
+        def pipeline(*args, **kwargs):
+            ops = {}
+            for step in self.order:
+                ops[step] = step.dslContainerOps(image, script_path, **kwargs)
+                upstream_ops = [op for u in reduced[step] for op in ops[u]]
+                if upstream_ops:
+                    for op in ops[step]:
+                        op.after(*upstream_ops)
+            if handoffs:
+                self.shared_volume.apply(ops, handoffs)
 
         return pipeline
 
+def _plan_handoffs(workflow: Workflow, keep_intermediates: bool = False) -> list:
+    """ Plans the artifacts a Workflow passes on its shared volume, if it has one. """
+    if workflow.shared_volume is None:
+        return []
+    dependencies = workflow.dependencies()
+    final_outputs = [step.name for step in dependencies] if keep_intermediates else workflow.final_outputs
+    return workflow.shared_volume.plan(dependencies, final_outputs)
 
 def Pipeline(pipeline_func: Callable, name:str, description:str=''): # NOTE: This does not work
 
+    from kfp import dsl
+    import wrapt
+
     @dsl.pipeline(name=name, description=description)
     @wrapt.decorator
     def wrapper(wrapped, instance, args, kwargs):
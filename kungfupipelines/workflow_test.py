@@ -1,5 +1,12 @@
 from kungfupipelines import workflow
+from kungfupipelines.step import Step, ArtifactStep
+from kungfupipelines.coffers import FolderCoffer
 import inspect
+import tarfile
+import threading
+import time
+import yaml
+import pytest
 
 # def test_Pipeline(): # NOTE: This does not work because the introspection doesn't capture optional keyword arguments
 # 
@@ -12,4 +19,115 @@ import inspect
 # 
 #     assert signature(a=2, b=3) == 15
 #     assert signature(a=2, b=3, c=1) == 9
-#     assert inspect.getargspec(signature).args == ['a','b']
\ No newline at end of file
+#     assert inspect.getargspec(signature).args == ['a','b']
+
+def test_sharded_sequential_workflow(tmp_path):
+
+    inputs = FolderCoffer(str(tmp_path / "inputs"))
+    outputs = FolderCoffer(str(tmp_path / "outputs"))
+    first = Step('first', print, ['a'])
+    sharded = ArtifactStep('sharded', print, ['a'], inputs, outputs, shards=3)
+    last = Step('last', print, ['a'])
+    my_workflow = workflow.SequentialWorkflow('sharded', [first, sharded, last])
+
+    filename = str(tmp_path / "pipeline.tar.gz")
+    my_workflow.generate_yaml(filename, 'image', 'script.py')
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+
+    dag = next(t['dag'] for t in spec['spec']['templates'] if 'dag' in t)
+    tasks = {t['name']: t for t in dag['tasks']}
+    assert sorted(tasks) == ['first', 'last', 'sharded-shard-0', 'sharded-shard-1', 'sharded-shard-2']
+    assert sorted(tasks['last']['dependencies']) == ['sharded-shard-0', 'sharded-shard-1', 'sharded-shard-2']
+    for i in range(3):
+        assert tasks['sharded-shard-{0}'.format(i)]['dependencies'] == ['first']
+
+def test_run_local():
+
+    events = []
+    lock = threading.Lock()
+    def record(name):
+        def function(**kwargs):
+            with lock:
+                events.append(name)
+            time.sleep(.05)
+            return name + kwargs.get('suffix', '')
+        return function
+
+    postprocess = [Step('post{0}'.format(i), record('post{0}'.format(i)), ['suffix']) for i in range(3)]
+    my_workflow = workflow.BasicMLWorkflow(
+        name='ml',
+        image='image',
+        script_path='script.py',
+        make_dataset=Step('make_dataset', record('make_dataset'), []),
+        train_test_split=Step('split', record('split'), []),
+        preprocess=Step('preprocess', record('preprocess'), []),
+        train=Step('train', record('train'), ['suffix']),
+        postprocess_ops=postprocess,
+    )
+    start = time.time()
+    results = my_workflow.run_local(workers=3, suffix='!')
+    elapsed = time.time() - start
+
+    assert events[:3] == ['make_dataset', 'split', 'train']
+    assert sorted(events[3:]) == ['post0', 'post1', 'post2']
+    assert results['train'] == 'train!'
+    assert results['post1'] == 'post1!'
+    assert results['split'] == 'split'
+    assert elapsed < 0.05 * 6 # The postprocessing steps run concurrently
+
+def test_run_local_failure():
+
+    def fail():
+        raise ValueError("nope")
+    ran = []
+    steps = [Step('a', fail, []), Step('b', lambda: ran.append('b'), [])]
+    with pytest.raises(ValueError):
+        workflow.SequentialWorkflow('fails', steps).run_local()
+    assert ran == []
+
+def test_dag_workflow(tmp_path):
+
+    steps = [Step(name, print, []) for name in ['a', 'b', 'c', 'd']]
+    dependencies = {'b': ['a'], 'c': ['a'], 'd': ['b', 'c', 'a']}
+    my_workflow = workflow.DAGWorkflow('diamond', steps, dependencies)
+
+    path, length = my_workflow.critical_path({'c': 5})
+    assert [s.name for s in path] == ['a', 'c', 'd']
+    assert length == 7
+    assert my_workflow.max_width() == 2
+
+    filename = str(tmp_path / "pipeline.tar.gz")
+    my_workflow.generate_yaml(filename, 'image', 'script.py')
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+    dag = next(t['dag'] for t in spec['spec']['templates'] if 'dag' in t)
+    tasks = {t['name']: t for t in dag['tasks']}
+    assert sorted(tasks['d']['dependencies']) == ['b', 'c'] # a -> d is implied
+    assert tasks['b']['dependencies'] == ['a']
+
+    with pytest.raises(ValueError):
+        workflow.DAGWorkflow('cycle', steps, {'a': ['d'], 'd': ['a']})
+    with pytest.raises(ValueError):
+        workflow.DAGWorkflow('unknown', steps, {'a': ['z']})
+
+def test_fused_sequential_workflow(tmp_path):
+
+    inputs = FolderCoffer(str(tmp_path / "inputs"))
+    outputs = FolderCoffer(str(tmp_path / "outputs"))
+    steps = [
+        Step('a', print, ['x']),
+        Step('b', print, ['y']),
+        ArtifactStep('sharded', print, [], inputs, outputs, shards=2),
+        Step('c', print, []),
+    ]
+    my_workflow = workflow.SequentialWorkflow('fused', steps, fuse=True)
+    assert [s.name for s in my_workflow.stages()] == ['a,b', 'sharded', 'c']
+
+    filename = str(tmp_path / "pipeline.tar.gz")
+    my_workflow.generate_yaml(filename, 'image', 'script.py')
+    with tarfile.open(filename) as tar:
+        spec = yaml.safe_load(tar.extractfile(tar.getmembers()[0]))
+    containers = {t['name']: t['container'] for t in spec['spec']['templates'] if 'container' in t}
+    assert sorted(containers) == ['a-b', 'c', 'sharded-shard-0', 'sharded-shard-1']
+    assert containers['a-b']['args'] == ['script.py', 'a,b']
@@ -0,0 +1,248 @@
+"""
+Local working directories for ArtifactSteps. Each run of an ArtifactStep gets a Workspace: a
+directory of its own under the system's temporary folder (or a given root), holding an input
+and an output folder, which is removed when the run ends. Workspaces left behind by processes
+which were killed before they could clean up are removed when the next Workspace is created
+under the same root, so leftover files never fill the disk or get processed by a later Step.
+A Workspace holds a lock (flock) on a file inside it while it is open, so it is only removed
+once no process holds that lock. The root can thus be shared between pods, whose process ids
+are only unique within their own container.
+
+A Workspace also knows how much it may hold: the smaller of its disk cap and the free space
+on its filesystem (less a reserve). ArtifactSteps stream inputs which don't fit.
+"""
+from kungfupipelines.streaming import DiskBudget, parse_size
+from typing import List
+import tempfile
+import logging
+import weakref
+import socket
+import shutil
+import fcntl
+import mmap
+import os
+import io
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'kungfupipelines-'
+LOCK = '.lock'
+
+def _hostname() -> str:
+    return socket.gethostname().replace(os.sep, '_')
+
+def _running(pid:int) -> bool:
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError: # Someone else's process
+        return True
+    return True
+
+def _lock(path:str):
+    """
+    Opens the lock file at path and takes an exclusive lock on it without blocking. Returns
+    the open file, which holds the lock until it is closed, or None if another open file
+    (in any process) holds the lock.
+    """
+    f = open(path, 'a')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+def _owner(name:str):
+    """ Returns the hostname and process id in the name of a Workspace directory. """
+    host, pid, _ = name[len(PREFIX):].rsplit('-', 2)
+    return host, int(pid)
+
+def _is_stale(path:str) -> bool:
+    """
+    Whether the Workspace at path was left behind. A Workspace whose lock can be taken is
+    stale. One without a lock file is still being created, unless it was made by a process
+    on this host which is no longer running; processes on other hosts can't be checked.
+    """
+    lock_path = os.path.join(path, LOCK)
+    if os.path.exists(lock_path):
+        lock = _lock(lock_path)
+        if lock is None:
+            return False
+        lock.close() # The Workspace is removed with the lock file in it
+        return True
+    try:
+        host, pid = _owner(os.path.basename(path))
+    except ValueError:
+        return False
+    return host == _hostname() and pid != os.getpid() and not _running(pid)
+
+def remove_stale(root:str) -> List[str]:
+    """
+    Removes the Workspaces under root which were left behind by processes that ended
+    without cleaning up, and returns their paths.
+    """
+    removed = []
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        path = os.path.join(root, name)
+        if not name.startswith(PREFIX) or not _is_stale(path):
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info("Removed workspace %s left behind by an earlier run.", path)
+        removed.append(path)
+    return removed
+
+def _close_workspace(path:str, lock):
+    shutil.rmtree(path, ignore_errors=True)
+    lock.close()
+
+class Workspace():
+    """
+    A directory for one run of an ArtifactStep, which is removed when the Workspace is closed,
+    when it is garbage collected, or when the interpreter exits. Use it as a context manager:
+
+        with Workspace(disk_cap='10G') as workspace:
+            ... # Download into workspace.input_dir, write to workspace.output_dir
+
+    Args:
+        root: (optional) The folder to create the Workspace in (defaults to the system's
+            temporary folder)
+        input_dir: (optional) A folder to use for inputs instead of one inside the Workspace.
+            It is neither created nor removed by the Workspace.
+        output_dir: (optional) A folder to use for outputs instead of one inside the Workspace
+        disk_cap: (optional) Maximum bytes of inputs and outputs to hold at once, either as a
+            number or a string such as '10G'
+        reserve: Free space to leave on the filesystem, either as a number or a string
+    """
+    def __init__(
+        self,
+        root:str = None,
+        input_dir:str = None,
+        output_dir:str = None,
+        disk_cap = None,
+        reserve = '256M',
+    ):
+        self.root = root or tempfile.gettempdir()
+        self.disk_cap = parse_size(disk_cap)
+        self.reserve = parse_size(reserve)
+        self._input_dir = input_dir
+        self._output_dir = output_dir
+        self.path = None
+        self._finalizer = None
+
+    def open(self):
+
+        os.makedirs(self.root, exist_ok=True)
+        remove_stale(self.root)
+        self.path = tempfile.mkdtemp(prefix='{0}{1}-{2}-'.format(PREFIX, _hostname(), os.getpid()), dir=self.root)
+        # The lock file only appears once it is locked, so it is never seen unlocked while in use.
+        lock = _lock(os.path.join(self.path, LOCK + '.new'))
+        os.rename(os.path.join(self.path, LOCK + '.new'), os.path.join(self.path, LOCK))
+        self._finalizer = weakref.finalize(self, _close_workspace, self.path, lock)
+        self.input_dir = self._input_dir or os.path.join(self.path, 'input')
+        self.output_dir = self._output_dir or os.path.join(self.path, 'output')
+        for folder in ('input', 'output'):
+            os.makedirs(os.path.join(self.path, folder))
+        return self
+
+    def close(self):
+        """ Removes the Workspace directory. Input and output folders given explicitly are kept. """
+        if self._finalizer is not None:
+            self._finalizer()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def free_bytes(self) -> int:
+        """ The free space on the filesystem which holds the inputs. """
+        folder = self.input_dir
+        while not os.path.exists(folder): # A given input_dir may not have been created yet
+            folder = os.path.dirname(os.path.abspath(folder))
+        return shutil.disk_usage(folder).free
+
+    def capacity(self) -> int:
+        """ The number of bytes the Workspace can hold at the moment. """
+        free = max(self.free_bytes() - self.reserve, 0)
+        return free if self.disk_cap is None else min(self.disk_cap, free)
+
+    def fits(self, nbytes:int) -> bool:
+        return nbytes <= self.capacity()
+
+    def budget(self) -> DiskBudget:
+        """ Returns a DiskBudget for streaming files through the Workspace. """
+        return DiskBudget(self.capacity())
+
+class MappedFile(io.BufferedIOBase):
+    """
+    A read-only file object backed by a memory map of a local file, so that its contents are
+    paged in from disk as they are read rather than held in memory. Like an io.BytesIO, it
+    can be handed to a caboodle Artifact as its path_or_buffer, and getbuffer() returns its
+    contents without copying. It is pickled by path, so it can be sent to worker processes.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # Empty files can't be mapped.
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else None
+        self._empty = io.BytesIO()
+
+    def __reduce__(self):
+        return (MappedFile, (self.path,))
+
+    @property
+    def _source(self):
+        return self._map if self._map is not None else self._empty
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def read(self, size:int = -1) -> bytes:
+        return self._source.read(-1 if size is None else size)
+
+    read1 = read
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self, size:int = -1) -> bytes:
+
+        start = self._source.tell()
+        line = self._source.readline()
+        if size is not None and 0 <= size < len(line):
+            self._source.seek(start + size)
+            line = line[:size]
+        return line
+
+    def seek(self, offset:int, whence:int = io.SEEK_SET) -> int:
+        self._source.seek(offset, whence)
+        return self._source.tell()
+
+    def tell(self) -> int:
+        return self._source.tell()
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._map) if self._map is not None else self._empty.getbuffer()
+
+    def close(self):
+
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError: # A view returned by getbuffer is still in use; it is unmapped once released
+                pass
+        super().close()
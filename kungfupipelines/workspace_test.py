@@ -0,0 +1,69 @@
+from kungfupipelines import workspace
+from kungfupipelines.workspace import Workspace, MappedFile, remove_stale, PREFIX
+from caboodle.artifacts import PickleArtifact
+import subprocess
+import fcntl
+import pickle
+import sys
+import os
+
+def test_workspace(tmp_path):
+
+    with Workspace(str(tmp_path), disk_cap='1K') as workspace:
+        assert os.path.isdir(workspace.input_dir) and os.path.isdir(workspace.output_dir)
+        assert workspace.capacity() == 1024
+        assert workspace.fits(1000) and not workspace.fits(2000)
+        assert workspace.budget().limit == 1024
+    assert list(tmp_path.iterdir()) == []
+
+    # Folders given explicitly are left alone.
+    (tmp_path / "outputs").mkdir()
+    with Workspace(str(tmp_path / "root"), output_dir=str(tmp_path / "outputs")) as workspace:
+        (tmp_path / "outputs" / "a.txt").write_text("a")
+        assert workspace.output_dir == str(tmp_path / "outputs")
+    assert list((tmp_path / "root").iterdir()) == []
+    assert (tmp_path / "outputs" / "a.txt").exists()
+
+def test_remove_stale(tmp_path):
+
+    host = workspace._hostname()
+    finished = subprocess.Popen([sys.executable, "-c", "pass"])
+    finished.wait()
+    stale = tmp_path / "{0}{1}-{2}-abc".format(PREFIX, host, finished.pid)
+    (stale / "input").mkdir(parents=True)
+    live = tmp_path / "{0}{1}-{2}-abc".format(PREFIX, host, os.getppid())
+    live.mkdir()
+    # Another pod on a shared root, with a process id which isn't running here
+    other = tmp_path / "{0}other-host-{1}-abc".format(PREFIX, finished.pid)
+    other.mkdir()
+    locked = tmp_path / "{0}other-host-{1}-def".format(PREFIX, finished.pid)
+    locked.mkdir()
+    lock = open(str(locked / workspace.LOCK), 'a')
+    fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+    crashed = tmp_path / "{0}other-host-{1}-ghi".format(PREFIX, os.getpid())
+    crashed.mkdir()
+    (crashed / workspace.LOCK).write_text("") # Its lock was released when its process died
+
+    with Workspace(str(tmp_path)) as current:
+        assert not stale.exists() and not crashed.exists()
+        assert live.exists() and other.exists() and locked.exists()
+        assert remove_stale(str(tmp_path)) == [] # The current Workspace holds its lock
+        assert os.path.exists(current.path)
+    lock.close()
+    assert remove_stale(str(tmp_path)) == [str(locked)]
+
+def test_mapped_file(tmp_path):
+
+    path = tmp_path / "data.pickle"
+    path.write_bytes(pickle.dumps(list(range(100))))
+    mapped = MappedFile(str(path))
+    assert PickleArtifact("data.pickle", path_or_buffer=mapped).data == list(range(100))
+    assert bytes(mapped.getbuffer()[:2]) == path.read_bytes()[:2]
+
+    copied = pickle.loads(pickle.dumps(mapped)) # Sent to worker processes by path
+    assert copied.read() == path.read_bytes()
+    copied.close()
+    mapped.close()
+
+    (tmp_path / "empty").write_bytes(b"")
+    assert MappedFile(str(tmp_path / "empty")).read() == b""